@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Replay recorded MQTT traffic through the ingest path and measure its throughput.
+
+Messages go through MqttListenerClient._on_message, the parser, the WorkerInputQueue,
+the Worker and the Aggregator, with an in-process stand-in for the broker.
+Reports throughput, latency percentiles per stage and the worker queue depth.
+
+Captures are the .mqttcap files written by the "mqtt_capture" config of the aggregator,
+or JSONL files of {"topic": ..., "payload": ..., "ts": ...} objects.
+Text corpora with one "topic - message" per line are also accepted, replayed as if
+received at --text-rate messages per second. By default replays the corpus recorded
+next to the parser. Runs against fakeredis, or a local Redis with --redis-host.
+
+With --reads-per-second, /space_state reads are made during the replay, through the
+ReaderPool or, with --read-path worker, through the worker queue like before, and their
+latency percentiles are reported.
+
+With --coalesce, the state updates go through the StateUpdateCoalescer, flushed every
+--coalesce seconds. Compare the Redis calls made with and without it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+SRC_DIRPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+sys.path.append(SRC_DIRPATH)
+
+from aggregator.clock import Clock  # noqa: E402
+from aggregator.communication import ReaderPool  # noqa: E402
+from aggregator.local_cache import CachingRedisAdapter  # noqa: E402
+from aggregator.logging import configure_logging_for_tests  # noqa: E402
+from aggregator.logic import Aggregator  # noqa: E402
+from aggregator.metrics import ADAPTER_CALLS, InstrumentedAdapter  # noqa: E402
+from aggregator.model import Machine, User  # noqa: E402
+from aggregator.mqtt.capture import CAPTURE_FILE_EXTENSION  # noqa: E402
+from aggregator.mqtt.mqtt_client import MqttListenerClient  # noqa: E402
+from aggregator.mqtt.mqtt_parser import MACHINE_TAG_RE  # noqa: E402
+from aggregator.mqtt.replay import (  # noqa: E402
+    AGGREGATOR,
+    STAGES,
+    CapturedMessage,
+    InProcessBroker,
+    InstrumentedWorkerInputQueue,
+    StageTimings,
+    broker_stand_in,
+    instrument_parsers,
+    read_capture,
+    replay,
+)
+from aggregator.mqtt.state_coalescer import StateUpdateCoalescer  # noqa: E402
+from aggregator.redis import RedisAdapter  # noqa: E402
+from aggregator.utils import percentile  # noqa: E402
+from aggregator.worker import Worker  # noqa: E402
+
+KEY_PREFIX = "msl_aggregator_benchmark"
+DEFAULT_CORPUS = os.path.join(
+    SRC_DIRPATH, "aggregator", "mqtt", "sample_mqtt_messages.txt"
+)
+
+
+class NullQueue(object):
+    def send_message(self, **kwargs):
+        pass
+
+
+class NullEmailAdapter(object):
+    def send_email_to_user(self, user, message, logger):
+        pass
+
+    def send_email(self, name, email, message, logger):
+        pass
+
+
+class DirectoryDatabase(object):
+    def __init__(self, users, machines):
+        self.users = users
+        self.machines = machines
+
+    def get_all_users(self, logger):
+        return self.users
+
+    def get_all_machines(self, logger):
+        return self.machines
+
+
+def read_text_corpus(file_path, messages_per_second):
+    messages = []
+    with open(file_path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if " - " in line:
+                topic, message = line.strip().split(" - ", 1)
+                ts = len(messages) / messages_per_second
+                messages.append(CapturedMessage(topic, message.encode("utf-8"), ts))
+    return messages
+
+
+def directory_from_capture(messages):
+    # Every user and machine mentioned in the capture, so that the logic finds them
+    user_ids = set()
+    machine_names = set()
+    for message in messages:
+        machine_match = MACHINE_TAG_RE.match(message.topic)
+        if machine_match:
+            machine_names.add(machine_match.group(1))
+        if message.payload.startswith(b"JSON="):
+            try:
+                payload = json.loads(message.payload[5:])
+            except ValueError:
+                continue
+            if isinstance(payload.get("userid"), int):
+                user_ids.add(payload["userid"])
+    users = [
+        User(i, f"First{i}", f"Last{i}", f"user{i}@example.com", f"+31{i}", False)
+        for i in sorted(user_ids)
+    ]
+    machines = [
+        Machine(i, name, "", name, name, "Benchmark")
+        for i, name in enumerate(sorted(machine_names), 1)
+    ]
+    return users, machines
+
+
+def make_redis_adapter(clock, args):
+    if args.redis_host:
+        return RedisAdapter(
+            clock,
+            args.redis_host,
+            args.redis_port,
+            0,
+            None,
+            KEY_PREFIX,
+            3600,
+            90,
+            60,
+            7,
+        )
+    import fakeredis
+    import redis
+
+    redis_class = redis.Redis
+    redis.Redis = fakeredis.FakeRedis
+    try:
+        return RedisAdapter(clock, None, None, 0, None, KEY_PREFIX, 3600, 90, 60, 7)
+    finally:
+        redis.Redis = redis_class
+
+
+def delete_all_keys(redis_adapter):
+    for key in redis_adapter.redis.keys(KEY_PREFIX + ":*"):
+        redis_adapter.redis.delete(key)
+
+
+async def read_continuously(
+    read, aggregator, logger, reads_per_second, stop, latencies
+):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await read(aggregator.get_space_state_for_json, logger)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(1 / reads_per_second)
+
+
+def start_reading(args, loop, reader_pool, worker_input_queue, aggregator, logger):
+    stop = threading.Event()
+    latencies = []
+    if args.read_path == "worker":
+        read = worker_input_queue.add_task_with_result_future
+    else:
+        read = reader_pool.run
+    future = asyncio.run_coroutine_threadsafe(
+        read_continuously(
+            read, aggregator, logger, args.reads_per_second, stop, latencies
+        ),
+        loop,
+    )
+    return stop, future, latencies
+
+
+def format_ms(value):
+    return f"{value * 1000:.3f}" if value is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("captures", nargs="*", default=[DEFAULT_CORPUS])
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=None,
+        help="1 for the original speed, N for N times faster (default: as fast as possible)",
+    )
+    parser.add_argument("--text-rate", type=float, default=10)
+    parser.add_argument("--topic-filters", nargs="+", default=None)
+    parser.add_argument("--pool-size", type=int, default=1)
+    parser.add_argument("--max-pending-per-partition", type=int, default=0)
+    parser.add_argument("--reads-per-second", type=float, default=0)
+    parser.add_argument("--read-path", choices=["pool", "worker"], default="pool")
+    parser.add_argument("--reader-pool-size", type=int, default=4)
+    parser.add_argument("--coalesce", type=float, default=None)
+    parser.add_argument("--redis-host", default=None)
+    parser.add_argument("--redis-port", type=int, default=6379)
+    args = parser.parse_args()
+
+    logger = configure_logging_for_tests()
+    logger.python_logger.setLevel("CRITICAL")
+
+    messages = []
+    for file_path in args.captures:
+        if file_path.endswith((".jsonl", CAPTURE_FILE_EXTENSION)):
+            messages.extend(read_capture(file_path))
+        else:
+            messages.extend(read_text_corpus(file_path, args.text_rate))
+    messages.sort(key=lambda message: message.ts)
+
+    clock = Clock()
+    redis_adapter = make_redis_adapter(clock, args)
+    delete_all_keys(redis_adapter)
+    users, machines = directory_from_capture(messages)
+    redis_adapter.set_users_by_ids(users, logger)
+    redis_adapter.set_all_machines(machines, logger)
+    aggregator = Aggregator(
+        DirectoryDatabase(users, machines),
+        CachingRedisAdapter(InstrumentedAdapter(redis_adapter, "benchmark")),
+        None,
+        NullQueue(),
+        clock,
+        NullEmailAdapter(),
+        None,
+        5,
+    )
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    reader_pool = ReaderPool(loop, args.reader_pool_size)
+
+    stage_timings = StageTimings()
+    worker_input_queue = InstrumentedWorkerInputQueue(
+        loop, stage_timings, args.max_pending_per_partition
+    )
+    state_coalescer = None
+    if args.coalesce is not None:
+        state_coalescer = StateUpdateCoalescer(
+            aggregator, worker_input_queue, args.coalesce
+        )
+        state_coalescer.start_flushing_in_background_thread(logger)
+    broker = InProcessBroker(stage_timings)
+    with broker_stand_in(broker):
+        mqtt_listener_client = MqttListenerClient(
+            worker_input_queue,
+            aggregator,
+            logger,
+            None,
+            None,
+            False,
+            topic_filters=args.topic_filters,
+            coalescer=state_coalescer,
+        )
+    instrument_parsers(mqtt_listener_client, stage_timings)
+    mqtt_listener_client.start_listening_on_a_background_thread()
+    Worker(worker_input_queue, args.pool_size).start_working_in_background_thread()
+
+    if args.reads_per_second:
+        stop_reading, reading, read_latencies = start_reading(
+            args, loop, reader_pool, worker_input_queue, aggregator, logger
+        )
+    start = time.perf_counter()
+    publish_time = replay(messages, broker, args.speed)
+    if state_coalescer:
+        # Flushes the pending states
+        state_coalescer.stop()
+    worker_input_queue.wait_until_empty()
+    total_time = time.perf_counter() - start
+    if args.reads_per_second:
+        stop_reading.set()
+        reading.result()
+    delete_all_keys(redis_adapter)
+
+    num_tasks = len(stage_timings.durations[AGGREGATOR])
+    print(
+        f"{len(messages)} messages, {broker.num_delivered} delivered, "
+        f"{broker.num_filtered} filtered by the subscriptions, {num_tasks} aggregator tasks"
+    )
+    print(
+        f"Published in {publish_time:.2f} s, processed in {total_time:.2f} s: "
+        f"{len(messages) / total_time:.0f} messages/s"
+    )
+    print(f"Max worker queue depth: {stage_timings.get_max_queue_depth()}")
+    num_redis_calls = sum(
+        count
+        for (adapter_name, _), count in ADAPTER_CALLS.values.items()
+        if adapter_name == "benchmark"
+    )
+    print(f"Redis adapter calls: {num_redis_calls}")
+    if state_coalescer:
+        print(f"State updates: {state_coalescer.get_stats()}")
+    print()
+    print(
+        f"{'stage':>12} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10}"
+    )
+    for stage in STAGES:
+        values = stage_timings.get_percentiles(stage)
+        print(f"{stage:>12} " + " ".join(f"{format_ms(v):>10}" for v in values))
+
+    if args.reads_per_second:
+        read_latencies.sort()
+        print()
+        print(
+            f"{len(read_latencies)} /space_state reads through the {args.read_path}: "
+            + ", ".join(
+                f"{name} {format_ms(percentile(read_latencies, fraction))} ms"
+                for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+            )
+        )
+    reader_pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of the MQTT message parser over recorded message corpora.
+
+By default replays the corpora recorded next to the parser. A corpus is a text file with
+either one "topic - message" per line, or aggregator log lines with "Cannot parse message:".
+
+Use --baseline with the path of another mqtt_parser.py (e.g. extracted with `git show`)
+to compare against it, and to check that both return the same results.
+"""
+import argparse
+import collections
+import importlib.util
+import os
+import sys
+import time
+
+SRC_DIRPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+sys.path.append(SRC_DIRPATH)
+
+from aggregator.mqtt import mqtt_parser  # noqa: E402
+
+MQTT_DIRPATH = os.path.join(SRC_DIRPATH, "aggregator", "mqtt")
+DEFAULT_CORPORA = [
+    os.path.join(MQTT_DIRPATH, "sample_mqtt_messages.txt"),
+    os.path.join(MQTT_DIRPATH, "errors_3_mar_2019.txt"),
+]
+LOG_LINE_MARKER = "Cannot parse message: "
+
+
+def read_corpus(file_path):
+    messages = []
+    with open(file_path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            line = line.strip()
+            if LOG_LINE_MARKER in line:
+                line = line[line.index(LOG_LINE_MARKER) + len(LOG_LINE_MARKER) :]
+            if " - " in line:
+                messages.append(tuple(line.split(" - ", 1)))
+    return messages
+
+
+def load_parser(file_path):
+    spec = importlib.util.spec_from_file_location("baseline_mqtt_parser", file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.parse_message
+
+
+def safe_parse(parse_message, topic, message):
+    try:
+        return parse_message(topic, message)
+    except Exception as e:
+        return type(e).__name__
+
+
+def measure(parse_message, messages, repetitions):
+    timings = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        for topic, message in messages:
+            try:
+                parse_message(topic, message)
+            except Exception:
+                pass
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return len(messages) / best, best * 1e6 / len(messages)
+
+
+def result_kind(parsed_message):
+    if parsed_message is None:
+        return "unparsed"
+    if isinstance(parsed_message, str):
+        return parsed_message
+    return parsed_message[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("corpora", nargs="*", default=DEFAULT_CORPORA)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--repetitions", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = []
+    for file_path in args.corpora:
+        messages.extend(read_corpus(file_path))
+
+    parsers = [("current", mqtt_parser.parse_message)]
+    if args.baseline:
+        parsers.append(("baseline", load_parser(args.baseline)))
+
+    kinds = collections.Counter(
+        result_kind(safe_parse(mqtt_parser.parse_message, topic, message))
+        for topic, message in messages
+    )
+    print(f"{len(messages)} messages:")
+    for kind, count in kinds.most_common():
+        print(f"  {kind:>24} {count:>8}")
+    print()
+
+    print(f"{'parser':>10} {'messages/s':>12} {'us/message':>11}")
+    for name, parse_message in parsers:
+        throughput, latency = measure(parse_message, messages, args.repetitions)
+        print(f"{name:>10} {throughput:>12.0f} {latency:>11.2f}")
+
+    if args.baseline:
+        baseline = parsers[1][1]
+        differences = [
+            (topic, message)
+            for topic, message in messages
+            if safe_parse(baseline, topic, message)
+            != safe_parse(mqtt_parser.parse_message, topic, message)
+        ]
+        print(f"\n{len(differences)} messages parsed differently from the baseline")
+        for topic, message in differences[:10]:
+            print(f"  {topic} - {message}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Compare directory reloads (all users + all machines) with and without the MySQL connection pool.
+
+Needs a MySQL database with the CRM schema. Connection parameters are read from the
+same environment variables as server-dev.py, or from the command line.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+SRC_DIRPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+sys.path.append(SRC_DIRPATH)
+
+from aggregator.database import MySQLAdapter  # noqa: E402
+from aggregator.logging import configure_logging_for_tests  # noqa: E402
+
+
+def measure(database_adapter, repetitions, logger):
+    timings = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        database_adapter.get_all_users(logger)
+        database_adapter.get_all_machines(logger)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--unix-socket", default=None)
+    parser.add_argument("--database", default="makerspace")
+    parser.add_argument("--user", default=os.environ.get("MSL_AGGREGATOR_DB_USER"))
+    parser.add_argument(
+        "--password", default=os.environ.get("MSL_AGGREGATOR_DB_PASSWORD")
+    )
+    parser.add_argument("--pool-size", type=int, default=2)
+    parser.add_argument("--repetitions", type=int, default=100)
+    args = parser.parse_args()
+
+    logger = configure_logging_for_tests()
+    logger.python_logger.setLevel("WARNING")
+
+    connection_params = {
+        "database": args.database,
+        "user": args.user,
+        "password": args.password,
+    }
+    if args.unix_socket:
+        connection_params["unix_socket"] = args.unix_socket
+    else:
+        connection_params["host"] = args.host
+        connection_params["port"] = args.port
+
+    print(f"{'mode':>10} {'median (ms)':>12} {'p95 (ms)':>10} {'total (s)':>10}")
+    for mode, pool_size in (("unpooled", None), ("pooled", args.pool_size)):
+        database_adapter = MySQLAdapter(pool_size=pool_size, **connection_params)
+        database_adapter.get_all_users(logger)  # Warm-up
+        timings = measure(database_adapter, args.repetitions, logger)
+        p95 = sorted(timings)[int(len(timings) * 0.95) - 1]
+        print(
+            f"{mode:>10} {statistics.median(timings):>12.2f} {p95:>10.2f} {sum(timings) / 1000:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
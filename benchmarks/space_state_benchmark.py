@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Count Redis round-trips and measure the latency of building the /space_state payload.
+
+By default runs against fakeredis (an in-process Redis stand-in), which has no network
+latency and interprets Lua in Python: there the round-trip count is the meaningful figure.
+Use --redis-host to measure latency against a real (local) Redis instead.
+"""
+import argparse
+import os
+import sys
+import time
+
+SRC_DIRPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+sys.path.append(SRC_DIRPATH)
+
+from aggregator.clock import MockClock  # noqa: E402
+from aggregator.logging import configure_logging_for_tests  # noqa: E402
+from aggregator.logic import Aggregator  # noqa: E402
+from aggregator.model import Machine, User, UserEntered  # noqa: E402
+from aggregator.redis import RedisAdapter  # noqa: E402
+
+KEY_PREFIX = "msl_aggregator_benchmark"
+
+
+class RoundTripCounter(object):
+    def __init__(self, client):
+        self.count = 0
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        def counting_execute_command(*args, **kwargs):
+            self.count += 1
+            return execute_command(*args, **kwargs)
+
+        def counting_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def counting_execute(*args, **kwargs):
+                self.count += 1
+                return execute(*args, **kwargs)
+
+            pipe.execute = counting_execute
+            return pipe
+
+        client.execute_command = counting_execute_command
+        client.pipeline = counting_pipeline
+
+
+class NullQueue(object):
+    def send_message(self, **kwargs):
+        pass
+
+
+class DirectoryDatabase(object):
+    def __init__(self, users, machines):
+        self.users = users
+        self.machines = machines
+
+    def get_all_users(self, logger):
+        return self.users
+
+    def get_all_machines(self, logger):
+        return self.machines
+
+
+def make_redis_adapter(clock, args):
+    if args.redis_host:
+        return RedisAdapter(
+            clock,
+            args.redis_host,
+            args.redis_port,
+            0,
+            None,
+            KEY_PREFIX,
+            3600,
+            90,
+            60,
+            7,
+        )
+    import fakeredis
+    import redis
+
+    redis_class = redis.Redis
+    redis.Redis = fakeredis.FakeRedis
+    try:
+        return RedisAdapter(clock, None, None, 0, None, KEY_PREFIX, 3600, 90, 60, 7)
+    finally:
+        redis.Redis = redis_class
+
+
+def populate(redis_adapter, clock, num_machines, logger):
+    users = [
+        User(i, f"First{i}", f"Last{i}", f"user{i}@example.com", f"+31{i}", False)
+        for i in range(1, num_machines + 1)
+    ]
+    machines = [
+        Machine(i, f"Machine {i}", "", f"machine{i}", f"node{i}", f"Room {i % 5}")
+        for i in range(1, num_machines + 1)
+    ]
+    redis_adapter.set_users_by_ids(users, logger)
+    redis_adapter.set_all_machines(machines, logger)
+    now = clock.now()
+    for user in users[: max(1, num_machines // 4)]:
+        redis_adapter.store_user_in_space(user, now, logger)
+        redis_adapter.store_history_line(
+            UserEntered(user.user_id, now, user.first_name, user.last_name), logger
+        )
+    for user, machine in zip(users, machines[: max(1, num_machines // 2)]):
+        redis_adapter.set_machine_on(
+            machine.node_machine_name, user.user_id, now, logger
+        )
+    for machine in machines:
+        redis_adapter.set_machine_state(machine.node_machine_name, "ready", logger)
+    return users, machines
+
+
+def per_key_reads(aggregator, logger):
+    # The access pattern used before the snapshot: one command per key
+    redis_adapter = aggregator.redis_adapter
+    for user_id, _ in redis_adapter.get_user_ids_in_space_with_timestamps(logger):
+        redis_adapter.get_user_by_id(user_id, logger)
+    for machine in redis_adapter.get_all_machines(logger):
+        redis_adapter.get_machine_state(machine.node_machine_name, logger)
+    for machine in redis_adapter.get_machines_on(logger):
+        state = redis_adapter.get_machine_on(machine, logger)
+        redis_adapter.get_user_by_id(state["user_id"], logger)
+        redis_adapter.get_machine_by_name(machine, logger)
+    redis_adapter.get_lights_on(logger)
+    redis_adapter.get_all_history_lines(logger)
+    redis_adapter.get_space_open(logger)
+
+
+def measure(function, counter, repetitions):
+    function()  # Warm-up, e.g. to load Lua scripts
+    counter.count = 0
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    elapsed = time.perf_counter() - start
+    return counter.count / repetitions, elapsed * 1000 / repetitions
+
+
+def delete_all_keys(redis_adapter):
+    for key in redis_adapter.redis.keys(KEY_PREFIX + ":*"):
+        redis_adapter.redis.delete(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--redis-host", default=None)
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--repetitions", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    logger = configure_logging_for_tests()
+    logger.python_logger.setLevel("WARNING")
+    clock = MockClock()
+
+    print(f"{'machines':>8} {'method':>14} {'round-trips':>12} {'latency (ms)':>13}")
+    for num_machines in args.sizes:
+        redis_adapter = make_redis_adapter(clock, args)
+        delete_all_keys(redis_adapter)
+        users, machines = populate(redis_adapter, clock, num_machines, logger)
+        aggregator = Aggregator(
+            DirectoryDatabase(users, machines),
+            redis_adapter,
+            None,
+            NullQueue(),
+            clock,
+            None,
+            None,
+            5,
+        )
+        counter = RoundTripCounter(redis_adapter.redis)
+        for name, function in (
+            ("per-key reads", lambda: per_key_reads(aggregator, logger)),
+            ("snapshot", lambda: redis_adapter.get_space_state_snapshot(logger)),
+            ("space_state", lambda: aggregator.get_space_state_for_json(logger)),
+        ):
+            round_trips, latency = measure(function, counter, args.repetitions)
+            print(f"{num_machines:>8} {name:>14} {round_trips:>12.0f} {latency:>13.2f}")
+        delete_all_keys(redis_adapter)
+
+
+if __name__ == "__main__":
+    main()
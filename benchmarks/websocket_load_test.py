@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Open hundreds of websocket clients and measure the delivery latency of the space state deltas.
+
+By default runs in-process: the clients are tasks subscribed to a SpaceStateFeed, and a
+thread publishes the deltas like the worker does. This measures the broadcast hub alone.
+
+With --url, the clients connect to the /ws websocket of a running aggregator (using wsproto,
+which comes with Quart), and the deltas are triggered by publishing lights messages on the
+test/log/lights MQTT topic of --mqtt-host. The latency is measured from the timestamp of the
+delta, so run the load test on the same host as the aggregator.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+SRC_DIRPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+sys.path.append(SRC_DIRPATH)
+
+from aggregator.broadcast_hub import (  # noqa: E402
+    SLOW_SUBSCRIBER_POLICIES,
+    SubscriberDisconnected,
+)
+from aggregator.space_state_feed import (  # noqa: E402
+    SNAPSHOT,
+    USER_CHECKED_OUT,
+    SpaceStateFeed,
+)
+from aggregator.utils import percentile  # noqa: E402
+
+LIGHTS_TOPIC = "test/log/lights"
+LIGHTS_MESSAGES = [
+    'lights {"machine": "lights", "state": "Lights are ON"}',
+    'lights {"machine": "lights", "state": "Powered - no lights"}',
+]
+
+
+class DeliveryStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.num_snapshots = 0
+        self.num_connected = 0
+        self.num_disconnected = 0
+
+    def received(self, text):
+        received_at = time.time()
+        message = json.loads(text)
+        if message["type"] == SNAPSHOT:
+            self.num_snapshots += 1
+        else:
+            self.latencies.append(received_at - message["ts"])
+
+
+# -- In-process ----
+
+
+async def in_process_client(feed, stats):
+    async def get_space_state():
+        return {}
+
+    subscription = feed.subscribe()
+    stats.num_connected += 1
+    try:
+        while True:
+            for text in await subscription.get_next_messages(get_space_state):
+                stats.received(text)
+    except SubscriberDisconnected:
+        stats.num_disconnected += 1
+    finally:
+        feed.unsubscribe(subscription)
+
+
+def publish_in_process(feed, args):
+    for i in range(args.messages):
+        feed.send_message(msg_type=USER_CHECKED_OUT, user_id=i, history_line=None)
+        time.sleep(1 / args.rate)
+
+
+async def run_in_process(args, stats):
+    loop = asyncio.get_event_loop()
+    feed = SpaceStateFeed(
+        loop,
+        max_pending_per_client=args.max_pending_per_client,
+        slow_client_policy=args.slow_client_policy,
+    )
+    clients = [
+        asyncio.ensure_future(in_process_client(feed, stats))
+        for _ in range(args.clients)
+    ]
+    await asyncio.sleep(0.1)
+    await loop.run_in_executor(None, publish_in_process, feed, args)
+    await asyncio.sleep(args.grace_period)
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+    return feed.hub.get_stats()
+
+
+# -- Over the network ----
+
+
+async def websocket_client(url, stats, stop):
+    from wsproto import ConnectionType, WSConnection
+    from wsproto.events import (
+        AcceptConnection,
+        CloseConnection,
+        Ping,
+        Request,
+        TextMessage,
+    )
+
+    parts = urlsplit(url)
+    try:
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    except OSError:
+        stats.num_disconnected += 1
+        return
+    connection = WSConnection(ConnectionType.CLIENT)
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
+    writer.write(connection.send(Request(host=parts.netloc, target=target)))
+    text = []
+    try:
+        while not stop.is_set():
+            data = await reader.read(65536)
+            if not data:
+                stats.num_disconnected += 1
+                return
+            connection.receive_data(data)
+            for event in connection.events():
+                if isinstance(event, AcceptConnection):
+                    stats.num_connected += 1
+                elif isinstance(event, TextMessage):
+                    text.append(event.data)
+                    if event.message_finished:
+                        stats.received("".join(text))
+                        text = []
+                elif isinstance(event, Ping):
+                    writer.write(connection.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    stats.num_disconnected += 1
+                    writer.write(connection.send(event.response()))
+                    return
+    finally:
+        writer.close()
+
+
+def publish_over_mqtt(args):
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client()
+    client.connect(args.mqtt_host, args.mqtt_port)
+    client.loop_start()
+    for i in range(args.messages):
+        client.publish(LIGHTS_TOPIC, LIGHTS_MESSAGES[i % 2])
+        time.sleep(1 / args.rate)
+    client.loop_stop()
+    client.disconnect()
+
+
+async def run_over_the_network(args, stats):
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    clients = [
+        asyncio.ensure_future(websocket_client(args.url, stats, stop))
+        for _ in range(args.clients)
+    ]
+    while stats.num_connected + stats.num_disconnected < args.clients:
+        await asyncio.sleep(0.1)
+    await loop.run_in_executor(None, publish_over_mqtt, args)
+    await asyncio.sleep(args.grace_period)
+    stop.set()
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+    return None
+
+
+def format_ms(value):
+    return f"{value * 1000:.3f}" if value is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--grace-period", type=float, default=1)
+    parser.add_argument("--max-pending-per-client", type=int, default=100)
+    parser.add_argument(
+        "--slow-client-policy", choices=SLOW_SUBSCRIBER_POLICIES, default="resync"
+    )
+    parser.add_argument("--url", default=None, help="e.g. ws://127.0.0.1:5000/ws")
+    parser.add_argument("--mqtt-host", default="127.0.0.1")
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    args = parser.parse_args()
+
+    stats = DeliveryStats()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run = run_over_the_network if args.url else run_in_process
+    hub_stats = loop.run_until_complete(run(args, stats))
+
+    latencies = sorted(stats.latencies)
+    print(
+        f"{args.clients} clients, {stats.num_connected} connected, "
+        f"{stats.num_disconnected} disconnected"
+    )
+    print(
+        f"{args.messages} messages published, {len(latencies)} delivered, "
+        f"{stats.num_snapshots} snapshots"
+    )
+    print(
+        "Delivery latency (ms): "
+        f"p50 {format_ms(percentile(latencies, 0.5))}, "
+        f"p95 {format_ms(percentile(latencies, 0.95))}, "
+        f"p99 {format_ms(percentile(latencies, 0.99))}, "
+        f"max {format_ms(latencies[-1] if latencies else None)}"
+    )
+    if hub_stats:
+        print(f"Hub: {hub_stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,8 @@ CONFIG = {
         "database": "makerspace",
         "user": os.environ.get("MSL_AGGREGATOR_DB_USER", None),
         "password": os.environ.get("MSL_AGGREGATOR_DB_PASSWORD", None),
+        "pool_size": 2,
+        "pool_recycle_in_sec": 3600,
     },
     "redis": {
         "host": "localhost",
@@ -22,16 +24,62 @@ CONFIG = {
         "machine_state_timeout_in_minutes": 60,  # 1 hour
         "history_lines_expiration_in_days": 7,
     },
+    "local_cache": {
+        "ttl_in_sec": 30,
+        "max_size": 2000,
+    },
+    "negative_cache": {
+        # Unknown user IDs, machine names and phone numbers don't trigger a reload from MySQL
+        "ttl_in_sec": 60,
+        "max_size": 1000,
+    },
     "mqtt": {
         "host": "space.makerspaceleiden.nl",
         "port": 1883,
         "log_all_messages": False,
+        "topic_filters": [
+            "makerspace/groteschakelaar/#",
+            "ac/log/#",
+            "test/log/#",
+        ],
+    },
+    "state_coalescer": {
+        # Repeated machine_state, lights and space_open messages are sent to the worker
+        # at most once per flush, and only when the state changed
+        "flush_interval_in_sec": 0.5,
+        # Unchanged states are still written again, or their expiration pushed back
+        "refresh_interval_in_sec": 300,
     },
     "crm": {
         "base_url": "https://mijn.makerspaceleiden.nl/api/v1",
         "auth_type": "token",
         "api_token": os.environ["MSL_AGGREGATOR_CRM_API_TOKEN"],
     },
+    "crm_outbox": {
+        # Check-ins and check-outs are stored in Redis and sent in the background
+        "concurrency": 2,
+        "initial_backoff_in_sec": 5,
+        "max_backoff_in_sec": 3600,
+        "max_attempts": 20,
+    },
+    "space_state_feed": {
+        # Deltas kept for websocket clients resuming after a disconnection
+        "history_size": 1000,
+        # Deltas a slow client can lag behind before it gets a new snapshot instead
+        "max_pending_per_client": 100,
+        # "resync" (send a new snapshot), "drop_oldest" or "disconnect"
+        "slow_client_policy": "resync",
+    },
+    "reader_pool": {
+        # Threads serving the read-only requests, concurrently with the worker
+        "pool_size": 4,
+    },
+    "space_state": {
+        # The precomputed /space_state is also rebuilt when older, for the relative times
+        "max_age_in_sec": 60,
+        # Also keep gzip and, if available, brotli encoded versions
+        "compress": True,
+    },
     "http": {
         "host": "127.0.0.1",
         "port": 5000,
@@ -41,6 +89,23 @@ CONFIG = {
             "password": "pass",
         },
     },
+    "directory_sync": {
+        # Apply only the users and machines changed in MySQL, instead of reloading everything
+        "crontab": "* * * * *",  # Every minute
+    },
+    "worker": {
+        # Tasks about the same user or machine run in order, the others in parallel
+        "pool_size": 4,
+        "max_pending_per_partition": 1000,
+        # Tasks pending in total. When full, tasks of a message class with an overflow
+        # policy are coalesced or dropped, the others wait. Check-ins and check-outs wait.
+        "max_size": 10000,
+        "overflow_policies": {
+            "machine_state": "coalesce",
+            "lights": "coalesce",
+            "space_open": "coalesce",
+        },
+    },
     "check_stale_checkins": {
         # If someone is still checked in at 5am from at least midnight, consider it stale
         "crontab": "0 5 * * *",  # At 5am every day
@@ -48,6 +113,14 @@ CONFIG = {
     },
     "email": {
         "from_address": "MakerSpace BOT <noc@makerspaceleiden.nl>",
+        # Emails are queued and sent over a persistent connection to the local relay
+        "smtp": {
+            "host": "localhost",
+            "port": 25,
+            "batch_size": 20,
+            "max_emails_per_minute": 60,
+            "max_attempts": 5,
+        },
     },
 }
 
@@ -0,0 +1,168 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict, deque
+
+from .utils import percentile
+
+# What to do when a subscriber has max_pending messages not yet taken
+RESYNC = "resync"  # Drop them all, the subscriber starts over from a snapshot
+DROP_OLDEST = (
+    "drop_oldest"  # Resyncs too when the dropped message had no coalescing key
+)
+DISCONNECT = "disconnect"
+
+SLOW_SUBSCRIBER_POLICIES = (RESYNC, DROP_OLDEST, DISCONNECT)
+
+
+class SubscriberDisconnected(Exception):
+    pass
+
+
+class BroadcastHub(object):
+    """
+    Delivers every published message to all the subscribers, each with its own bounded
+    buffer, so that a slow subscriber does not hold up the others.
+
+    A message published with a coalescing key replaces the pending message of the subscriber
+    with the same key, which is outdated by it. To be used only from the asyncio loop.
+    """
+
+    def __init__(
+        self,
+        max_pending_per_subscriber=100,
+        slow_subscriber_policy=RESYNC,
+        num_latency_samples=1000,
+        time_function=time.monotonic,
+    ):
+        if slow_subscriber_policy not in SLOW_SUBSCRIBER_POLICIES:
+            raise ValueError(f"Unknown slow subscriber policy {slow_subscriber_policy}")
+        self.max_pending_per_subscriber = max_pending_per_subscriber
+        self.slow_subscriber_policy = slow_subscriber_policy
+        self.time_function = time_function
+        self.subscribers = set()
+        self.latencies = deque(maxlen=num_latency_samples)
+        self.stats = {
+            "published": 0,
+            "delivered": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "resyncs": 0,
+            "disconnected": 0,
+        }
+
+    def subscribe(self):
+        subscriber = Subscriber(self)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, message, coalescing_key=None):
+        self.stats["published"] += 1
+        now = self.time_function()
+        for subscriber in list(self.subscribers):
+            subscriber.put(message, coalescing_key, now)
+
+    def get_stats(self):
+        now = self.time_function()
+        lags = [len(subscriber.pending) for subscriber in self.subscribers]
+        lags_in_sec = [
+            subscriber.get_lag_in_sec(now) for subscriber in self.subscribers
+        ]
+        latencies = sorted(self.latencies)
+        return dict(
+            self.stats,
+            subscribers=len(self.subscribers),
+            max_lag=max(lags, default=0),
+            total_lag=sum(lags),
+            max_lag_in_sec=max(lags_in_sec, default=0),
+            delivery_latency_p50_in_sec=percentile(latencies, 0.5),
+            delivery_latency_p99_in_sec=percentile(latencies, 0.99),
+        )
+
+
+class Subscriber(object):
+    def __init__(self, hub):
+        self.hub = hub
+        # Messages by coalescing key, oldest first. Messages without a key get a unique one.
+        self.pending = OrderedDict()
+        self.unique_keys = itertools.count()
+        self.wake_up = asyncio.Event()
+        self.needs_resync = False
+        self.disconnected = False
+
+    def put(self, message, coalescing_key, now):
+        hub = self.hub
+        if coalescing_key is None:
+            coalescing_key = (None, next(self.unique_keys))
+        elif self.pending.pop(coalescing_key, None):
+            hub.stats["coalesced"] += 1
+        if len(self.pending) >= hub.max_pending_per_subscriber:
+            if hub.slow_subscriber_policy == DROP_OLDEST:
+                dropped_key, _ = self.pending.popitem(last=False)
+                hub.stats["dropped"] += 1
+                if dropped_key[0] is None and not self.needs_resync:
+                    # A message without a key is not outdated by a later one: without
+                    # it the subscriber would miss a change, so it has to start over
+                    hub.stats["resyncs"] += 1
+                    self.needs_resync = True
+            elif hub.slow_subscriber_policy == RESYNC:
+                hub.stats["dropped"] += len(self.pending)
+                hub.stats["resyncs"] += 1
+                self.pending.clear()
+                self.needs_resync = True
+                self.wake_up.set()
+                return
+            else:
+                hub.stats["dropped"] += len(self.pending)
+                hub.stats["disconnected"] += 1
+                self.pending.clear()
+                self.disconnected = True
+                hub.unsubscribe(self)
+                self.wake_up.set()
+                return
+        self.pending[coalescing_key] = (message, now)
+        self.wake_up.set()
+
+    def request_resync(self):
+        self.needs_resync = True
+        self.wake_up.set()
+
+    def take_resync(self):
+        """
+        Whether the subscriber has to start over. If so, the pending messages are dropped.
+        """
+        if not self.needs_resync:
+            return False
+        self.needs_resync = False
+        self.pending.clear()
+        return True
+
+    def get_nowait(self):
+        """
+        The oldest pending message, or None.
+        """
+        if self.disconnected:
+            raise SubscriberDisconnected()
+        if not self.pending:
+            return None
+        _, (message, published_at) = self.pending.popitem(last=False)
+        self.hub.stats["delivered"] += 1
+        self.hub.latencies.append(self.hub.time_function() - published_at)
+        return message
+
+    async def wait(self):
+        """
+        Waits until there is something new: a message, a resync or a disconnection.
+        """
+        if self.disconnected:
+            raise SubscriberDisconnected()
+        self.wake_up.clear()
+        await self.wake_up.wait()
+
+    def get_lag_in_sec(self, now):
+        for _, published_at in self.pending.values():
+            return now - published_at
+        return 0
@@ -0,0 +1,114 @@
+import asyncio
+import unittest
+
+from .broadcast_hub import (
+    DISCONNECT,
+    DROP_OLDEST,
+    RESYNC,
+    BroadcastHub,
+    SubscriberDisconnected,
+)
+
+
+def take_all(subscriber):
+    messages = []
+    while True:
+        message = subscriber.get_nowait()
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+class TestBroadcastHub(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_every_subscriber_gets_every_message(self):
+        hub = BroadcastHub()
+        subscribers = [hub.subscribe(), hub.subscribe()]
+        for i in range(3):
+            hub.publish(i)
+
+        for subscriber in subscribers:
+            self.assertEqual(take_all(subscriber), [0, 1, 2])
+        stats = hub.get_stats()
+        self.assertEqual((stats["subscribers"], stats["delivered"]), (2, 6))
+
+    def test_waiting_subscribers_are_woken_up(self):
+        hub = BroadcastHub()
+        subscriber = hub.subscribe()
+
+        async def receive():
+            await subscriber.wait()
+            return subscriber.get_nowait()
+
+        task = self.loop.create_task(receive())
+        self.loop.call_soon(hub.publish, "hello")
+        self.assertEqual(self.loop.run_until_complete(task), "hello")
+
+    def test_messages_with_the_same_key_are_coalesced(self):
+        hub = BroadcastHub()
+        subscriber = hub.subscribe()
+        hub.publish("lights on", "lights")
+        hub.publish("user in")
+        hub.publish("lights off", "lights")
+
+        self.assertEqual(take_all(subscriber), ["user in", "lights off"])
+        self.assertEqual(hub.get_stats()["coalesced"], 1)
+
+    def test_slow_subscribers_lose_the_oldest_messages(self):
+        hub = BroadcastHub(
+            max_pending_per_subscriber=2, slow_subscriber_policy=DROP_OLDEST
+        )
+        subscriber = hub.subscribe()
+        for i in range(5):
+            hub.publish(i, ("lights", i))
+
+        stats = hub.get_stats()
+        self.assertEqual((stats["max_lag"], stats["dropped"]), (2, 3))
+        self.assertFalse(subscriber.take_resync())
+        self.assertEqual(take_all(subscriber), [3, 4])
+
+    def test_slow_subscribers_losing_a_message_without_key_resync(self):
+        hub = BroadcastHub(
+            max_pending_per_subscriber=2, slow_subscriber_policy=DROP_OLDEST
+        )
+        subscriber = hub.subscribe()
+        hub.publish("user in")
+        for i in range(3):
+            hub.publish(i, ("lights", i))
+
+        stats = hub.get_stats()
+        self.assertEqual((stats["dropped"], stats["resyncs"]), (2, 1))
+        self.assertTrue(subscriber.take_resync())
+        self.assertEqual(take_all(subscriber), [])
+
+    def test_slow_subscribers_resync(self):
+        hub = BroadcastHub(max_pending_per_subscriber=2, slow_subscriber_policy=RESYNC)
+        subscriber = hub.subscribe()
+        for i in range(4):
+            hub.publish(i)
+
+        self.assertTrue(subscriber.take_resync())
+        self.assertEqual(take_all(subscriber), [])
+        self.assertFalse(subscriber.take_resync())
+
+    def test_slow_subscribers_are_disconnected(self):
+        hub = BroadcastHub(
+            max_pending_per_subscriber=2, slow_subscriber_policy=DISCONNECT
+        )
+        slow = hub.subscribe()
+        fast = hub.subscribe()
+        for i in range(3):
+            hub.publish(i)
+            take_all(fast)
+
+        with self.assertRaises(SubscriberDisconnected):
+            slow.get_nowait()
+        stats = hub.get_stats()
+        self.assertEqual((stats["subscribers"], stats["disconnected"]), (1, 1))
@@ -1,33 +1,203 @@
 import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
 
+from .metrics import REGISTRY
+from .utils import percentile
 
-class HttpServerInputMessageQueue(object):
-    def __init__(self, asyncio_loop):
-        self.msg_queue = asyncio.Queue()
-        self.asyncio_loop = asyncio_loop
+# Tasks added without a partition key all run in order, as with a single worker
+DEFAULT_PARTITION = None
+
+# What to do with a task when the worker input queue is full
+BLOCK = (
+    "block"  # Wait for room, holding up the caller: backpressure up to the MQTT thread
+)
+DROP = "drop"  # Drop the task
+COALESCE = "coalesce"  # Replace the pending task with the same coalescing key, or drop
+
+OVERFLOW_POLICIES = (BLOCK, DROP, COALESCE)
+
+# What happened to a task put in the queue
+QUEUED = "queued"
+COALESCED = "coalesced"
+DROPPED = "dropped"
+
+# Classes of tasks that are never dropped, whatever the configuration
+NEVER_DROPPED_MESSAGE_CLASSES = ("user_entered_space", "user_left_space")
+
+WORKER_TASKS_ENQUEUED = REGISTRY.counter(
+    "aggregator_worker_tasks_enqueued_total", "Tasks added to the worker input queue"
+)
+WORKER_TASKS_DROPPED = REGISTRY.counter(
+    "aggregator_worker_tasks_dropped_total",
+    "Tasks dropped because the worker input queue was full",
+    ("message_class",),
+)
+WORKER_TASKS_COALESCED = REGISTRY.counter(
+    "aggregator_worker_tasks_coalesced_total",
+    "Tasks replacing a pending one because the worker input queue was full",
+    ("message_class",),
+)
+WORKER_QUEUE_DEPTH = REGISTRY.gauge(
+    "aggregator_worker_queue_depth", "Tasks in the worker input queue, not started yet"
+)
+WORKER_QUEUE_WAIT = REGISTRY.histogram(
+    "aggregator_worker_queue_wait_seconds",
+    "Time spent by the tasks in the worker input queue before being started",
+)
+
+
+class WorkerQueueFull(Exception):
+    pass
+
+
+class PartitionedTaskQueue(object):
+    """
+    A task queue for a pool of workers, where every task belongs to a partition.
+
+    Tasks of the same partition are handed out one at a time, in order: the next one only
+    after the previous one is done. Tasks of different partitions can run in parallel.
+
+    The queue is full with max_size tasks pending, or max_pending_per_partition in the
+    partition of the task. What put() does then depends on the overflow policy of the task.
+    """
 
-    def send_message(self, **kwargs):
+    def __init__(self, max_pending_per_partition=0, max_size=0):
+        self.max_pending_per_partition = max_pending_per_partition
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        # Partition key -> pending entries, each a list [item, coalescing key, partition key]
+        self.pending = {}
+        self.size = 0
+        # Coalescing key -> its pending entry
+        self.coalescible = {}
+        self.ready_partitions = deque()
+        self.running_partitions = set()
+
+    def put(
+        self,
+        item,
+        partition_key=DEFAULT_PARTITION,
+        overflow_policy=BLOCK,
+        coalescing_key=None,
+    ):
         """
-        Send a message to the asyncio-based http server from an external thread.
+        Returns QUEUED, or COALESCED or DROPPED when the queue was full.
         """
-        coro = self.msg_queue.put(kwargs)
-        asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop)
+        with self.condition:
+            while self._is_full(partition_key):
+                if overflow_policy == COALESCE and coalescing_key in self.coalescible:
+                    self._coalesce(item, coalescing_key)
+                    return COALESCED
+                if overflow_policy != BLOCK:
+                    return DROPPED
+                self.condition.wait()
+            entry = [item, coalescing_key, partition_key]
+            pending = self.pending.setdefault(partition_key, deque())
+            pending.append(entry)
+            self.size += 1
+            if coalescing_key is not None:
+                self.coalescible[coalescing_key] = entry
+            if len(pending) == 1 and partition_key not in self.running_partitions:
+                self.ready_partitions.append(partition_key)
+                self.condition.notify_all()
+            return QUEUED
+
+    def _coalesce(self, item, coalescing_key):
+        # The pending task is outdated by this one, which goes at the end of the partition
+        # instead: after the tasks queued meanwhile, so that they don't run after it
+        entry = self.coalescible[coalescing_key]
+        pending = self.pending[entry[2]]
+        for index, pending_entry in enumerate(pending):
+            if pending_entry is entry:
+                del pending[index]
+                break
+        entry = [item, coalescing_key, entry[2]]
+        pending.append(entry)
+        self.coalescible[coalescing_key] = entry
+
+    def _is_full(self, partition_key):
+        if self.max_size and self.size >= self.max_size:
+            return True
+        return bool(
+            self.max_pending_per_partition
+            and len(self.pending.get(partition_key, ()))
+            >= self.max_pending_per_partition
+        )
 
-    async def get_next_message(self):
+    def get(self):
         """
-        Fetch the next message from the queue. Wait until a message is available.
-        To be called only from the main asyncio-based thread.
+        Returns the partition key and the next item, which must be followed by task_done().
         """
-        return await self.msg_queue.get()
+        with self.condition:
+            while not self.ready_partitions:
+                self.condition.wait()
+            partition_key = self.ready_partitions.popleft()
+            entry = self.pending[partition_key].popleft()
+            self.size -= 1
+            item, coalescing_key, _ = entry
+            if self.coalescible.get(coalescing_key) is entry:
+                del self.coalescible[coalescing_key]
+            self.running_partitions.add(partition_key)
+            self.condition.notify_all()
+            return partition_key, item
+
+    def task_done(self, partition_key):
+        with self.condition:
+            self.running_partitions.discard(partition_key)
+            if self.pending[partition_key]:
+                self.ready_partitions.append(partition_key)
+            else:
+                del self.pending[partition_key]
+            self.condition.notify_all()
+
+    def join(self):
+        # Wait until every task put so far is done
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def qsize(self):
+        with self.condition:
+            return self.size
 
 
 class WorkerInputQueue(object):
-    def __init__(self, asyncio_loop):
-        self.queue = Queue()
+    """
+    The tasks for the worker, from the MQTT thread, the HTTP server and the timed tasks.
+
+    The overflow policy of a task, used when the queue is full, comes from its message
+    class: the type of the MQTT message it processes. Tasks without a message class, or
+    of a class without a policy, block. Callers on the asyncio loop can't block it: their
+    tasks are dropped instead, and the futures of their results fail with WorkerQueueFull.
+    """
+
+    def __init__(
+        self,
+        asyncio_loop,
+        max_pending_per_partition=0,
+        max_size=0,
+        overflow_policies=None,
+    ):
+        self.overflow_policies = overflow_policies or {}
+        for message_class, overflow_policy in self.overflow_policies.items():
+            if overflow_policy not in OVERFLOW_POLICIES:
+                raise ValueError(f"Unknown overflow policy {overflow_policy}")
+            if (
+                message_class in NEVER_DROPPED_MESSAGE_CLASSES
+                and overflow_policy != BLOCK
+            ):
+                raise ValueError(f"Tasks of class {message_class} can't be dropped")
+        self.queue = PartitionedTaskQueue(max_pending_per_partition, max_size)
         self.asyncio_loop = asyncio_loop
+        self.stats = {COALESCED: 0, DROPPED: 0}
 
-    def add_task_with_result_future(self, task, logger):
+    def add_task_with_result_future(
+        self, task, logger, partition_key=DEFAULT_PARTITION
+    ):
         # logger = logger.getLogger(subsystem='worker_q')
         fut = asyncio.Future()
 
@@ -43,23 +213,59 @@ class WorkerInputQueue(object):
             asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop)
 
         # logger.info('put in queue')
-        self.queue.put((task, respond, logger))
+        if self._put(task, respond, logger, partition_key, DROP) == DROPPED:
+            fut.set_exception(WorkerQueueFull())
         return fut
 
-    def add_task_with_result_blocking(self, task, logger):
+    def add_task_with_result_blocking(
+        self, task, logger, partition_key=DEFAULT_PARTITION
+    ):
         response_queue = Queue()
 
         def respond(error, value):
             response_queue.put((error, value))
 
-        self.queue.put((task, respond, logger))
+        self._put(task, respond, logger, partition_key)
         error, result = response_queue.get()
         if error:
             raise error
         else:
             return result
 
-    def add_task(self, task, logger):
+    def add_task(
+        self,
+        task,
+        logger,
+        partition_key=DEFAULT_PARTITION,
+        message_class=None,
+        coalescing_key=None,
+    ):
+        """
+        Returns QUEUED, or COALESCED or DROPPED when the queue was full.
+        """
+        return self._put(
+            task,
+            self._make_logging_respond(logger),
+            logger,
+            partition_key,
+            self.overflow_policies.get(message_class, BLOCK),
+            coalescing_key,
+            message_class,
+        )
+
+    def add_task_without_blocking(self, task, logger, partition_key=DEFAULT_PARTITION):
+        """
+        For the callers running on the asyncio loop, like the timed tasks, which must not
+        wait for room: when the queue is full the task is dropped.
+        """
+        outcome = self._put(
+            task, self._make_logging_respond(logger), logger, partition_key, DROP
+        )
+        if outcome == DROPPED:
+            logger.error("Worker input queue full, task dropped")
+        return outcome
+
+    def _make_logging_respond(self, logger):
         def respond(error, value):
             if error:
                 logger.error("Error executing task", exc_info=error)
@@ -68,7 +274,89 @@ class WorkerInputQueue(object):
                     f"Task returned result but it's going to be discarded: {value}"
                 )
 
-        self.queue.put((task, respond, logger))
+        return respond
+
+    def _put(
+        self,
+        task,
+        respond,
+        logger,
+        partition_key,
+        overflow_policy=BLOCK,
+        coalescing_key=None,
+        message_class=None,
+    ):
+        WORKER_QUEUE_DEPTH.inc()
+        outcome = self.queue.put(
+            (task, respond, logger, time.perf_counter()),
+            partition_key,
+            overflow_policy,
+            coalescing_key,
+        )
+        if outcome == QUEUED:
+            WORKER_TASKS_ENQUEUED.inc()
+            return outcome
+        WORKER_QUEUE_DEPTH.dec()
+        self.stats[outcome] += 1
+        if outcome == COALESCED:
+            WORKER_TASKS_COALESCED.inc(message_class or "other")
+        else:
+            WORKER_TASKS_DROPPED.inc(message_class or "other")
+        return outcome
 
     def get_next_task_blocking(self):
-        return self.queue.get()
+        """
+        Returns the partition key and the task, to be passed to task_done() when finished.
+        """
+        partition_key, (task, respond, logger, enqueued_at) = self.queue.get()
+        WORKER_QUEUE_DEPTH.dec()
+        WORKER_QUEUE_WAIT.observe(time.perf_counter() - enqueued_at)
+        return partition_key, (task, respond, logger)
+
+    def task_done(self, partition_key):
+        self.queue.task_done(partition_key)
+
+    def wait_until_empty(self):
+        self.queue.join()
+
+    def get_stats(self):
+        return dict(self.stats, pending=self.queue.qsize())
+
+
+class ReaderPool(object):
+    """
+    Runs read-only tasks on a pool of threads, so that they are served concurrently instead
+    of waiting behind the MQTT processing queued for the worker. Tasks that change the state
+    must go through the WorkerInputQueue, which keeps them in order.
+    """
+
+    def __init__(self, asyncio_loop, pool_size=4, num_latency_samples=1000):
+        self.asyncio_loop = asyncio_loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="reader"
+        )
+        self.latencies = deque(maxlen=num_latency_samples)
+        self.num_reads = 0
+
+    async def run(self, task, logger):
+        """
+        To be called only from the main asyncio-based thread.
+        """
+        start = time.perf_counter()
+        try:
+            return await self.asyncio_loop.run_in_executor(self.executor, task, logger)
+        finally:
+            self.num_reads += 1
+            self.latencies.append(time.perf_counter() - start)
+
+    def stop(self):
+        self.executor.shutdown()
+
+    def get_stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "reads": self.num_reads,
+            "latency_p50_in_sec": percentile(latencies, 0.5),
+            "latency_p95_in_sec": percentile(latencies, 0.95),
+            "latency_p99_in_sec": percentile(latencies, 0.99),
+        }
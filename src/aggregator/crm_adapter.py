@@ -1,12 +1,64 @@
+import asyncio
 import json
+import threading
+import time
 from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
 
-import requests
-from requests.auth import HTTPBasicAuth
-from requests.exceptions import ConnectionError, RequestException, Timeout
+import httpx
 
 
-class CrmAdapter(object):
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures, so that calls are short-circuited
+    while the remote service is down. After reset_timeout_in_sec a single trial call is let
+    through: if it succeeds the circuit closes again, otherwise it stays open.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, failure_threshold, reset_timeout_in_sec, time_function=time.monotonic
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_in_sec = reset_timeout_in_sec
+        self.time_function = time_function
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if (
+                self.state == self.OPEN
+                and self.time_function() - self.opened_at >= self.reset_timeout_in_sec
+            ):
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = self.time_function()
+
+
+class AsyncCrmAdapter(object):
     def __init__(
         self,
         base_url: str = "https://mijn.makerspaceleiden.nl/api/v1",
@@ -17,9 +69,15 @@ class CrmAdapter(object):
         timeout: int = 30,
         verify_ssl: bool = True,
         headers: Optional[Dict[str, str]] = None,
+        max_connections: int = 10,
+        max_concurrent_requests_per_host: int = 4,
+        http2: bool = True,
+        circuit_breaker_failure_threshold: int = 5,
+        circuit_breaker_reset_timeout_in_sec: int = 30,
+        time_function=time.monotonic,
     ):
         """
-        Initialize HTTP REST adapter for MakerSpace Leiden API.
+        Initialize non-blocking HTTP REST adapter for MakerSpace Leiden API.
 
         Args:
             base_url: Base URL for the REST API
@@ -27,33 +85,56 @@ class CrmAdapter(object):
             api_token: API token for token-based auth
             username: Username for basic auth
             password: Password for basic auth
-            timeout: Request timeout in seconds
+            timeout: Deadline for a whole request in seconds
             verify_ssl: Whether to verify SSL certificates
             headers: Additional headers to include in requests
+            max_connections: Size of the pool of keep-alive connections
+            max_concurrent_requests_per_host: Requests in flight to the same host
+            http2: Whether to use HTTP/2 when the server supports it
+            circuit_breaker_failure_threshold: Consecutive failures before short-circuiting calls
+            circuit_breaker_reset_timeout_in_sec: Time before trying again after the circuit opened
         """
         self.base_url = base_url.rstrip("/")
         self.timeout = timeout
-        self.verify_ssl = verify_ssl
-
-        # Setup session with authentication
-        self.session = requests.Session()
+        self.max_concurrent_requests_per_host = max_concurrent_requests_per_host
 
         # Set up authentication
+        all_headers = {}
+        auth = None
         if auth_type == "token" and api_token:
-            self.session.headers.update({"Authorization": f"Api-Key {api_token}"})
+            all_headers["Authorization"] = f"Api-Key {api_token}"
         elif auth_type == "basic" and username and password:
-            self.session.auth = HTTPBasicAuth(username, password)
+            auth = httpx.BasicAuth(username, password)
         else:
             raise ValueError("Invalid authentication configuration")
 
         # Set default headers
-        self.session.headers.update(
+        all_headers.update(
             {"Accept": "application/json", "Content-Type": "application/json"}
         )
 
         # Add custom headers if provided
         if headers:
-            self.session.headers.update(headers)
+            all_headers.update(headers)
+
+        self.client = httpx.AsyncClient(
+            auth=auth,
+            headers=all_headers,
+            timeout=timeout,
+            verify=verify_ssl,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self.circuit_breaker = CircuitBreaker(
+            circuit_breaker_failure_threshold,
+            circuit_breaker_reset_timeout_in_sec,
+            time_function,
+        )
+        # Created lazily, to bind them to the event loop running the requests
+        self.semaphores_by_host = {}
 
         # Available endpoints
         self.endpoints = {
@@ -62,46 +143,44 @@ class CrmAdapter(object):
             "member_checkins": f"{self.base_url}/members/?format=json",
         }
 
-    def _make_request(
+    def _get_semaphore(self, url):
+        host = urlsplit(url).netloc
+        semaphore = self.semaphores_by_host.get(host)
+        if semaphore is None:
+            semaphore = self.semaphores_by_host[host] = asyncio.Semaphore(
+                self.max_concurrent_requests_per_host
+            )
+        return semaphore
+
+    async def _send(self, method, url, data, params):
+        async with self._get_semaphore(url):
+            return await self.client.request(
+                method,
+                url,
+                json=data if method not in ("GET", "DELETE") else None,
+                params=params,
+            )
+
+    async def make_request(
         self, method: str, url: str, data: Any = None, params: Dict = None, logger=None
     ) -> Optional[Dict]:
         """Make HTTP request with error handling."""
+        if not self.circuit_breaker.allow_request():
+            if logger:
+                logger.error(f"CRM unavailable, not sending {method} {url}")
+            return None
+        outcome_recorded = False
         try:
-            if method.upper() == "GET":
-                response = self.session.get(
-                    url, params=params, timeout=self.timeout, verify=self.verify_ssl
-                )
-            elif method.upper() == "POST":
-                response = self.session.post(
-                    url,
-                    json=data,
-                    params=params,
-                    timeout=self.timeout,
-                    verify=self.verify_ssl,
-                )
-            elif method.upper() == "PUT":
-                response = self.session.put(
-                    url,
-                    json=data,
-                    params=params,
-                    timeout=self.timeout,
-                    verify=self.verify_ssl,
-                )
-            elif method.upper() == "PATCH":
-                response = self.session.patch(
-                    url,
-                    json=data,
-                    params=params,
-                    timeout=self.timeout,
-                    verify=self.verify_ssl,
-                )
-            elif method.upper() == "DELETE":
-                response = self.session.delete(
-                    url, params=params, timeout=self.timeout, verify=self.verify_ssl
-                )
+            # The deadline includes the time waiting for a free slot
+            response = await asyncio.wait_for(
+                self._send(method.upper(), url, data, params), self.timeout
+            )
+            if response.status_code >= 500:
+                self.circuit_breaker.record_failure()
             else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-
+                # Client errors mean that the CRM is up
+                self.circuit_breaker.record_success()
+            outcome_recorded = True
             response.raise_for_status()
 
             # Handle empty responses
@@ -110,15 +189,15 @@ class CrmAdapter(object):
 
             return [response.status_code, response.json()]
 
-        except Timeout:
+        except (asyncio.TimeoutError, httpx.TimeoutException):
             if logger:
                 logger.error(f"Request timeout for {method} {url}")
             return None
-        except ConnectionError:
+        except httpx.TransportError:
             if logger:
                 logger.error(f"Connection error for {method} {url}")
             return None
-        except RequestException as e:
+        except httpx.HTTPError as e:
             if logger:
                 logger.error(f"Request failed for {method} {url}: {str(e)}")
             return None
@@ -126,37 +205,84 @@ class CrmAdapter(object):
             if logger:
                 logger.error(f"Invalid JSON response from {method} {url}")
             return None
+        finally:
+            if not outcome_recorded:
+                # No response, whatever the reason, even a cancellation: a trial call must
+                # not leave the circuit half open, short-circuiting every call after it
+                self.circuit_breaker.record_failure()
 
-    def user_checkin(self, user_id, logger):
+    async def user_checkin(self, user_id, logger):
         logger = logger.getLogger(subsystem="crm")
         logger.info(f"Checking in user {user_id}")
 
-        data = self._make_request(
+        data = await self.make_request(
             "POST",
             self.base_url + f"/members/{user_id}/checkin/",
             data={},
             logger=logger,
         )
-        if data:
+        # Empty responses (e.g. 204) are returned as {}, errors as None
+        if data is not None:
             logger.info(f"Successfully checked in user {user_id}")
             return True
         else:
             logger.error(f"Failed to check in user {user_id}")
             return False
 
-    def user_checkout(self, user_id, logger):
+    async def user_checkout(self, user_id, logger):
         logger = logger.getLogger(subsystem="crm")
         logger.info(f"Checking out user {user_id}")
 
-        data = self._make_request(
+        data = await self.make_request(
             "POST",
             self.base_url + f"/members/{user_id}/checkout/",
             data={},
             logger=logger,
         )
-        if data:
+        # Empty responses (e.g. 204) are returned as {}, errors as None
+        if data is not None:
             logger.info(f"Successfully checked out user {user_id}")
             return True
         else:
             logger.error(f"Failed to check out user {user_id}")
             return False
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class CrmAdapter(object):
+    """
+    Blocking API over AsyncCrmAdapter, for the worker threads.
+    The requests run on an event loop in a dedicated thread, which owns the connection pool.
+    """
+
+    def __init__(self, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.async_adapter = AsyncCrmAdapter(**kwargs)
+        self.base_url = self.async_adapter.base_url
+        self.endpoints = self.async_adapter.endpoints
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _make_request(
+        self, method: str, url: str, data: Any = None, params: Dict = None, logger=None
+    ) -> Optional[Dict]:
+        return self._run(
+            self.async_adapter.make_request(method, url, data, params, logger)
+        )
+
+    def user_checkin(self, user_id, logger):
+        return self._run(self.async_adapter.user_checkin(user_id, logger))
+
+    def user_checkout(self, user_id, logger):
+        return self._run(self.async_adapter.user_checkout(user_id, logger))
+
+    def close(self):
+        self._run(self.async_adapter.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+from .crm_adapter import AsyncCrmAdapter, CircuitBreaker, CrmAdapter
+from .logging import configure_logging_for_tests
+
+
+class StubCrmServer(object):
+    """
+    Local HTTP server answering every request with the configured status, body and delay.
+    """
+
+    def __init__(self):
+        self.status = 200
+        self.body = {"ok": True}
+        self.delay = 0
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                with stub.lock:
+                    stub.requests.append((self.path, dict(self.headers)))
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(stub.delay)
+                body = json.dumps(stub.body).encode("utf-8") if stub.body else b""
+                self.send_response(stub.status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with stub.lock:
+                    stub.in_flight -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/api/v1"
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MockTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_consecutive_failures_and_retries_after_timeout(self):
+        mock_time = MockTime()
+        circuit_breaker = CircuitBreaker(2, 30, mock_time)
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow_request())
+
+        mock_time.now += 30
+        self.assertTrue(circuit_breaker.allow_request())
+        # Only one trial call at a time
+        self.assertFalse(circuit_breaker.allow_request())
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow_request())
+
+        mock_time.now += 30
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_success()
+        self.assertTrue(circuit_breaker.allow_request())
+
+
+class TestAsyncCrmAdapter(unittest.TestCase):
+    def setUp(self):
+        self.logger = configure_logging_for_tests()
+        self.stub = StubCrmServer()
+        self.time = MockTime()
+        self.loop = asyncio.new_event_loop()
+        self.crm_adapter = AsyncCrmAdapter(
+            base_url=self.stub.base_url,
+            api_token="secret",
+            timeout=1,
+            max_concurrent_requests_per_host=2,
+            circuit_breaker_failure_threshold=2,
+            circuit_breaker_reset_timeout_in_sec=30,
+            time_function=self.time,
+        )
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.crm_adapter.close())
+        self.loop.close()
+        self.stub.stop()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_checkin_and_checkout(self):
+        self.assertTrue(self.run_async(self.crm_adapter.user_checkin(22, self.logger)))
+        self.assertTrue(self.run_async(self.crm_adapter.user_checkout(22, self.logger)))
+        paths = [path for path, _ in self.stub.requests]
+        self.assertEqual(
+            paths, ["/api/v1/members/22/checkin/", "/api/v1/members/22/checkout/"]
+        )
+        self.assertEqual(self.stub.requests[0][1]["Authorization"], "Api-Key secret")
+
+    def test_empty_response_is_a_success(self):
+        self.stub.status = 204
+        self.stub.body = None
+        self.assertTrue(self.run_async(self.crm_adapter.user_checkin(22, self.logger)))
+
+    def test_client_errors_do_not_open_the_circuit(self):
+        self.stub.status = 404
+        for _ in range(3):
+            self.assertFalse(
+                self.run_async(self.crm_adapter.user_checkin(22, self.logger))
+            )
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_circuit_opens_while_the_crm_is_down(self):
+        self.stub.status = 503
+        for _ in range(4):
+            self.assertFalse(
+                self.run_async(self.crm_adapter.user_checkin(22, self.logger))
+            )
+        self.assertEqual(len(self.stub.requests), 2)
+
+        self.stub.status = 200
+        self.time.now += 30
+        self.assertTrue(self.run_async(self.crm_adapter.user_checkin(22, self.logger)))
+        self.assertTrue(self.run_async(self.crm_adapter.user_checkin(22, self.logger)))
+        self.assertEqual(len(self.stub.requests), 4)
+
+    def test_trial_call_without_response_reopens_the_circuit(self):
+        self.stub.status = 503
+        for _ in range(2):
+            self.run_async(self.crm_adapter.user_checkin(22, self.logger))
+        send = self.crm_adapter._send
+
+        async def send_failing(*args):
+            raise self.error
+
+        self.crm_adapter._send = send_failing
+        self.error = httpx.TooManyRedirects("Redirect loop")
+        self.time.now += 30
+        self.assertFalse(self.run_async(self.crm_adapter.user_checkin(22, self.logger)))
+        self.assertFalse(self.crm_adapter.circuit_breaker.allow_request())
+
+        self.error = asyncio.CancelledError()
+        self.time.now += 30
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_async(self.crm_adapter.user_checkin(22, self.logger))
+        self.assertFalse(self.crm_adapter.circuit_breaker.allow_request())
+
+        self.crm_adapter._send = send
+        self.stub.status = 200
+        self.time.now += 30
+        self.assertTrue(self.run_async(self.crm_adapter.user_checkin(22, self.logger)))
+
+    def test_deadline(self):
+        self.stub.delay = 2
+        start = time.monotonic()
+        self.assertFalse(self.run_async(self.crm_adapter.user_checkin(22, self.logger)))
+        self.assertLess(time.monotonic() - start, 1.9)
+
+    def test_concurrency_per_host_is_limited(self):
+        self.stub.delay = 0.05
+
+        async def check_in_everyone():
+            return await asyncio.gather(
+                *[self.crm_adapter.user_checkin(i, self.logger) for i in range(6)]
+            )
+
+        self.assertEqual(self.run_async(check_in_everyone()), [True] * 6)
+        self.assertEqual(self.stub.max_in_flight, 2)
+
+
+class TestCrmAdapter(unittest.TestCase):
+    def test_blocking_api(self):
+        logger = configure_logging_for_tests()
+        stub = StubCrmServer()
+        crm_adapter = CrmAdapter(base_url=stub.base_url, api_token="secret", timeout=1)
+        try:
+            self.assertTrue(crm_adapter.user_checkin(22, logger))
+            stub.status = 500
+            self.assertFalse(crm_adapter.user_checkout(22, logger))
+        finally:
+            crm_adapter.close()
+            stub.stop()
@@ -0,0 +1,154 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CHECKIN = "checkin"
+CHECKOUT = "checkout"
+
+
+class CrmOutbox(object):
+    """
+    Records CRM check-ins and check-outs in Redis, and sends them from a background thread.
+
+    It has the same user_checkin/user_checkout methods as CrmAdapter, which only enqueue,
+    so a slow or unreachable CRM does not hold up the worker.
+
+    Only the latest operation of a user is kept: a check-in followed by a check-out that were
+    not sent yet are coalesced into the check-out. Failed operations are retried with
+    exponential backoff, and dropped after max_attempts.
+    """
+
+    def __init__(
+        self,
+        redis_adapter,
+        crm_adapter,
+        concurrency=2,
+        poll_interval_in_sec=5,
+        initial_backoff_in_sec=5,
+        max_backoff_in_sec=3600,
+        max_attempts=20,
+        time_function=time.time,
+    ):
+        self.redis_adapter = redis_adapter
+        self.crm_adapter = crm_adapter
+        self.concurrency = concurrency
+        self.poll_interval_in_sec = poll_interval_in_sec
+        self.initial_backoff_in_sec = initial_backoff_in_sec
+        self.max_backoff_in_sec = max_backoff_in_sec
+        self.max_attempts = max_attempts
+        self.time_function = time_function
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="crm_outbox"
+        )
+        self.wake_up = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+        }
+
+    def user_checkin(self, user_id, logger):
+        self._enqueue(user_id, CHECKIN, logger)
+
+    def user_checkout(self, user_id, logger):
+        self._enqueue(user_id, CHECKOUT, logger)
+
+    def _enqueue(self, user_id, operation, logger):
+        logger = logger.getLogger(subsystem="crm_outbox")
+        replaced = self.redis_adapter.enqueue_crm_operation(
+            user_id, operation, self.time_function(), logger
+        )
+        self._count("enqueued")
+        if replaced:
+            logger.info(
+                f"CRM {operation} of user ID {user_id} replaces the pending {replaced.operation}"
+            )
+            self._count("coalesced")
+        self.wake_up.set()
+
+    # -- Sending ----
+
+    def start_sending_in_background_thread(self, logger):
+        logger = logger.getLogger(subsystem="crm_outbox")
+        self.thread = threading.Thread(target=self._main, args=(logger,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake_up.set()
+        if self.thread:
+            self.thread.join()
+        self.executor.shutdown()
+
+    def _main(self, logger):
+        while not self.stopped.is_set():
+            try:
+                num_sent = self.send_due_operations(logger)
+            except Exception:
+                logger.exception("Cannot send CRM operations")
+                num_sent = 0
+            if num_sent < self.concurrency:
+                self.wake_up.wait(self.poll_interval_in_sec)
+                self.wake_up.clear()
+
+    def send_due_operations(self, logger):
+        """
+        Sends up to `concurrency` due operations in parallel, and returns how many were due.
+        """
+        crm_operations = self.redis_adapter.get_due_crm_operations(
+            self.time_function(), self.concurrency, logger
+        )
+        list(
+            self.executor.map(
+                lambda crm_operation: self._send(crm_operation, logger), crm_operations
+            )
+        )
+        return len(crm_operations)
+
+    def _send(self, crm_operation, logger):
+        logger = logger.getLoggerWithRandomReqId("crm_outbox")
+        try:
+            if crm_operation.operation == CHECKIN:
+                ok = self.crm_adapter.user_checkin(crm_operation.user_id, logger)
+            else:
+                ok = self.crm_adapter.user_checkout(crm_operation.user_id, logger)
+        except Exception:
+            logger.exception(
+                f"Cannot send CRM {crm_operation.operation} of user ID {crm_operation.user_id}"
+            )
+            ok = False
+        if ok:
+            self._count("sent")
+            self.redis_adapter.complete_crm_operation(crm_operation, logger)
+            return
+        self._count("failed")
+        attempts = crm_operation.attempts + 1
+        if attempts >= self.max_attempts:
+            logger.error(
+                f"Dropping CRM {crm_operation.operation} of user ID {crm_operation.user_id} after {attempts} attempts"
+            )
+            self._count("dropped")
+            self.redis_adapter.complete_crm_operation(crm_operation, logger)
+            return
+        backoff = min(
+            self.initial_backoff_in_sec * 2 ** (attempts - 1), self.max_backoff_in_sec
+        )
+        self.redis_adapter.reschedule_crm_operation(
+            crm_operation, self.time_function() + backoff, logger
+        )
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def get_stats(self, logger):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["pending"] = self.redis_adapter.get_num_pending_crm_operations(logger)
+        return stats
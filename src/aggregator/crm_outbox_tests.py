@@ -0,0 +1,121 @@
+from .crm_outbox import CHECKIN, CHECKOUT, CrmOutbox
+from .testing_utils import BOB, STEFANO, AggregatorBaseTestSuite
+
+
+class MockTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingCrmAdapter(object):
+    def __init__(self):
+        self.calls = []
+        self.failing = False
+
+    def user_checkin(self, user_id, logger):
+        self.calls.append((CHECKIN, user_id))
+        return not self.failing
+
+    def user_checkout(self, user_id, logger):
+        self.calls.append((CHECKOUT, user_id))
+        if self.failing:
+            raise ConnectionError("CRM unreachable")
+        return True
+
+
+class TestCrmOutbox(AggregatorBaseTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.time = MockTime()
+        self.crm = RecordingCrmAdapter()
+        self.outbox = CrmOutbox(
+            self.redis_adapter,
+            self.crm,
+            concurrency=2,
+            initial_backoff_in_sec=5,
+            max_backoff_in_sec=20,
+            max_attempts=4,
+            time_function=self.time,
+        )
+        self.aggregator.crm_adapter = self.outbox
+
+    def tearDown(self):
+        self.outbox.stop()
+        super().tearDown()
+
+    def test_entering_the_space_only_enqueues(self):
+        self.aggregator.user_entered_space(STEFANO.user_id, self.logger)
+        self.assertEqual(self.crm.calls, [])
+        self.assertEqual(self.outbox.get_stats(self.logger)["pending"], 1)
+
+        self.assertEqual(self.outbox.send_due_operations(self.logger), 1)
+        self.assertEqual(self.crm.calls, [(CHECKIN, STEFANO.user_id)])
+        self.assertEqual(self.outbox.get_stats(self.logger)["pending"], 0)
+
+    def test_pending_operations_of_a_user_are_coalesced(self):
+        self.outbox.user_checkin(STEFANO.user_id, self.logger)
+        self.outbox.user_checkin(BOB.user_id, self.logger)
+        self.outbox.user_checkout(STEFANO.user_id, self.logger)
+
+        self.outbox.send_due_operations(self.logger)
+        self.assertEqual(
+            sorted(self.crm.calls),
+            [(CHECKIN, BOB.user_id), (CHECKOUT, STEFANO.user_id)],
+        )
+        self.assertEqual(self.outbox.get_stats(self.logger)["coalesced"], 1)
+
+    def test_failed_operations_are_retried_with_backoff(self):
+        self.crm.failing = True
+        self.outbox.user_checkin(STEFANO.user_id, self.logger)
+
+        self.assertEqual(self.outbox.send_due_operations(self.logger), 1)
+        self.time.now += 4
+        self.assertEqual(self.outbox.send_due_operations(self.logger), 0)
+        self.time.now += 1
+        self.assertEqual(self.outbox.send_due_operations(self.logger), 1)
+        self.time.now += 9
+        self.assertEqual(self.outbox.send_due_operations(self.logger), 0)
+
+        self.crm.failing = False
+        self.time.now += 1
+        self.assertEqual(self.outbox.send_due_operations(self.logger), 1)
+        self.assertEqual(self.crm.calls, [(CHECKIN, STEFANO.user_id)] * 3)
+        self.assertEqual(self.outbox.get_stats(self.logger)["pending"], 0)
+
+    def test_operations_are_dropped_after_max_attempts(self):
+        self.crm.failing = True
+        self.outbox.user_checkout(STEFANO.user_id, self.logger)
+        for _ in range(4):
+            self.outbox.send_due_operations(self.logger)
+            self.time.now += 20
+
+        stats = self.outbox.get_stats(self.logger)
+        self.assertEqual(stats["dropped"], 1)
+        self.assertEqual(stats["pending"], 0)
+
+    def test_an_operation_replaced_while_sending_stays_pending(self):
+        self.outbox.user_checkin(STEFANO.user_id, self.logger)
+        (crm_operation,) = self.redis_adapter.get_due_crm_operations(
+            self.time(), 10, self.logger
+        )
+        self.outbox.user_checkout(STEFANO.user_id, self.logger)
+
+        self.assertFalse(
+            self.redis_adapter.complete_crm_operation(crm_operation, self.logger)
+        )
+        (crm_operation,) = self.redis_adapter.get_due_crm_operations(
+            self.time(), 10, self.logger
+        )
+        self.assertEqual(crm_operation.operation, CHECKOUT)
+
+    def test_background_sender(self):
+        self.outbox.start_sending_in_background_thread(self.logger)
+        self.outbox.user_checkin(STEFANO.user_id, self.logger)
+        for _ in range(100):
+            if self.crm.calls:
+                break
+            self.outbox.stopped.wait(0.01)
+        self.assertEqual(self.crm.calls, [(CHECKIN, STEFANO.user_id)])
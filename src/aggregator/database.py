@@ -1,55 +1,264 @@
+import queue
+import threading
+import time
 from contextlib import contextmanager
 
 import mysql.connector
 
 from aggregator.model import Machine, Tag, User
 
+QUERY_ALL_USERS = "SELECT id, first_name, last_name, email, phone_number, always_uses_email FROM members_user"
+
+QUERY_ALL_MACHINES = """
+    SELECT acl_machine.id, acl_machine.name, acl_machine.description, node_machine_name, node_name, acl_location.name
+    FROM acl_machine
+    LEFT JOIN acl_location ON (acl_machine.location_id = acl_location.id)
+    WHERE node_machine_name IS NOT NULL
+      AND node_machine_name <> ''
+"""
+
+# Per-row checksums, to detect which rows changed since the last sync
+USER_CHECKSUM = "MD5(CONCAT_WS('|', QUOTE(first_name), QUOTE(last_name), QUOTE(email), QUOTE(phone_number), QUOTE(always_uses_email)))"
+
+MACHINE_CHECKSUM = "MD5(CONCAT_WS('|', acl_machine.id, QUOTE(acl_machine.name), QUOTE(acl_machine.description), QUOTE(node_name), QUOTE(acl_location.name)))"
+
+QUERY_USERS_CHECKSUMS = f"SELECT id, {USER_CHECKSUM} FROM members_user"
+
+QUERY_USERS_BY_IDS = f"SELECT id, first_name, last_name, email, phone_number, always_uses_email, {USER_CHECKSUM} FROM members_user WHERE id IN ({{0}})"
+
+QUERY_MACHINES_CHECKSUMS = f"""
+    SELECT node_machine_name, {MACHINE_CHECKSUM}
+    FROM acl_machine
+    LEFT JOIN acl_location ON (acl_machine.location_id = acl_location.id)
+    WHERE node_machine_name IS NOT NULL
+      AND node_machine_name <> ''
+"""
+
+QUERY_MACHINES_BY_NAMES = f"""
+    SELECT acl_machine.id, acl_machine.name, acl_machine.description, node_machine_name, node_name, acl_location.name, {MACHINE_CHECKSUM}
+    FROM acl_machine
+    LEFT JOIN acl_location ON (acl_machine.location_id = acl_location.id)
+    WHERE node_machine_name IN ({{0}})
+"""
+
+QUERY_ALL_TAGS = """
+    SELECT members_tag.id AS tag_id, members_tag.tag, members_user.id AS user_id, first_name, last_name, email, phone_number, always_uses_email
+    FROM members_tag LEFT JOIN members_user ON (members_tag.owner_id = members_user.id)
+"""
+
+# Covers the owner too, as a tag is served with its owner
+TAG_CHECKSUM = (
+    f"MD5(CONCAT_WS('|', QUOTE(members_tag.tag), members_user.id, {USER_CHECKSUM}))"
+)
+
+QUERY_TAGS_CHECKSUMS = f"""
+    SELECT members_tag.id, {TAG_CHECKSUM}
+    FROM members_tag LEFT JOIN members_user ON (members_tag.owner_id = members_user.id)
+"""
+
+QUERY_TAGS_BY_IDS = f"""
+    SELECT members_tag.id AS tag_id, members_tag.tag, members_user.id AS user_id, first_name, last_name, email, phone_number, always_uses_email, {TAG_CHECKSUM}
+    FROM members_tag LEFT JOIN members_user ON (members_tag.owner_id = members_user.id)
+    WHERE members_tag.id IN ({{0}})
+"""
+
 
 class MySQLAdapter(object):
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+    def __init__(
+        self,
+        pool_size=None,
+        pool_recycle_in_sec=3600,
+        pool_health_check_after_idle_in_sec=30,
+        **connection_params,
+    ):
+        """
+        Without a pool_size, a new connection is opened for every query.
+        With a pool_size, up to that many connections are kept open and reused,
+        and the fixed queries run as server-side prepared statements.
+        """
+        self.connection_params = connection_params
+        if pool_size:
+            # Without autocommit, the first read would open a transaction never ended:
+            # the later reads on the connection would all see the data as it was then
+            pooled_connection_params = dict(connection_params, autocommit=True)
+            self.pool = MySQLConnectionPool(
+                lambda: mysql.connector.connect(**pooled_connection_params),
+                pool_size,
+                pool_recycle_in_sec,
+                pool_health_check_after_idle_in_sec,
+            )
+        else:
+            self.pool = None
 
     @contextmanager
     def _connection(self):
-        db = mysql.connector.connect(**self.__dict__)
-        yield db
-        db.close()
+        db = mysql.connector.connect(**self.connection_params)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _query(self, query, params=()):
+        if self.pool:
+            with self.pool.connection() as pooled_connection:
+                if params:
+                    # Queries with a variable number of parameters are not worth preparing
+                    cursor = pooled_connection.db.cursor()
+                else:
+                    cursor = pooled_connection.prepared_cursor(query)
+                cursor.execute(query, params)
+                return [_decode_row(row) for row in cursor.fetchall()]
+        with self._connection() as db:
+            cursor = db.cursor()
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def _query_in(self, query, values):
+        placeholders = ", ".join(["%s"] * len(values))
+        return self._query(query.format(placeholders), tuple(values))
 
     def get_all_users(self, logger):
         logger = logger.getLogger(subsystem="mysql")
         logger.info("Reading all users")
-        with self._connection() as db:
-            mycursor = db.cursor()
-            mycursor.execute(
-                "SELECT id, first_name, last_name, email, telegram_user_id, phone_number, uses_signal, always_uses_email FROM members_user"
-            )
-        return [User(*row) for row in mycursor]
+        return [User(*row) for row in self._query(QUERY_ALL_USERS)]
 
     def get_all_machines(self, logger):
         logger = logger.getLogger(subsystem="mysql")
         logger.info("Reading all machines")
-        with self._connection() as db:
-            mycursor = db.cursor()
-            mycursor.execute(
-                """
-                SELECT acl_machine.id, acl_machine.name, acl_machine.description, node_machine_name, node_name, acl_location.name
-                FROM acl_machine
-                LEFT JOIN acl_location ON (acl_machine.location_id = acl_location.id)
-                WHERE node_machine_name IS NOT NULL
-                  AND node_machine_name <> ''
-            """
-            )
-        return [Machine(*row) for row in mycursor]
+        return [Machine(*row) for row in self._query(QUERY_ALL_MACHINES)]
+
+    def get_users_checksums(self, logger):
+        logger = logger.getLogger(subsystem="mysql")
+        logger.info("Reading users checksums")
+        return dict(self._query(QUERY_USERS_CHECKSUMS))
+
+    def get_users_by_ids_with_checksums(self, user_ids, logger):
+        logger = logger.getLogger(subsystem="mysql")
+        logger.info(f"Reading {len(user_ids)} users")
+        return [
+            (User(*row[:-1]), row[-1])
+            for row in self._query_in(QUERY_USERS_BY_IDS, user_ids)
+        ]
+
+    def get_machines_checksums(self, logger):
+        logger = logger.getLogger(subsystem="mysql")
+        logger.info("Reading machines checksums")
+        return dict(self._query(QUERY_MACHINES_CHECKSUMS))
+
+    def get_machines_by_names_with_checksums(self, machine_names, logger):
+        logger = logger.getLogger(subsystem="mysql")
+        logger.info(f"Reading {len(machine_names)} machines")
+        return [
+            (Machine(*row[:-1]), row[-1])
+            for row in self._query_in(QUERY_MACHINES_BY_NAMES, machine_names)
+        ]
 
     def get_all_tags(self, logger):
         logger = logger.getLogger(subsystem="mysql")
         logger.info("Reading all tags")
-        with self._connection() as db:
-            mycursor = db.cursor()
-            mycursor.execute(
-                """
-                SELECT members_tag.id AS tag_id, members_tag.tag, members_user.id AS user_id, first_name, last_name, email
-                FROM members_tag LEFT JOIN members_user ON (members_tag.owner_id = members_user.id)
-            """
-            )
-        return [Tag(row[0], row[1], User(*row[2:])) for row in mycursor]
+        return [
+            Tag(row[0], row[1], User(*row[2:])) for row in self._query(QUERY_ALL_TAGS)
+        ]
+
+    def get_tags_checksums(self, logger):
+        logger = logger.getLogger(subsystem="mysql")
+        logger.info("Reading tags checksums")
+        return dict(self._query(QUERY_TAGS_CHECKSUMS))
+
+    def get_tags_by_ids_with_checksums(self, tag_ids, logger):
+        logger = logger.getLogger(subsystem="mysql")
+        logger.info(f"Reading {len(tag_ids)} tags")
+        return [
+            (Tag(row[0], row[1], User(*row[2:-1])), row[-1])
+            for row in self._query_in(QUERY_TAGS_BY_IDS, tag_ids)
+        ]
+
+
+def _decode_row(row):
+    # Prepared statements return text columns as raw bytes
+    return tuple(
+        value.decode("utf-8") if isinstance(value, (bytes, bytearray)) else value
+        for value in row
+    )
+
+
+class MySQLConnectionPool(object):
+    """
+    A fixed-size pool of MySQL connections.
+
+    Connections older than recycle_in_sec are closed and replaced when checked out.
+    Connections idle for more than health_check_after_idle_in_sec are pinged first,
+    and replaced if the server went away.
+    """
+
+    def __init__(
+        self,
+        connect,
+        size,
+        recycle_in_sec,
+        health_check_after_idle_in_sec,
+        time_function=time.monotonic,
+    ):
+        self.connect = connect
+        self.size = size
+        self.recycle_in_sec = recycle_in_sec
+        self.health_check_after_idle_in_sec = health_check_after_idle_in_sec
+        self.time_function = time_function
+        self.idle_connections = queue.LifoQueue()
+        self.available_slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self.available_slots.acquire()
+        try:
+            pooled_connection = self._checkout()
+            try:
+                yield pooled_connection
+            except Exception:
+                pooled_connection.close()
+                raise
+            pooled_connection.last_used_at = self.time_function()
+            self.idle_connections.put(pooled_connection)
+        finally:
+            self.available_slots.release()
+
+    def _checkout(self):
+        try:
+            pooled_connection = self.idle_connections.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+        now = self.time_function()
+        if now - pooled_connection.created_at > self.recycle_in_sec:
+            pooled_connection.close()
+            return self._new_connection()
+        if now - pooled_connection.last_used_at > self.health_check_after_idle_in_sec:
+            try:
+                pooled_connection.db.ping()
+            except Exception:
+                pooled_connection.close()
+                return self._new_connection()
+        return pooled_connection
+
+    def _new_connection(self):
+        return PooledConnection(self.connect(), self.time_function())
+
+
+class PooledConnection(object):
+    def __init__(self, db, created_at):
+        self.db = db
+        self.created_at = created_at
+        self.last_used_at = created_at
+        self.prepared_cursors = {}
+
+    def prepared_cursor(self, query):
+        # The cursor keeps the statement prepared as long as it executes the same query
+        cursor = self.prepared_cursors.get(query)
+        if cursor is None:
+            cursor = self.prepared_cursors[query] = self.db.cursor(prepared=True)
+        return cursor
+
+    def close(self):
+        try:
+            self.db.close()
+        except Exception:
+            pass
@@ -0,0 +1,128 @@
+import unittest
+from unittest import mock
+
+from .database import MySQLAdapter, MySQLConnectionPool
+from .logging import configure_logging_for_tests
+
+
+class MockTime(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class MockConnection(object):
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.closed = False
+        self.server_gone = False
+        self.num_pings = 0
+
+    def ping(self):
+        self.num_pings += 1
+        if self.server_gone:
+            raise Exception("MySQL server has gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class MockCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params=()):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+class MockMySQLConnection(MockConnection):
+    def __init__(self, connection_id, **connection_params):
+        super().__init__(connection_id)
+        self.autocommit = connection_params.get("autocommit", False)
+
+    def cursor(self, prepared=False):
+        return MockCursor([(1, b"checksum")])
+
+
+class TestMySQLConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.time = MockTime()
+        self.connections = []
+        self.pool = MySQLConnectionPool(
+            self._connect, 2, 3600, 30, time_function=self.time
+        )
+
+    def _connect(self):
+        connection = MockConnection(len(self.connections))
+        self.connections.append(connection)
+        return connection
+
+    def _use_connection(self):
+        with self.pool.connection() as pooled_connection:
+            return pooled_connection.db
+
+    def test_connections_are_reused(self):
+        self.assertIs(self._use_connection(), self._use_connection())
+        self.assertEqual(len(self.connections), 1)
+
+    def test_concurrent_checkouts_open_new_connections(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertIsNot(first.db, second.db)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_old_connections_are_recycled(self):
+        first = self._use_connection()
+        self.time.now = 3601
+        second = self._use_connection()
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+
+    def test_idle_connections_are_health_checked(self):
+        first = self._use_connection()
+        self.time.now = 10
+        self.assertIs(self._use_connection(), first)
+        self.assertEqual(first.num_pings, 0)
+
+        self.time.now = 100
+        self.assertIs(self._use_connection(), first)
+        self.assertEqual(first.num_pings, 1)
+
+        self.time.now = 200
+        first.server_gone = True
+        second = self._use_connection()
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+
+    def test_connections_are_discarded_after_errors(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection() as pooled_connection:
+                raise ValueError("Lost connection to MySQL server during query")
+        self.assertTrue(pooled_connection.db.closed)
+        self.assertIsNot(self._use_connection(), pooled_connection.db)
+
+
+class TestMySQLAdapter(unittest.TestCase):
+    def test_pooled_reads_see_the_latest_data(self):
+        connections = []
+
+        def connect(**connection_params):
+            connections.append(
+                MockMySQLConnection(len(connections), **connection_params)
+            )
+            return connections[-1]
+
+        with mock.patch("mysql.connector.connect", connect):
+            adapter = MySQLAdapter(pool_size=1, database="msl")
+            logger = configure_logging_for_tests()
+            self.assertEqual(adapter.get_users_checksums(logger), {1: "checksum"})
+            adapter.get_users_checksums(logger)
+
+        # Each read runs in its own transaction, not in one opened by the first read
+        self.assertEqual(len(connections), 1)
+        self.assertTrue(connections[0].autocommit)
@@ -0,0 +1,85 @@
+class IncrementalDirectorySync(object):
+    """
+    Keeps the users, machines and tags directories in Redis in sync with MySQL,
+    writing only the rows that changed since the last sync.
+
+    MySQL computes a checksum per row, which is stored in Redis next to the directory.
+    Only rows whose checksum differs are read in full and written with HSET,
+    rows that disappeared are removed with HDEL.
+    """
+
+    def __init__(self, database_adapter, redis_adapter):
+        self.database_adapter = database_adapter
+        self.redis_adapter = redis_adapter
+
+    def sync_users(self, logger):
+        logger = logger.getLogger(subsystem="directory_sync")
+        checksums = self.database_adapter.get_users_checksums(logger)
+        stored_checksums = self.redis_adapter.get_users_checksums(logger)
+        changed_user_ids = _changed_keys(checksums, stored_checksums)
+        removed_user_ids = _removed_keys(checksums, stored_checksums)
+        if not changed_user_ids and not removed_user_ids:
+            return 0
+        changed_users_with_checksums = (
+            self.database_adapter.get_users_by_ids_with_checksums(
+                changed_user_ids, logger
+            )
+            if changed_user_ids
+            else []
+        )
+        self.redis_adapter.apply_users_changes(
+            changed_users_with_checksums, removed_user_ids, logger
+        )
+        return len(changed_users_with_checksums) + len(removed_user_ids)
+
+    def sync_machines(self, logger):
+        logger = logger.getLogger(subsystem="directory_sync")
+        checksums = self.database_adapter.get_machines_checksums(logger)
+        stored_checksums = self.redis_adapter.get_machines_checksums(logger)
+        changed_machine_names = _changed_keys(checksums, stored_checksums)
+        removed_machine_names = _removed_keys(checksums, stored_checksums)
+        if not changed_machine_names and not removed_machine_names:
+            return 0
+        changed_machines_with_checksums = (
+            self.database_adapter.get_machines_by_names_with_checksums(
+                changed_machine_names, logger
+            )
+            if changed_machine_names
+            else []
+        )
+        self.redis_adapter.apply_machines_changes(
+            changed_machines_with_checksums, removed_machine_names, logger
+        )
+        return len(changed_machines_with_checksums) + len(removed_machine_names)
+
+    def sync_tags(self, logger):
+        logger = logger.getLogger(subsystem="directory_sync")
+        checksums = self.database_adapter.get_tags_checksums(logger)
+        stored_checksums = self.redis_adapter.get_tags_checksums(logger)
+        changed_tag_ids = _changed_keys(checksums, stored_checksums)
+        removed_tag_ids = _removed_keys(checksums, stored_checksums)
+        if not changed_tag_ids and not removed_tag_ids:
+            return 0
+        changed_tags_with_checksums = (
+            self.database_adapter.get_tags_by_ids_with_checksums(
+                changed_tag_ids, logger
+            )
+            if changed_tag_ids
+            else []
+        )
+        self.redis_adapter.apply_tags_changes(
+            changed_tags_with_checksums, removed_tag_ids, logger
+        )
+        return len(changed_tags_with_checksums) + len(removed_tag_ids)
+
+
+def _changed_keys(checksums, stored_checksums):
+    return [
+        key
+        for key, checksum in checksums.items()
+        if stored_checksums.get(key) != checksum
+    ]
+
+
+def _removed_keys(checksums, stored_checksums):
+    return [key for key in stored_checksums if key not in checksums]
@@ -0,0 +1,171 @@
+import hashlib
+
+from .directory_sync import IncrementalDirectorySync
+from .model import Tag
+from .testing_utils import (
+    ALL_MACHINES,
+    ALL_USERS,
+    BOB,
+    STEFANO,
+    AggregatorBaseTestSuite,
+)
+
+ALL_TAGS = [Tag(tag_id, f"tag{tag_id}", STEFANO) for tag_id in range(1, 6)]
+
+
+def checksum(row):
+    return hashlib.md5(repr(tuple(row)).encode("utf-8")).hexdigest()
+
+
+class MockChecksumDatabaseAdapter(object):
+    def __init__(self):
+        self.users = list(ALL_USERS)
+        self.machines = list(ALL_MACHINES)
+        self.tags = list(ALL_TAGS)
+        self.users_read = []
+
+    def get_users_checksums(self, logger):
+        return dict((user.user_id, checksum(user)) for user in self.users)
+
+    def get_users_by_ids_with_checksums(self, user_ids, logger):
+        self.users_read.extend(user_ids)
+        return [
+            (user, checksum(user)) for user in self.users if user.user_id in user_ids
+        ]
+
+    def get_machines_checksums(self, logger):
+        return dict(
+            (machine.node_machine_name, checksum(machine)) for machine in self.machines
+        )
+
+    def get_machines_by_names_with_checksums(self, machine_names, logger):
+        return [
+            (machine, checksum(machine))
+            for machine in self.machines
+            if machine.node_machine_name in machine_names
+        ]
+
+    def get_tags_checksums(self, logger):
+        return dict((tag.tag_id, checksum(tag)) for tag in self.tags)
+
+    def get_tags_by_ids_with_checksums(self, tag_ids, logger):
+        return [(tag, checksum(tag)) for tag in self.tags if tag.tag_id in tag_ids]
+
+
+class TestIncrementalDirectorySync(AggregatorBaseTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.checksum_db = MockChecksumDatabaseAdapter()
+        self.directory_sync = IncrementalDirectorySync(
+            self.checksum_db, self.redis_adapter
+        )
+        self.aggregator.directory_sync = self.directory_sync
+        self.aggregator.tags_sync = self.directory_sync
+
+    def test_first_sync_loads_everything(self):
+        self.assertEqual(self.directory_sync.sync_users(self.logger), 2)
+        self.assertEqual(self.directory_sync.sync_machines(self.logger), 1)
+        self.assertEqual(
+            self.redis_adapter.get_user_by_id(STEFANO.user_id, self.logger), STEFANO
+        )
+        self.assertEqual(
+            self.redis_adapter.get_user_by_phone_number(BOB.phone_number, self.logger),
+            BOB,
+        )
+        self.assertEqual(self.redis_adapter.get_all_machines(self.logger), ALL_MACHINES)
+
+    def test_only_changes_are_applied(self):
+        self.directory_sync.sync_users(self.logger)
+        self.assertEqual(self.directory_sync.sync_users(self.logger), 0)
+
+        new_bob = BOB._replace(last_name="de Bouwmeester", phone_number="+3100000")
+        self.checksum_db.users = [STEFANO, new_bob]
+        self.checksum_db.users_read = []
+
+        self.assertEqual(self.directory_sync.sync_users(self.logger), 1)
+        self.assertEqual(self.checksum_db.users_read, [BOB.user_id])
+        self.assertEqual(
+            self.redis_adapter.get_user_by_id(BOB.user_id, self.logger), new_bob
+        )
+        self.assertEqual(
+            self.redis_adapter.get_user_by_phone_number("+3100000", self.logger),
+            new_bob,
+        )
+        self.assertIsNone(
+            self.redis_adapter.get_user_by_phone_number(BOB.phone_number, self.logger)
+        )
+
+    def test_removed_rows_are_deleted(self):
+        self.directory_sync.sync_users(self.logger)
+        self.directory_sync.sync_machines(self.logger)
+        self.checksum_db.users = [STEFANO]
+        self.checksum_db.machines = []
+
+        self.assertEqual(self.directory_sync.sync_users(self.logger), 1)
+        self.assertEqual(self.directory_sync.sync_machines(self.logger), 1)
+        self.assertIsNone(self.redis_adapter.get_user_by_id(BOB.user_id, self.logger))
+        self.assertIsNone(
+            self.redis_adapter.get_user_by_phone_number(BOB.phone_number, self.logger)
+        )
+        self.assertEqual(self.redis_adapter.get_all_machines(self.logger), [])
+
+    def test_directory_is_not_expired(self):
+        self.directory_sync.sync_users(self.logger)
+        self.assertEqual(
+            self.redis_adapter.redis.ttl(self.redis_adapter._k_users_by_id()), -1
+        )
+
+    def test_aggregator_syncs_on_miss(self):
+        self.aggregator.user_entered_space(STEFANO.user_id, self.logger)
+
+        self.assertEqual(self.db.num_users_reloads, 0)
+        self.assertEqual(
+            self.aggregator.get_space_state_for_json(self.logger)["users_in_space"][0][
+                "user"
+            ]["user_id"],
+            STEFANO.user_id,
+        )
+
+    def get_tags_page(self, after_tag_id=None, since_version=None, limit=2):
+        return self.aggregator.get_tags_page(
+            after_tag_id, since_version, limit, self.logger
+        )
+
+    def test_tags_are_paginated(self):
+        page = self.get_tags_page()
+        self.assertEqual(page.tags, ALL_TAGS[:2])
+        self.assertEqual(page.next_tag_id, 2)
+        self.assertEqual(self.get_tags_page(2).tags, ALL_TAGS[2:4])
+        last_page = self.get_tags_page(4)
+        self.assertEqual(last_page.tags, ALL_TAGS[4:])
+        self.assertIsNone(last_page.next_tag_id)
+
+    def test_tags_changed_since_a_version(self):
+        version = self.get_tags_page().version
+        self.checksum_db.tags = [
+            ALL_TAGS[0],
+            ALL_TAGS[1]._replace(user=BOB),
+            ALL_TAGS[3],
+            ALL_TAGS[4],
+        ]
+        self.aggregator.sync_directories(self.logger)
+
+        page = self.get_tags_page(since_version=version)
+        self.assertEqual(page.version, version + 1)
+        self.assertEqual(page.tags, [ALL_TAGS[1]._replace(user=BOB)])
+        self.assertEqual(page.removed_tag_ids, [3])
+        self.assertFalse(page.reset)
+        self.assertEqual(self.get_tags_page(since_version=page.version).tags, [])
+
+    def test_tags_are_synced_again_when_old(self):
+        self.get_tags_page()
+        self.checksum_db.tags = ALL_TAGS[:1]
+        self.assertEqual(len(self.get_tags_page(limit=10).tags), 5)
+
+        self.clock.add(1, "hour")
+        self.assertEqual(self.get_tags_page(limit=10).tags, ALL_TAGS[:1])
+
+    def test_unknown_versions_get_all_tags(self):
+        page = self.get_tags_page(since_version=100, limit=10)
+        self.assertTrue(page.reset)
+        self.assertEqual(page.tags, ALL_TAGS)
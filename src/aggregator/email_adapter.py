@@ -1,5 +1,12 @@
+import queue
+import re
+import smtplib
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from functools import lru_cache
 from subprocess import PIPE, Popen
 
 
@@ -19,6 +26,9 @@ class EmailAdapter(object):
             message.get_email_text(),
         )
         logger.info(f"Sending email to {name}: {message.__class__.__name__}")
+        self._send(email, email_body, logger)
+
+    def _send(self, email, email_body, logger):
         try:
             ps = Popen(["/usr/sbin/sendmail", email], stdin=PIPE, stderr=PIPE)
             ps.stdin.write(email_body.encode("utf-8"))
@@ -31,6 +41,177 @@ class EmailAdapter(object):
             logger.error(f"Unexpexted return code while sending email: {error}")
 
 
+class SmtpEmailAdapter(EmailAdapter):
+    """
+    Queues the emails, and sends them from a background thread over a persistent SMTP
+    connection to a (local) relay, instead of forking sendmail for every email.
+
+    The queued emails are sent in batches on the same connection, at most
+    max_emails_per_minute. Temporary failures are retried with backoff,
+    emails refused by the relay are dropped.
+    """
+
+    def __init__(
+        self,
+        from_address,
+        host="localhost",
+        port=25,
+        username=None,
+        password=None,
+        starttls=False,
+        timeout_in_sec=30,
+        batch_size=20,
+        max_emails_per_minute=60,
+        max_attempts=5,
+        retry_backoff_in_sec=5,
+        idle_timeout_in_sec=60,
+        max_queue_size=1000,
+    ):
+        super().__init__(from_address)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout_in_sec = timeout_in_sec
+        self.batch_size = batch_size
+        self.min_interval_in_sec = 60 / max_emails_per_minute
+        self.max_attempts = max_attempts
+        self.retry_backoff_in_sec = retry_backoff_in_sec
+        self.idle_timeout_in_sec = idle_timeout_in_sec
+        self.queue = queue.Queue(max_queue_size)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.connection = None
+        self.last_sent_at = 0
+        self.stats_lock = threading.Lock()
+        self.stats = {"queued": 0, "sent": 0, "retried": 0, "dropped": 0}
+
+    def _send(self, email, email_body, logger):
+        try:
+            self.queue.put_nowait((email, email_body, logger))
+        except queue.Full:
+            logger.error(f"Email queue full, dropping email to {email}")
+            self._count("dropped")
+            return
+        self._count("queued")
+
+    def start_sending_in_background_thread(self, logger):
+        logger = logger.getLogger(subsystem="mail")
+        self.thread = threading.Thread(target=self._main, args=(logger,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+
+    def wait_until_sent(self):
+        self.queue.join()
+
+    def _main(self, logger):
+        while not self.stopped.is_set():
+            try:
+                item = self.queue.get(timeout=self.idle_timeout_in_sec)
+            except queue.Empty:
+                self._close_connection(logger)
+                continue
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                try:
+                    if item:
+                        self._deliver(*item)
+                finally:
+                    self.queue.task_done()
+        self._close_connection(logger)
+
+    def _deliver(self, email, email_body, logger):
+        # Date and Message-ID are unique per email, so they are not part of the composed email
+        email_body = (
+            f"Date: {formatdate(localtime=True)}\n"
+            f"Message-ID: {make_msgid()}\n" + email_body
+        )
+        # smtplib only fixes the line endings of str messages, and relays may reject bare LFs
+        email_body = to_crlf_line_endings(email_body).encode("utf-8")
+        for attempt in range(1, self.max_attempts + 1):
+            self._wait_for_rate_limit()
+            try:
+                self._get_connection().sendmail(self.from_address, [email], email_body)
+                self.last_sent_at = time.monotonic()
+                self._count("sent")
+                return
+            except smtplib.SMTPRecipientsRefused as e:
+                self.last_sent_at = time.monotonic()
+                if min(code for code, _ in e.recipients.values()) >= 500:
+                    logger.error(f"Email to {email} refused by the relay")
+                    self._count("dropped")
+                    return
+                # E.g. greylisting
+                logger.error(f"Email to {email} temporarily refused by the relay: {e}")
+            except smtplib.SMTPResponseException as e:
+                self.last_sent_at = time.monotonic()
+                if e.smtp_code >= 500:
+                    logger.error(f"Email to {email} refused by the relay: {e}")
+                    self._count("dropped")
+                    return
+                logger.error(f"Temporary failure sending email to {email}: {e}")
+            except (OSError, smtplib.SMTPException) as e:
+                logger.error(f"Cannot send email to {email}: {e}")
+                self._close_connection(logger)
+            if attempt < self.max_attempts:
+                self._count("retried")
+                self.stopped.wait(self.retry_backoff_in_sec * 2 ** (attempt - 1))
+        logger.error(f"Dropping email to {email} after {self.max_attempts} attempts")
+        self._count("dropped")
+
+    def _wait_for_rate_limit(self):
+        delay = self.last_sent_at + self.min_interval_in_sec - time.monotonic()
+        if delay > 0:
+            self.stopped.wait(delay)
+
+    def _get_connection(self):
+        if self.connection is None:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout_in_sec)
+            if self.starttls:
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+            self.connection = connection
+        return self.connection
+
+    def _close_connection(self, logger):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except (OSError, smtplib.SMTPException):
+            logger.info("SMTP connection already closed")
+        self.connection = None
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["pending"] = self.queue.qsize()
+        return stats
+
+
+def to_crlf_line_endings(text):
+    return re.sub(r"\r\n|\r|\n", "\r\n", text)
+
+
+# Messages with the same template and recipient compose to the same text
+@lru_cache(maxsize=256)
 def compose_email(from_address, to_address, subject, body_text):
     msg = MIMEMultipart()
     msg["From"] = from_address
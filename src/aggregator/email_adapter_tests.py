@@ -0,0 +1,116 @@
+import unittest
+
+from . import messages
+from .email_adapter import SmtpEmailAdapter, compose_email
+from .logging import configure_logging_for_tests
+from .testing_utils import BOB, STEFANO, SmtpSink
+
+FROM_ADDRESS = "MakerSpace BOT <noc@makerspaceleiden.nl>"
+
+
+class TestSmtpEmailAdapter(unittest.TestCase):
+    def setUp(self):
+        self.logger = configure_logging_for_tests()
+        self.sink = SmtpSink()
+        self.email_adapter = SmtpEmailAdapter(
+            FROM_ADDRESS,
+            host=self.sink.host,
+            port=self.sink.port,
+            timeout_in_sec=5,
+            max_emails_per_minute=60000,
+            max_attempts=3,
+            retry_backoff_in_sec=0.01,
+        )
+        self.email_adapter.start_sending_in_background_thread(self.logger)
+
+    def tearDown(self):
+        self.email_adapter.stop()
+        self.sink.stop()
+
+    def test_emails_are_sent_over_one_connection(self):
+        for user in (STEFANO, BOB, STEFANO):
+            self.email_adapter.send_email_to_user(
+                user, messages.TestNotification(user), self.logger
+            )
+        self.email_adapter.wait_until_sent()
+
+        self.assertEqual(
+            [recipients for recipients, _ in self.sink.emails],
+            [[STEFANO.email], [BOB.email], [STEFANO.email]],
+        )
+        self.assertEqual(self.sink.num_connections, 1)
+        _, text = self.sink.emails[0]
+        self.assertIn("Subject: Test notification", text)
+        self.assertIn("Message-ID: ", text)
+        # Every line ends with CRLF on the wire
+        self.assertNotRegex(text, r"[^\r]\n")
+        self.assertNotEqual(self.sink.emails[0][1], self.sink.emails[2][1])
+        self.assertEqual(self.email_adapter.get_stats()["sent"], 3)
+
+    def test_temporary_failures_are_retried(self):
+        self.sink.fail_next_emails(2, 451)
+        self.email_adapter.send_email_to_user(
+            STEFANO, messages.TestNotification(STEFANO), self.logger
+        )
+        self.email_adapter.wait_until_sent()
+
+        self.assertEqual(len(self.sink.emails), 1)
+        stats = self.email_adapter.get_stats()
+        self.assertEqual((stats["sent"], stats["retried"]), (1, 2))
+
+    def test_greylisted_recipients_are_retried(self):
+        self.sink.fail_next_recipients(1, 450)
+        self.email_adapter.send_email_to_user(
+            STEFANO, messages.TestNotification(STEFANO), self.logger
+        )
+        self.email_adapter.wait_until_sent()
+
+        self.assertEqual([r for r, _ in self.sink.emails], [[STEFANO.email]])
+        stats = self.email_adapter.get_stats()
+        self.assertEqual((stats["sent"], stats["retried"]), (1, 1))
+
+    def test_refused_recipients_are_dropped(self):
+        self.sink.fail_next_recipients(1, 550)
+        self.email_adapter.send_email_to_user(
+            STEFANO, messages.TestNotification(STEFANO), self.logger
+        )
+        self.email_adapter.wait_until_sent()
+
+        self.assertEqual(self.sink.emails, [])
+        self.assertEqual(self.email_adapter.get_stats()["dropped"], 1)
+
+    def test_permanent_failures_are_dropped(self):
+        self.sink.fail_next_emails(1, 550)
+        self.email_adapter.send_email_to_user(
+            STEFANO, messages.TestNotification(STEFANO), self.logger
+        )
+        self.email_adapter.send_email_to_user(
+            BOB, messages.TestNotification(BOB), self.logger
+        )
+        self.email_adapter.wait_until_sent()
+
+        self.assertEqual([r for r, _ in self.sink.emails], [[BOB.email]])
+        self.assertEqual(self.email_adapter.get_stats()["dropped"], 1)
+
+    def test_reconnects_when_the_connection_is_lost(self):
+        self.email_adapter.send_email_to_user(
+            STEFANO, messages.TestNotification(STEFANO), self.logger
+        )
+        self.email_adapter.wait_until_sent()
+        self.sink.drop_connections()
+
+        self.email_adapter.send_email_to_user(
+            BOB, messages.TestNotification(BOB), self.logger
+        )
+        self.email_adapter.wait_until_sent()
+
+        self.assertEqual(len(self.sink.emails), 2)
+        self.assertEqual(self.sink.num_connections, 2)
+
+
+class TestComposeEmail(unittest.TestCase):
+    def test_composed_emails_are_cached(self):
+        compose_email.cache_clear()
+        for _ in range(3):
+            compose_email(FROM_ADDRESS, "bob@example.com", "Subject", "Text")
+        self.assertEqual(compose_email.cache_info().hits, 2)
@@ -1,13 +1,36 @@
 import json
 import logging
+import time
 from functools import partial, wraps
 
+from .broadcast_hub import SubscriberDisconnected
+from .communication import WorkerQueueFull
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .metrics import REGISTRY
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "aggregator_http_requests_total",
+    "HTTP requests handled",
+    ("method", "route", "status"),
+)
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "aggregator_http_request_duration_seconds",
+    "Duration of the HTTP handlers, until the response starts",
+    ("method", "route"),
+)
+
+# Tags read from Redis at a time when streaming the whole directory
+TAGS_PAGE_SIZE = 500
+MAX_TAGS_PAGE_SIZE = 1000
+
 
 def run_http_server(
     loop,
-    input_message_queue,
+    space_state_feed,
+    space_state_document,
     aggregator,
     worker_input_queue,
+    reader_pool,
     logger,
     logging_handler,
     basic_auth,
@@ -53,6 +76,14 @@ def run_http_server(
                         {"WWW-Authenticate": f'Basic realm="{realm}"'},
                     )
                 return await f(*args, **kwargs)
+            except WorkerQueueFull:
+                logger.error("Worker input queue full, request rejected")
+                return Response(
+                    "Too busy, retry later",
+                    503,
+                    {"Retry-After": "1"},
+                    mimetype="text/plain",
+                )
             except Exception:
                 logger.exception("Unexpected exception")
                 return Response("Internal server error", 500, mimetype="text/plain")
@@ -65,9 +96,20 @@ def run_http_server(
 
     @app.before_request
     def prepare_request():
+        request.started_at = time.perf_counter()
         request.logger = logger.getLoggerWithRandomReqId("http")
         request.logger.info(f"{request.method} {request.path}")
 
+    @app.after_request
+    def measure_request(response):
+        # By route rather than by path, so that the number of series stays bounded
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUESTS.inc(request.method, route, str(response.status_code))
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - request.started_at, request.method, route
+        )
+        return response
+
     @app.route("/", methods=["GET"])
     async def root():
         return Response("MSL Aggregator", mimetype="text/plain")
@@ -75,39 +117,111 @@ def run_http_server(
     @app.route("/tags", methods=["GET"])
     @with_basic_auth
     async def tags():
-        _tags = await worker_input_queue.add_task_with_result_future(
-            aggregator.get_tags, request.logger
+        # ?after= is the cursor returned as "next" by the previous page, ?limit= the page
+        # size (the whole directory when missing), ?since= the version of the node copy
+        try:
+            after_tag_id = parse_optional_int(request.args.get("after"))
+            limit = parse_optional_int(request.args.get("limit"))
+            since_version = parse_optional_int(request.args.get("since"))
+        except ValueError:
+            return Response("Invalid parameters", 400, mimetype="text/plain")
+        if limit is not None and not 0 < limit <= MAX_TAGS_PAGE_SIZE:
+            return Response(
+                f"The limit must be between 1 and {MAX_TAGS_PAGE_SIZE}",
+                400,
+                mimetype="text/plain",
+            )
+
+        def read_page(after_tag_id, page_logger):
+            return aggregator.get_tags_page(
+                after_tag_id, since_version, limit or TAGS_PAGE_SIZE, page_logger
+            )
+
+        # Read before responding, so that errors still get a proper status code
+        first_page = await reader_pool.run(
+            partial(read_page, after_tag_id), request.logger
         )
-        return jsonify(
-            {
-                "tags": [
-                    {
-                        "tag_id": tag.tag_id,
-                        "tag": tag.tag,
-                        "user": tag.user.for_json(),
-                    }
-                    for tag in _tags
-                ]
-            }
+        return Response(
+            stream_tags(first_page, read_page, limit is None, request.logger),
+            mimetype="application/json",
+        )
+
+    async def stream_tags(page, read_page, all_pages, tags_logger):
+        yield (
+            f'{{"version":{page.version},"reset":{json.dumps(page.reset)},'
+            f'"removed":{json.dumps(page.removed_tag_ids)},"tags":['
         )
+        separator = ""
+        while True:
+            if page.tags:
+                yield separator + ",".join(
+                    json.dumps(
+                        {
+                            "tag_id": tag.tag_id,
+                            "tag": tag.tag,
+                            "user": tag.user.for_json(),
+                        }
+                    )
+                    for tag in page.tags
+                )
+                separator = ","
+            if not all_pages or page.next_tag_id is None:
+                break
+            page = await reader_pool.run(
+                partial(read_page, page.next_tag_id), tags_logger
+            )
+        next_tag_id = None if all_pages else page.next_tag_id
+        yield f'],"next":{json.dumps(next_tag_id)}}}'
+
+    def parse_optional_int(value):
+        return int(value) if value not in (None, "") else None
 
     @app.route("/space_state", methods=["GET"])
     @with_basic_auth
     async def space_state():
-        logger.info("space_state endpoint called")
-        try:
-            logger.info("About to call worker_input_queue.add_task_with_result_future")
-            state = await worker_input_queue.add_task_with_result_future(
-                aggregator.get_space_state_for_json, request.logger
-            )
-            logger.info(f"Worker queue returned: {type(state)}")
-            logger.info("About to call jsonify")
-            response = jsonify(state)
-            logger.info(f"jsonify returned: {type(response)}")
-            return response
-        except Exception as e:
-            logger.exception(f"Error in space_state endpoint: {e}")
-            raise
+        # Served from the precomputed document, without going through the worker
+        document = await space_state_document.get()
+        headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        for encoding in ("br", "gzip"):
+            if (
+                encoding in document.bodies_by_encoding
+                and request.accept_encodings[encoding]
+            ):
+                headers["Content-Encoding"] = encoding
+                break
+        else:
+            encoding = "identity"
+        etag = document.etags_by_encoding[encoding]
+        headers["ETag"] = f'"{etag}"'
+        if request.if_none_match.contains_weak(etag):
+            return Response(b"", 304, headers)
+        return Response(
+            document.bodies_by_encoding[encoding],
+            200,
+            headers,
+            mimetype="application/json",
+        )
+
+    @app.route("/stats", methods=["GET"])
+    @with_basic_auth
+    async def stats():
+        stats = {
+            "local_cache": aggregator.redis_adapter.get_stats(),
+            "negative_cache": aggregator.negative_cache.get_stats(),
+            "shared_directory_reloads": aggregator.directory_reloads.shared,
+            "websocket": space_state_feed.hub.get_stats(),
+            "space_state": space_state_document.get_stats(),
+            "reader_pool": reader_pool.get_stats(),
+            "worker_queue": worker_input_queue.get_stats(),
+        }
+        if hasattr(aggregator.crm_adapter, "get_stats"):
+            stats["crm_outbox"] = aggregator.crm_adapter.get_stats(request.logger)
+        return jsonify(stats)
+
+    @app.route("/metrics", methods=["GET"])
+    @with_basic_auth
+    async def metrics():
+        return Response(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
 
     @app.route("/telegram/token", methods=["POST"])
     @with_basic_auth
@@ -119,6 +233,7 @@ def run_http_server(
                 aggregator.create_telegram_connect_token, request_payload["user_id"]
             ),
             request.logger,
+            partition_key=("user", request_payload["user_id"]),
         )
         return Response(token.encode("utf-8"), mimetype="text/plain")
 
@@ -130,6 +245,7 @@ def run_http_server(
         await worker_input_queue.add_task_with_result_future(
             partial(aggregator.send_notification_test, request_payload["user_id"]),
             request.logger,
+            partition_key=("user", request_payload["user_id"]),
         )
         return Response("Ok", mimetype="text/plain")
 
@@ -141,26 +257,69 @@ def run_http_server(
         await worker_input_queue.add_task_with_result_future(
             partial(aggregator.user_left_space, request_payload["user_id"]),
             request.logger,
+            # Ordered with the check-ins and check-outs of the user from MQTT
+            partition_key=("user", request_payload["user_id"]),
         )
         return Response("Ok", mimetype="text/plain")
 
     # -- Web Socket -----
 
-    async def ws_sending():
-        while True:
-            msg = await input_message_queue.get_next_message()
-            await websocket.send(msg["text"])
+    # Sends a snapshot of the space state, then the deltas, see space_state_feed.py.
+    # Connect with ?stream=...&since=... to resume after the last received message.
+    # Clients can send {"type": "resume", "stream": ..., "since": ...} or {"type": "snapshot"}.
 
-    async def ws_receiving():
+    def parse_seq(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    async def ws_sending(subscription, ws_logger):
+        get_space_state = partial(
+            reader_pool.run,
+            aggregator.get_space_state_for_json,
+            ws_logger,
+        )
+        try:
+            while True:
+                for text in await subscription.get_next_messages(get_space_state):
+                    await websocket.send(text)
+        except SubscriberDisconnected:
+            ws_logger.error("Disconnecting websocket client, too slow")
+            await websocket.close(1013, "Too slow")
+
+    async def ws_receiving(subscription, ws_logger):
         while True:
             data = await websocket.receive()
-            print(f"received: {data}")
+            try:
+                ws_request = json.loads(data)
+                request_type = ws_request["type"]
+            except (ValueError, TypeError, KeyError):
+                ws_logger.error(f"Invalid websocket request: {data}")
+                continue
+            if request_type == "resume":
+                subscription.resume(
+                    ws_request.get("stream"), parse_seq(ws_request.get("since"))
+                )
+            elif request_type == "snapshot":
+                subscription.request_snapshot()
+            else:
+                ws_logger.error(f"Unknown websocket request: {request_type}")
 
     @app.websocket("/ws")
     async def ws():
-        producer = asyncio.create_task(ws_sending())
-        consumer = asyncio.create_task(ws_receiving())
-        await asyncio.gather(producer, consumer)
+        ws_logger = logger.getLoggerWithRandomReqId("ws")
+        subscription = space_state_feed.subscribe(
+            websocket.args.get("stream"), parse_seq(websocket.args.get("since"))
+        )
+        producer = asyncio.create_task(ws_sending(subscription, ws_logger))
+        consumer = asyncio.create_task(ws_receiving(subscription, ws_logger))
+        try:
+            await asyncio.gather(producer, consumer)
+        finally:
+            producer.cancel()
+            consumer.cancel()
+            space_state_feed.unsubscribe(subscription)
 
     # -- Run server ----
 
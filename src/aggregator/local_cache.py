@@ -0,0 +1,230 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .utils import make_random_string
+
+USERS = "users"
+MACHINES = "machines"
+TAGS = "tags"
+
+
+class LocalCache(object):
+    """
+    Thread-safe in-process LRU cache, where every entry also expires after a TTL.
+    """
+
+    def __init__(self, ttl_in_sec, max_size, time_function=time.monotonic):
+        self.ttl_in_sec = ttl_in_sec
+        self.max_size = max_size
+        self.time_function = time_function
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.time_function():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.time_function() + self.ttl_in_sec, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class SingleFlight(object):
+    """
+    Concurrent calls for the same key share a single execution of the function:
+    the first caller runs it, the others wait and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CachingRedisAdapter(object):
+    """
+    L1 cache for the user and machine directories, in front of a RedisAdapter.
+    Every other method is delegated to the wrapped adapter.
+
+    When a directory is reloaded, an invalidation is published on a Redis channel,
+    so that other aggregator processes drop their local copies too.
+    """
+
+    def __init__(self, redis_adapter, ttl_in_sec=30, max_size=2000):
+        self.redis_adapter = redis_adapter
+        self.users_by_id = LocalCache(ttl_in_sec, max_size)
+        self.users_by_phone_number = LocalCache(ttl_in_sec, max_size)
+        self.machines_by_name = LocalCache(ttl_in_sec, max_size)
+        self.reloads = {USERS: 0, MACHINES: 0}
+        self.invalidations_received = 0
+        self.process_id = make_random_string(10)
+        self.pubsub_thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.redis_adapter, name)
+
+    def get_user_by_id(self, user_id, logger):
+        user = self.users_by_id.get(user_id)
+        if user is None:
+            user = self.redis_adapter.get_user_by_id(user_id, logger)
+            if user:
+                self.users_by_id.set(user_id, user)
+        return user
+
+    def get_user_by_phone_number(self, phone_number, logger):
+        user = self.users_by_phone_number.get(phone_number)
+        if user is None:
+            user = self.redis_adapter.get_user_by_phone_number(phone_number, logger)
+            if user:
+                self.users_by_phone_number.set(phone_number, user)
+        return user
+
+    def get_machine_by_name(self, machine, logger):
+        value = self.machines_by_name.get(machine)
+        if value is None:
+            value = self.redis_adapter.get_machine_by_name(machine, logger)
+            if value:
+                self.machines_by_name.set(machine, value)
+        return value
+
+    def set_users_by_ids(self, users, logger):
+        self.redis_adapter.set_users_by_ids(users, logger)
+        self.reloads[USERS] += 1
+        self._invalidate(USERS)
+        self._publish_invalidation(USERS, logger)
+
+    def set_all_machines(self, machines, logger):
+        self.redis_adapter.set_all_machines(machines, logger)
+        self.reloads[MACHINES] += 1
+        self._invalidate(MACHINES)
+        self._publish_invalidation(MACHINES, logger)
+
+    def apply_users_changes(
+        self, changed_users_with_checksums, removed_user_ids, logger
+    ):
+        self.redis_adapter.apply_users_changes(
+            changed_users_with_checksums, removed_user_ids, logger
+        )
+        self.reloads[USERS] += 1
+        self._invalidate(USERS)
+        self._publish_invalidation(USERS, logger)
+
+    def apply_machines_changes(
+        self, changed_machines_with_checksums, removed_machine_names, logger
+    ):
+        self.redis_adapter.apply_machines_changes(
+            changed_machines_with_checksums, removed_machine_names, logger
+        )
+        self.reloads[MACHINES] += 1
+        self._invalidate(MACHINES)
+        self._publish_invalidation(MACHINES, logger)
+
+    def get_stats(self):
+        return {
+            "users_by_id": self.users_by_id.get_stats(),
+            "users_by_phone_number": self.users_by_phone_number.get_stats(),
+            "machines_by_name": self.machines_by_name.get_stats(),
+            "reloads": dict(self.reloads),
+            "invalidations_received": self.invalidations_received,
+        }
+
+    # -- Invalidation ----
+
+    def start_listening_for_invalidations(self, logger):
+        logger = logger.getLogger(subsystem="local_cache")
+        logger.info("Listening for directory invalidations")
+        pubsub = self.redis_adapter.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self._k_invalidations(): self._on_invalidation_message})
+        self.pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop(self):
+        if self.pubsub_thread:
+            self.pubsub_thread.stop()
+            self.pubsub_thread = None
+
+    def _on_invalidation_message(self, message):
+        process_id, directory = message["data"].decode("utf-8").split(":", 1)
+        if process_id != self.process_id:
+            self.invalidations_received += 1
+            self._invalidate(directory)
+
+    def _publish_invalidation(self, directory, logger):
+        try:
+            self.redis_adapter.redis.publish(
+                self._k_invalidations(), f"{self.process_id}:{directory}"
+            )
+        except Exception:
+            logger.getLogger(subsystem="local_cache").exception(
+                f"Cannot publish invalidation of {directory}"
+            )
+
+    def _invalidate(self, directory):
+        if directory == USERS:
+            self.users_by_id.clear()
+            self.users_by_phone_number.clear()
+        elif directory == MACHINES:
+            self.machines_by_name.clear()
+
+    def _k_invalidations(self):
+        return f"{self.redis_adapter.key_prefix}:iv"
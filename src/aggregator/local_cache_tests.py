@@ -0,0 +1,143 @@
+import threading
+import unittest
+
+from .local_cache import CachingRedisAdapter, LocalCache, SingleFlight
+from .testing_utils import (
+    ALL_MACHINES,
+    ALL_USERS,
+    STEFANO,
+    TABLE_SAW,
+    AggregatorBaseTestSuite,
+)
+
+
+class MockTime(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        self.time = MockTime()
+        self.cache = LocalCache(10, 2, time_function=self.time)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(
+            self.cache.get_stats(), {"size": 1, "hits": 1, "misses": 1, "evictions": 0}
+        )
+
+    def test_entries_expire(self):
+        self.cache.set("a", 1)
+        self.time.now = 9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.time.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get_stats()["size"], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.get_stats()["evictions"], 1)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        executions = []
+        results = []
+
+        def reload():
+            executions.append(1)
+            started.set()
+            release.wait()
+            return "users"
+
+        def call():
+            results.append(single_flight.do("users", reload))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=call) for _ in range(5)]
+        for thread in followers:
+            thread.start()
+        while single_flight.shared < len(followers):
+            pass
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(executions), 1)
+        self.assertEqual(results, ["users"] * 6)
+
+    def test_errors_are_shared_and_not_cached(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError("MySQL down")
+
+        with self.assertRaises(ValueError):
+            single_flight.do("users", fail)
+        self.assertEqual(single_flight.do("users", lambda: "users"), "users")
+
+
+class TestCachingRedisAdapter(AggregatorBaseTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.redis_adapter.set_users_by_ids(ALL_USERS, self.logger)
+        self.redis_adapter.set_all_machines(ALL_MACHINES, self.logger)
+        self.redis_adapter = CachingRedisAdapter(self.redis_adapter)
+        self.aggregator.redis_adapter = self.redis_adapter
+
+    def test_users_are_read_from_redis_only_once(self):
+        self.aggregator.user_entered_space(STEFANO.user_id, self.logger)
+        self.aggregator.user_left_space(STEFANO.user_id, self.logger)
+        self.aggregator.user_entered_space(STEFANO.user_id, self.logger)
+
+        stats = self.redis_adapter.get_stats()
+        self.assertEqual(stats["reloads"], {"users": 0, "machines": 0})
+        self.assertEqual(stats["users_by_id"]["misses"], 1)
+        self.assertEqual(stats["users_by_id"]["hits"], 2)
+
+    def test_reload_invalidates_local_copies(self):
+        self.assertEqual(
+            self.redis_adapter.get_machine_by_name("tablesaw", self.logger), TABLE_SAW
+        )
+        self.assertEqual(self.redis_adapter.machines_by_name.get_stats()["size"], 1)
+
+        self.redis_adapter.set_all_machines([TABLE_SAW], self.logger)
+
+        self.assertEqual(self.redis_adapter.machines_by_name.get_stats()["size"], 0)
+        self.assertEqual(self.redis_adapter.get_stats()["reloads"]["machines"], 1)
+
+    def test_invalidation_from_another_process(self):
+        self.redis_adapter.get_user_by_id(STEFANO.user_id, self.logger)
+        self.assertEqual(self.redis_adapter.users_by_id.get_stats()["size"], 1)
+
+        other_process = CachingRedisAdapter(self.redis_adapter.redis_adapter)
+        self.redis_adapter._on_invalidation_message(
+            {"data": f"{other_process.process_id}:users".encode("utf-8")}
+        )
+
+        self.assertEqual(self.redis_adapter.users_by_id.get_stats()["size"], 0)
+        self.assertEqual(self.redis_adapter.get_stats()["invalidations_received"], 1)
+
+    def test_own_invalidations_are_ignored(self):
+        self.redis_adapter.get_user_by_id(STEFANO.user_id, self.logger)
+        self.redis_adapter._on_invalidation_message(
+            {"data": f"{self.redis_adapter.process_id}:users".encode("utf-8")}
+        )
+        self.assertEqual(self.redis_adapter.users_by_id.get_stats()["size"], 1)
@@ -1,10 +1,14 @@
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 
 from .utils import make_random_string
 
 
-def configure_logging(log_filepath=None, when=None, interval=None, backup_count=None):
+def configure_logging(
+    log_filepath=None, when=None, interval=None, backup_count=None, level="DEBUG"
+):
     formatter = DispatchingFormatter(
         {
             "aggregator": logging.Formatter(
@@ -29,13 +33,20 @@ def configure_logging(log_filepath=None, when=None, interval=None, backup_count=
     handler.setLevel(logging.DEBUG)
     handler.setFormatter(formatter)
 
+    # Records are formatted and written by a dedicated thread, off the worker and the MQTT thread
+    records_queue = queue.Queue()
+    queue_handler = DeferredQueueHandler(records_queue)
+    listener = QueueListener(records_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
     # Our own internal application logger wrapper
     logger = logging.getLogger("aggregator")
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
     application_logger = Logger(logger, subsystem="root")
 
-    return application_logger, handler
+    return application_logger, queue_handler
 
 
 def configure_logging_for_tests():
@@ -45,31 +56,60 @@ def configure_logging_for_tests():
 
 
 class Logger(object):
+    """
+    Wrapper adding the subsystem and the request ID to the records.
+
+    Messages can take %-style arguments, which are only formatted when the record is
+    written, and nothing is done at all below the level of the Python logger:
+
+        logger.info("Machine %s state %s", machine, state)
+    """
+
     def __init__(self, python_logger, **extra):
         extra.setdefault("subsystem", "")
         extra.setdefault("req_id", "__n/a__")
         self.python_logger = python_logger
         self.extra = extra
+        self.children = {}
 
-    def info(self, msg, **extra):
-        e = self.extra.copy()
-        e.update(extra)
-        self.python_logger.info(msg, extra=e)
+    def isEnabledFor(self, level):
+        return self.python_logger.isEnabledFor(level)
 
-    def error(self, msg, exc_info=None, **extra):
-        e = self.extra.copy()
-        e.update(extra)
-        self.python_logger.error(msg, exc_info=exc_info, extra=e)
+    def debug(self, msg, *args, **extra):
+        if self.python_logger.isEnabledFor(logging.DEBUG):
+            self.python_logger.debug(msg, *args, extra=self._extra(extra))
+
+    def info(self, msg, *args, **extra):
+        if self.python_logger.isEnabledFor(logging.INFO):
+            self.python_logger.info(msg, *args, extra=self._extra(extra))
 
-    def exception(self, msg, exc_info=True, **extra):
+    def error(self, msg, *args, exc_info=None, **extra):
+        self.python_logger.error(
+            msg, *args, exc_info=exc_info, extra=self._extra(extra)
+        )
+
+    def exception(self, msg, *args, exc_info=True, **extra):
+        self.python_logger.exception(
+            msg, *args, exc_info=exc_info, extra=self._extra(extra)
+        )
+
+    def _extra(self, extra):
+        # The records copy the extra fields, so ours can be passed as they are
+        if not extra:
+            return self.extra
         e = self.extra.copy()
         e.update(extra)
-        self.python_logger.exception(msg, exc_info=exc_info, extra=e)
+        return e
 
     def getLogger(self, **extra):
-        new_extra = self.extra.copy()
-        new_extra.update(extra)
-        return Logger(self.python_logger, **new_extra)
+        # Called at every adapter method, so the children are reused
+        key = tuple(sorted(extra.items()))
+        child = self.children.get(key)
+        if child is None:
+            new_extra = self.extra.copy()
+            new_extra.update(extra)
+            child = self.children[key] = Logger(self.python_logger, **new_extra)
+        return child
 
     def getLoggerWithRandomReqId(self, prefix):
         new_extra = self.extra.copy()
@@ -77,6 +117,16 @@ class Logger(object):
         return Logger(self.python_logger, **new_extra)
 
 
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queues the records as they are, leaving the formatting of the message to the
+    thread which writes them. QueueHandler formats them beforehand, for other processes.
+    """
+
+    def prepare(self, record):
+        return record
+
+
 # From https://stackoverflow.com/a/34626685
 
 
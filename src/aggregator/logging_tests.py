@@ -0,0 +1,77 @@
+import logging
+import queue
+import threading
+import unittest
+from logging.handlers import QueueListener
+
+from .logging import DeferredQueueHandler, Logger
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = []
+
+    def emit(self, record):
+        self.messages.append((record.subsystem, self.format(record)))
+        self.threads.append(threading.current_thread())
+
+
+class CountingStr(object):
+    def __init__(self):
+        self.num_calls = 0
+        self.threads = set()
+
+    def __str__(self):
+        self.num_calls += 1
+        self.threads.add(threading.current_thread())
+        return "value"
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        # Outside of the hierarchy, so that no other handler formats the records
+        self.python_logger = logging.Logger("aggregator.logging_tests")
+        self.handler = RecordingHandler()
+        self.python_logger.addHandler(self.handler)
+        self.python_logger.setLevel(logging.INFO)
+        self.logger = Logger(self.python_logger, subsystem="root")
+
+    def test_child_loggers_are_reused(self):
+        child = self.logger.getLogger(subsystem="redis")
+        self.assertIs(self.logger.getLogger(subsystem="redis"), child)
+        self.assertIsNot(self.logger.getLogger(subsystem="mysql"), child)
+        self.assertEqual(child.extra["subsystem"], "redis")
+
+        child.info("Setting machine %s state %s", "tablesaw", "on")
+        self.assertEqual(
+            self.handler.messages, [("redis", "Setting machine tablesaw state on")]
+        )
+
+    def test_arguments_are_formatted_only_when_logged(self):
+        value = CountingStr()
+        self.logger.debug("Debug %s", value)
+        self.assertEqual(value.num_calls, 0)
+        self.assertEqual(self.handler.messages, [])
+
+        self.logger.info("Info %s", value)
+        self.assertEqual(value.num_calls, 1)
+        self.assertEqual(self.handler.messages, [("root", "Info value")])
+
+    def test_records_are_written_by_the_listener_thread(self):
+        records_queue = queue.Queue()
+        queue_handler = DeferredQueueHandler(records_queue)
+        self.python_logger.removeHandler(self.handler)
+        self.python_logger.addHandler(queue_handler)
+        listener = QueueListener(records_queue, self.handler)
+        listener.start()
+        value = CountingStr()
+        try:
+            self.logger.info("Info %s", value)
+        finally:
+            listener.stop()
+
+        self.assertEqual(self.handler.messages, [("root", "Info value")])
+        self.assertEqual(value.threads, set(self.handler.threads))
+        self.assertNotIn(threading.current_thread(), value.threads)
@@ -2,6 +2,8 @@
 
 from collections import defaultdict
 
+from .directory_sync import IncrementalDirectorySync
+from .local_cache import MACHINES, TAGS, USERS, LocalCache, SingleFlight
 from .messages import (
     MachineLeftOnNotification,
     ProblemLightLeftOn,
@@ -12,13 +14,27 @@ from .messages import (
 )
 from .model import (
     ALL_LIGHTS,
+    TagsPage,
     UserEntered,
     UserLeft,
     get_history_line_description,
     history_line_to_json,
 )
+from .space_state_feed import (
+    LIGHTS,
+    MACHINE_OFF,
+    MACHINE_ON,
+    MACHINE_STATE,
+    SPACE_OPEN,
+    USER_CHECKED_IN,
+    USER_CHECKED_OUT,
+)
 from .urls import Urls
 
+# The tags directory is synced from MySQL at most this often when read,
+# besides during the scheduled directory sync
+TAGS_MAX_AGE_IN_SEC = 300
+
 
 class Aggregator(object):
     def __init__(
@@ -31,6 +47,8 @@ class Aggregator(object):
         email_adapter,
         task_scheduler,
         checkin_stale_after_hours,
+        negative_cache=None,
+        directory_sync=None,
     ):
         self.database_adapter = database_adapter
         self.redis_adapter = redis_adapter
@@ -41,51 +59,123 @@ class Aggregator(object):
         self.email_adapter = email_adapter
         self.task_scheduler = task_scheduler
         self.urls = Urls()
+        # IDs, names and phone numbers recently not found even after reloading from the database
+        self.negative_cache = negative_cache or LocalCache(60, 1000)
+        # Concurrent misses share one directory reload
+        self.directory_reloads = SingleFlight()
+        # When set, reloads apply only the rows changed in MySQL since the last sync
+        self.directory_sync = directory_sync
+        # Tags are always synced incrementally, which versions them for the nodes
+        self.tags_sync = directory_sync or IncrementalDirectorySync(
+            database_adapter, redis_adapter
+        )
+        self.tags_synced_at = None
+
+    def _reload_users(self, logger):
+        def reload():
+            if self.directory_sync:
+                self.directory_sync.sync_users(logger)
+            else:
+                all_users = self.database_adapter.get_all_users(logger)
+                self.redis_adapter.set_users_by_ids(all_users, logger)
+
+        self.directory_reloads.do(USERS, reload)
+
+    def _reload_machines(self, logger):
+        def reload():
+            if self.directory_sync:
+                self.directory_sync.sync_machines(logger)
+            else:
+                all_machines = self.database_adapter.get_all_machines(logger)
+                self.redis_adapter.set_all_machines(all_machines, logger)
+
+        self.directory_reloads.do(MACHINES, reload)
+
+    def _reload_tags(self, logger):
+        def reload():
+            self.tags_sync.sync_tags(logger)
+            self.tags_synced_at = self.clock.now().as_int_timestamp()
+
+        self.directory_reloads.do(TAGS, reload)
 
     def _get_user_by_id(self, user_id, logger):
         user = self.redis_adapter.get_user_by_id(user_id, logger)
-        if not user:
-            all_users = self.database_adapter.get_all_users(logger)
-            self.redis_adapter.set_users_by_ids(all_users, logger)
-            filtered_users = [u for u in all_users if u.user_id == user_id]
-            if len(filtered_users) == 1:
-                user = filtered_users[0]
+        if not user and not self.negative_cache.get(("user_id", user_id)):
+            self._reload_users(logger)
+            user = self.redis_adapter.get_user_by_id(user_id, logger)
+            if not user:
+                self.negative_cache.set(("user_id", user_id), True)
         return user
 
     def _get_machine_by_name(self, machine_name, logger):
         machine = self.redis_adapter.get_machine_by_name(machine_name, logger)
-        if not machine:
-            all_machines = self.database_adapter.get_all_machines(logger)
-            self.redis_adapter.set_all_machines(all_machines, logger)
-            filtered_machines = [
-                m for m in all_machines if m.node_machine_name == machine_name
-            ]
-            if len(filtered_machines) == 1:
-                machine = filtered_machines[0]
+        if not machine and not self.negative_cache.get(("machine", machine_name)):
+            self._reload_machines(logger)
+            machine = self.redis_adapter.get_machine_by_name(machine_name, logger)
+            if not machine:
+                self.negative_cache.set(("machine", machine_name), True)
         return machine
 
     def _get_all_machines(self, logger):
         machines = self.redis_adapter.get_all_machines(logger)
         if not machines:
-            machines = self.database_adapter.get_all_machines(logger)
-            self.redis_adapter.set_all_machines(machines, logger)
-        machines.sort(key=lambda m: (m.location_name or "", m.name or ""))
+            self._reload_machines(logger)
+            machines = self.redis_adapter.get_all_machines(logger)
+        self._sort_machines(machines)
         return machines
 
+    def _sort_machines(self, machines):
+        machines.sort(key=lambda m: (m.location_name or "", m.name or ""))
+
     # --------------------------------------------------
 
     def get_user_by_phone_number(self, phone_number, logger):
         user = self.redis_adapter.get_user_by_phone_number(phone_number, logger)
-        if not user:
-            all_users = self.database_adapter.get_all_users(logger)
-            self.redis_adapter.set_users_by_ids(all_users, logger)
-            filtered_users = [u for u in all_users if u.phone_number == phone_number]
-            if len(filtered_users) == 1:
-                user = filtered_users[0]
+        if not user and not self.negative_cache.get(("phone_number", phone_number)):
+            self._reload_users(logger)
+            user = self.redis_adapter.get_user_by_phone_number(phone_number, logger)
+            if not user:
+                self.negative_cache.set(("phone_number", phone_number), True)
         return user
 
-    def get_tags(self, logger):
-        return self.database_adapter.get_all_tags(logger)
+    def sync_directories(self, logger):
+        logger = logger.getLogger(subsystem="aggregator")
+        self._reload_users(logger)
+        self._reload_machines(logger)
+        self._reload_tags(logger)
+
+    def get_tags_page(self, after_tag_id, since_version, limit, logger):
+        """
+        Tags are served from the Redis copy, versioned by the incremental sync.
+        Nodes pass the version of their copy as since_version to get only the changes.
+        """
+        logger = logger.getLogger(subsystem="aggregator")
+        if (
+            self.tags_synced_at is None
+            or self.clock.now().as_int_timestamp() - self.tags_synced_at
+            > TAGS_MAX_AGE_IN_SEC
+        ):
+            self._reload_tags(logger)
+        version = self.redis_adapter.get_tags_version(logger)
+        # A version from the future means that the Redis copy was rebuilt since
+        reset = since_version is not None and since_version > version
+        if reset:
+            since_version = None
+        tags, has_more = self.redis_adapter.get_tags_page(
+            after_tag_id, since_version, limit, logger
+        )
+        removed_tag_ids = (
+            self.redis_adapter.get_removed_tag_ids(since_version, logger)
+            if since_version is not None and after_tag_id is None
+            else []
+        )
+        return TagsPage(
+            version,
+            tags,
+            removed_tag_ids,
+            tags[-1].tag_id if has_more else None,
+            reset,
+        )
 
     def user_entered_space(self, user_id, logger):
         logger = logger.getLogger(subsystem="aggregator")
@@ -99,9 +189,13 @@ class Aggregator(object):
             self.crm_adapter.user_checkin(user_id, logger)
 
         self.redis_adapter.store_user_in_space(user, now, logger)
-        self.notifications_queue.send_message(msg_type="user_entered_space")
-        self.redis_adapter.store_history_line(
-            UserEntered(user_id, now, user.first_name, user.last_name), logger
+        history_line = UserEntered(user_id, now, user.first_name, user.last_name)
+        self.redis_adapter.store_history_line(history_line, logger)
+        self.notifications_queue.send_message(
+            msg_type=USER_CHECKED_IN,
+            user=user.for_json(),
+            ts_checkin=now.human_str(),
+            history_line=self._get_history_line_for_json(history_line),
         )
 
     def user_left_space(self, user_id, logger):
@@ -115,8 +209,14 @@ class Aggregator(object):
             self.crm_adapter.user_checkout(user_id, logger)
 
         self.redis_adapter.user_left_space(user, logger)
-        self.redis_adapter.store_history_line(
-            UserLeft(user_id, self.clock.now(), user.first_name, user.last_name), logger
+        history_line = UserLeft(
+            user_id, self.clock.now(), user.first_name, user.last_name
+        )
+        self.redis_adapter.store_history_line(history_line, logger)
+        self.notifications_queue.send_message(
+            msg_type=USER_CHECKED_OUT,
+            user_id=user_id,
+            history_line=self._get_history_line_for_json(history_line),
         )
         users_still_in_space = self.redis_adapter.get_user_ids_in_space_with_timestamps(
             logger
@@ -183,41 +283,62 @@ class Aggregator(object):
                     "Machine {0} ON state expired. Cable must have been disconnected. Setting to off."
                 )
                 self.redis_adapter.set_machine_off(machine, logger)
+                self._notify_machine_off(machine, logger)
 
     def get_space_state_for_json(self, logger):
         logger = logger.getLogger(subsystem="aggregator")
-        data = self.redis_adapter.get_user_ids_in_space_with_timestamps(logger)
+        snapshot = self.redis_adapter.get_space_state_snapshot(logger)
+        now = self.clock.now()
         users = [
-            (self._get_user_by_id(user_id, logger), ts_checkin)
-            for user_id, ts_checkin in data
+            (self._get_user_from_snapshot(snapshot, user_id, logger), ts_checkin)
+            for user_id, ts_checkin in snapshot.user_ids_in_space_with_timestamps
         ]
         users.sort(key=lambda checkin: -checkin[1].sorting_key())
-        all_machines = self._get_all_machines(logger)
-        all_machines_states = self._get_machines_on_for_json(logger)
+        all_machines = snapshot.machines
+        machine_states = snapshot.machine_states
+        if all_machines:
+            self._sort_machines(all_machines)
+        else:
+            # Machines directory expired from Redis: reload it and read states one by one
+            all_machines = self._get_all_machines(logger)
+            machine_states = dict(
+                (
+                    machine.node_machine_name,
+                    self.redis_adapter.get_machine_state(
+                        machine.node_machine_name, logger
+                    ),
+                )
+                for machine in all_machines
+            )
+        all_machines_states = self._get_machines_on_from_snapshot_for_json(
+            snapshot, now, logger
+        )
         machines_on_by_user = defaultdict(list)
         for state in all_machines_states:
             if state.get("user", None) and state["user"].get("user_id", None):
                 machines_on_by_user[state["user"]["user_id"]].append(state)
-        lights_on = self.redis_adapter.get_lights_on(logger)
-        all_history_lines = self.redis_adapter.get_all_history_lines(logger)
-        all_history_lines.sort(key=lambda hl: hl.ts)
         return {
             "lights_on": [
-                light.for_json() for light in ALL_LIGHTS if light.label in lights_on
+                light.for_json()
+                for light in ALL_LIGHTS
+                if light.label in snapshot.lights_on
             ],
-            "space_open": self.redis_adapter.get_space_open(logger),
+            "space_open": snapshot.space_open,
             "machines_on": all_machines_states,
             "machines": [
-                self._get_machine_state(machine, logger) for machine in all_machines
+                self._machine_state_for_json(
+                    machine, machine_states.get(machine.node_machine_name)
+                )
+                for machine in all_machines
             ],
             "history": [
-                self._get_history_line_for_json(hl) for hl in all_history_lines
+                self._get_history_line_for_json(hl) for hl in snapshot.history_lines
             ],
             "users_in_space": [
                 {
                     "user": user.for_json(),
                     "ts_checkin": ts_checkin.human_str(),
-                    "ts_checkin_human": ts_checkin.human_delta_from(self.clock.now()),
+                    "ts_checkin_human": ts_checkin.human_delta_from(now),
                     "machines_on": machines_on_by_user.get(user.user_id, []),
                 }
                 for user, ts_checkin in users
@@ -225,6 +346,31 @@ class Aggregator(object):
             ],
         }
 
+    def _get_user_from_snapshot(self, snapshot, user_id, logger):
+        user = snapshot.users_by_id.get(user_id)
+        if not user:
+            user = self._get_user_by_id(user_id, logger)
+        return user
+
+    def _get_machines_on_from_snapshot_for_json(self, snapshot, now, logger):
+        machines_by_name = dict(
+            (machine.node_machine_name, machine) for machine in snapshot.machines
+        )
+        all_machines_states = []
+        for machine_name, state in snapshot.machines_on.items():
+            user = self._get_user_from_snapshot(snapshot, state["user_id"], logger)
+            if not user:
+                continue
+            machine = machines_by_name.get(machine_name)
+            if not machine:
+                machine = self._get_machine_by_name(machine_name, logger)
+            if not machine:
+                continue
+            all_machines_states.append(
+                self._machine_onoff_state_for_json(machine, state, user, now)
+            )
+        return all_machines_states
+
     def _get_machines_on_for_json(self, logger):
         all_machines_states = [
             self._get_machine_onoff_state(machine, logger)
@@ -238,8 +384,7 @@ class Aggregator(object):
         data["description"] = get_history_line_description(hl)
         return data
 
-    def _get_machine_state(self, machine, logger):
-        state = self.redis_adapter.get_machine_state(machine.node_machine_name, logger)
+    def _machine_state_for_json(self, machine, state):
         return {
             "machine": {
                 "name": machine.name,
@@ -259,16 +404,19 @@ class Aggregator(object):
         machine = self._get_machine_by_name(machine_name, logger)
         if not machine:
             return None
+        return self._machine_onoff_state_for_json(
+            machine, state, user, self.clock.now()
+        )
+
+    def _machine_onoff_state_for_json(self, machine, state, user, now):
         return {
             "machine": {
                 "name": machine.name,
                 "machine_id": machine.machine_id,
             },
-            "ts": state["ts"].human_str() if state else None,
-            "ts_human": state["ts"].human_delta_from(self.clock.now())
-            if state
-            else None,
-            "user": user.for_json() if user else None,
+            "ts": state["ts"].human_str(),
+            "ts_human": state["ts"].human_delta_from(now),
+            "user": user.for_json(),
         }
 
     def clean_stale_user_checkins(self, logger):
@@ -289,6 +437,9 @@ class Aggregator(object):
             f"Checking out stale user {user.full_name if user else user_id} after {int(elapsed_time_in_hours)} hours"
         )
         self.redis_adapter.remove_user_from_space(user_id, logger)
+        self.notifications_queue.send_message(
+            msg_type=USER_CHECKED_OUT, user_id=user_id, history_line=None
+        )
 
         if self.crm_adapter:
             self.crm_adapter.user_checkout(user_id, logger)
@@ -323,6 +474,7 @@ class Aggregator(object):
                 )
                 now = self.clock.now()
                 self.redis_adapter.set_machine_on(machine, user_id, now, logger)
+                self._notify_machine_on(machine, user, now, logger)
         else:
             assert state == "off"
             state = self.redis_adapter.get_machine_on(machine, logger)
@@ -333,14 +485,21 @@ class Aggregator(object):
             else:
                 logger.info(f"Turning off machine {machine}")
                 self.redis_adapter.set_machine_off(machine, logger)
+                self._notify_machine_off(machine, logger)
 
     def space_open(self, is_open, logger):
         logger = logger.getLogger(subsystem="aggregator")
         self.redis_adapter.set_space_open(is_open, logger)
+        self.notifications_queue.send_message(msg_type=SPACE_OPEN, space_open=is_open)
 
     def lights(self, room, state, logger):
         logger = logger.getLogger(subsystem="aggregator")
         self.redis_adapter.set_lights(room, state, logger)
+        for light in ALL_LIGHTS:
+            if light.label == room:
+                self.notifications_queue.send_message(
+                    msg_type=LIGHTS, light=light.for_json(), on=state
+                )
 
     def send_notification_test(self, user_id, logger):
         logger = logger.getLogger(subsystem="aggregator")
@@ -353,7 +512,36 @@ class Aggregator(object):
             if state_on:
                 self._warn_user_of_machine_left_on(machine, state_on["user_id"], logger)
                 self.redis_adapter.set_machine_off(machine, logger)
+                self._notify_machine_off(machine, logger)
         self.redis_adapter.set_machine_state(machine, state, logger)
+        self._notify_machine_state(machine, state, logger)
+
+    def refresh_machine_states(self, states, logger):
+        # The states didn't change, only their expiration is pushed back
+        self.redis_adapter.refresh_machine_states(states, logger)
+
+    def _notify_machine_on(self, machine_name, user, now, logger):
+        machine = self._get_machine_by_name(machine_name, logger)
+        if machine and user:
+            self.notifications_queue.send_message(
+                msg_type=MACHINE_ON,
+                **self._machine_onoff_state_for_json(machine, {"ts": now}, user, now),
+            )
+
+    def _notify_machine_state(self, machine_name, state, logger):
+        machine = self._get_machine_by_name(machine_name, logger)
+        if machine:
+            self.notifications_queue.send_message(
+                msg_type=MACHINE_STATE, **self._machine_state_for_json(machine, state)
+            )
+
+    def _notify_machine_off(self, machine_name, logger):
+        machine = self._get_machine_by_name(machine_name, logger)
+        if machine:
+            self.notifications_queue.send_message(
+                msg_type=MACHINE_OFF,
+                machine={"name": machine.name, "machine_id": machine.machine_id},
+            )
 
     def _warn_user_of_machine_left_on(self, machine_name, user_id, logger):
         user = self._get_user_by_id(user_id, logger)
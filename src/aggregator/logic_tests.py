@@ -222,3 +222,19 @@ class TestApplicationLogic(AggregatorBaseTestSuite):
 
         space_state = self.aggregator.get_space_state_for_json(self.logger)
         self.assertEqual(space_state["lights_on"], [])
+
+    def test_unknown_ids_do_not_reload_the_directories_every_time(self):
+        self.assertIsNone(self.aggregator._get_user_by_id(999, self.logger))
+        self.assertIsNone(self.aggregator._get_user_by_id(999, self.logger))
+        self.assertIsNone(self.aggregator.get_user_by_phone_number("+31", self.logger))
+        self.assertIsNone(self.aggregator.get_user_by_phone_number("+31", self.logger))
+        self.assertIsNone(self.aggregator._get_machine_by_name("nope", self.logger))
+        self.assertIsNone(self.aggregator._get_machine_by_name("nope", self.logger))
+
+        self.assertEqual(self.db.num_users_reloads, 2)
+        self.assertEqual(self.db.num_machines_reloads, 1)
+
+        # Known IDs are still found
+        self.assertEqual(
+            self.aggregator._get_user_by_id(STEFANO.user_id, self.logger), STEFANO
+        )
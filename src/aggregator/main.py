@@ -26,19 +26,28 @@ def _main(config):
     import asyncio
 
     from aggregator.clock import Clock
-    from aggregator.communication import HttpServerInputMessageQueue, WorkerInputQueue
+    from aggregator.communication import ReaderPool, WorkerInputQueue
     from aggregator.crm_adapter import CrmAdapter
+    from aggregator.crm_outbox import CrmOutbox
     from aggregator.database import MySQLAdapter
-    from aggregator.email_adapter import EmailAdapter
+    from aggregator.directory_sync import IncrementalDirectorySync
+    from aggregator.email_adapter import EmailAdapter, SmtpEmailAdapter
     from aggregator.http_server import run_http_server
+    from aggregator.local_cache import CachingRedisAdapter, LocalCache
     from aggregator.logging import configure_logging
     from aggregator.logic import Aggregator
+    from aggregator.metrics import InstrumentedAdapter
+    from aggregator.mqtt.capture import MqttCapture
     from aggregator.mqtt.mqtt_client import MqttListenerClient
+    from aggregator.mqtt.state_coalescer import StateUpdateCoalescer
     from aggregator.redis import RedisAdapter
+    from aggregator.space_state_document import SpaceStateDocument
+    from aggregator.space_state_feed import SpaceStateFeed
     from aggregator.timed_tasks import (
         TaskScheduler,
         start_checking_for_off_machines,
         start_checking_for_stale_checkins,
+        start_syncing_directories,
     )
     from aggregator.worker import Worker
 
@@ -49,44 +58,102 @@ def _main(config):
     loop = asyncio.get_event_loop()
 
     # Communication queues
-    http_server_input_message_queue = HttpServerInputMessageQueue(loop)
-    worker_input_queue = WorkerInputQueue(loop)
+    space_state_feed = SpaceStateFeed(loop, **config.get("space_state_feed", {}))
+    # Read-only requests don't wait behind the worker
+    reader_pool = ReaderPool(loop, **config.get("reader_pool", {}))
+    worker_config = config.get("worker", {})
+    worker_input_queue = WorkerInputQueue(
+        loop,
+        worker_config.get("max_pending_per_partition", 0),
+        worker_config.get("max_size", 0),
+        worker_config.get("overflow_policies"),
+    )
 
     # Clock
     clock = Clock()
 
     # Email
-    email_adapter = EmailAdapter(**config["email"])
+    email_config = config["email"]
+    if "smtp" in email_config:
+        email_adapter = SmtpEmailAdapter(
+            email_config["from_address"], **email_config["smtp"]
+        )
+        email_adapter.start_sending_in_background_thread(logger)
+    else:
+        email_adapter = EmailAdapter(**email_config)
 
     # Task scheduler
     task_scheduler = TaskScheduler(clock, logger)
 
+    # Redis
+    # Calls to the adapters are counted and timed for /metrics
+    redis_adapter = InstrumentedAdapter(RedisAdapter(clock, **config["redis"]), "redis")
+    redis_adapter.migrate_legacy_history_lines(logger)
+    redis_adapter = CachingRedisAdapter(redis_adapter, **config.get("local_cache", {}))
+    redis_adapter.start_listening_for_invalidations(logger)
+
+    # Directories
+    database_adapter = InstrumentedAdapter(MySQLAdapter(**config["mysql"]), "mysql")
+    directory_sync = (
+        IncrementalDirectorySync(database_adapter, redis_adapter)
+        if "directory_sync" in config
+        else None
+    )
+
+    # CRM
+    crm_adapter = InstrumentedAdapter(CrmAdapter(**config["crm"]), "crm")
+    if "crm_outbox" in config:
+        crm_adapter = CrmOutbox(redis_adapter, crm_adapter, **config["crm_outbox"])
+        crm_adapter.start_sending_in_background_thread(logger)
+
     # Application logic
     aggregator = Aggregator(
-        MySQLAdapter(**config["mysql"]),
-        RedisAdapter(clock, **config["redis"]),
-        CrmAdapter(**config["crm"]),
-        http_server_input_message_queue,
+        database_adapter,
+        redis_adapter,
+        crm_adapter,
+        space_state_feed,
         clock,
         email_adapter,
         task_scheduler,
         config["check_stale_checkins"]["stale_after_hours"]
         if "check_stale_checkins" in config
         else 0,
+        LocalCache(**config["negative_cache"]) if "negative_cache" in config else None,
+        directory_sync,
+    )
+
+    # Precomputed /space_state response
+    space_state_document = SpaceStateDocument(
+        aggregator,
+        reader_pool,
+        space_state_feed,
+        logger,
+        **config.get("space_state", {}),
     )
 
     # Start MQTT listener
+    mqtt_capture = None
+    if "mqtt_capture" in config:
+        mqtt_capture = MqttCapture(**config["mqtt_capture"])
+        mqtt_capture.start_writing_in_background_thread(logger)
+    state_coalescer = None
+    if "state_coalescer" in config:
+        state_coalescer = StateUpdateCoalescer(
+            aggregator, worker_input_queue, **config["state_coalescer"]
+        )
+        state_coalescer.start_flushing_in_background_thread(logger)
     mqtt_listener_client = MqttListenerClient(
-        http_server_input_message_queue,
         worker_input_queue,
         aggregator,
         logger,
+        capture=mqtt_capture,
+        coalescer=state_coalescer,
         **config["mqtt"],
     )
     mqtt_listener_client.start_listening_on_a_background_thread()
 
     # Start worker
-    worker = Worker(worker_input_queue)
+    worker = Worker(worker_input_queue, worker_config.get("pool_size", 1))
     worker.start_working_in_background_thread()
 
     # Start cronjobs
@@ -98,14 +165,23 @@ def _main(config):
             logger,
         )
     start_checking_for_off_machines(aggregator, worker_input_queue, logger)
+    if "directory_sync" in config:
+        start_syncing_directories(
+            aggregator,
+            worker_input_queue,
+            config["directory_sync"]["crontab"],
+            logger,
+        )
     task_scheduler.start_running_scheduled_tasks(worker_input_queue)
 
     # Start HTTP server (blocks until Ctrl-C)
     run_http_server(
         loop=loop,
-        input_message_queue=http_server_input_message_queue,
+        space_state_feed=space_state_feed,
+        space_state_document=space_state_document,
         aggregator=aggregator,
         worker_input_queue=worker_input_queue,
+        reader_pool=reader_pool,
         logger=logger,
         logging_handler=logging_handler,
         **config["http"],
@@ -113,3 +189,13 @@ def _main(config):
 
     # Quit the application
     mqtt_listener_client.stop()
+    if state_coalescer:
+        state_coalescer.stop()
+    if mqtt_capture:
+        mqtt_capture.stop()
+    if isinstance(crm_adapter, CrmOutbox):
+        crm_adapter.stop()
+    if isinstance(email_adapter, SmtpEmailAdapter):
+        email_adapter.stop()
+    reader_pool.stop()
+    redis_adapter.stop()
@@ -0,0 +1,233 @@
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+# Upper bounds of the histogram buckets, in seconds: from a Redis round trip to a slow CRM
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\""))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        lines.extend(self._render_samples())
+        return "\n".join(lines)
+
+    def _render_samples(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def _render_samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            labels = _format_labels(self.label_names, label_values)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Counts the observations in fixed buckets. Only the count of the bucket the observation
+    falls into is incremented: the cumulative counts of Prometheus are computed on render.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        # Label values -> [counts by bucket, with +Inf last, sum]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            data[0][index] += 1
+            data[1] += value
+
+    def get_count(self, *label_values):
+        data = self.values.get(label_values)
+        return sum(data[0]) if data else 0
+
+    def _render_samples(self):
+        with self.lock:
+            values = sorted(
+                (label_values, list(counts), total)
+                for label_values, (counts, total) in self.values.items()
+            )
+        for label_values, counts, total in values:
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative_count += count
+                labels = _format_labels(
+                    self.label_names, label_values, [("le", _format_value(upper_bound))]
+                )
+                yield f"{self.name}_bucket{labels} {cumulative_count}"
+            labels = _format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative_count}"
+
+
+class MetricsRegistry(object):
+    """
+    The metrics of the process, exposed in the Prometheus text format on /metrics.
+    Metrics are created once, at import time, by the modules that update them.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return "".join(metric.render() + "\n" for _, metric in metrics)
+
+
+REGISTRY = MetricsRegistry()
+
+ADAPTER_CALLS = REGISTRY.counter(
+    "aggregator_adapter_calls_total",
+    "Calls to the Redis, MySQL and CRM adapters",
+    ("adapter", "method"),
+)
+ADAPTER_CALL_ERRORS = REGISTRY.counter(
+    "aggregator_adapter_call_errors_total",
+    "Calls to the Redis, MySQL and CRM adapters that raised an exception",
+    ("adapter", "method"),
+)
+ADAPTER_CALL_DURATION = REGISTRY.histogram(
+    "aggregator_adapter_call_duration_seconds",
+    "Duration of the calls to the Redis, MySQL and CRM adapters",
+    ("adapter", "method"),
+)
+
+
+class InstrumentedAdapter(object):
+    """
+    Counts and times the calls to the public methods of an adapter.
+    Every attribute is delegated to the wrapped adapter.
+    """
+
+    def __init__(self, adapter, adapter_name):
+        self.adapter = adapter
+        self.adapter_name = adapter_name
+
+    def __getattr__(self, name):
+        value = getattr(self.adapter, name)
+        if name.startswith("_") or not callable(value):
+            return value
+        instrumented_method = self._instrument(name, value)
+        # Cached on the instance, so that __getattr__ is only called once per method
+        setattr(self, name, instrumented_method)
+        return instrumented_method
+
+    def _instrument(self, name, method):
+        label_values = (self.adapter_name, name)
+
+        @wraps(method)
+        def instrumented_method(*args, **kwargs):
+            ADAPTER_CALLS.inc(*label_values)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                ADAPTER_CALL_ERRORS.inc(*label_values)
+                raise
+            finally:
+                ADAPTER_CALL_DURATION.observe(
+                    time.perf_counter() - start, *label_values
+                )
+
+        return instrumented_method
@@ -0,0 +1,118 @@
+import functools
+import unittest
+
+from .communication import WORKER_QUEUE_WAIT, WorkerInputQueue
+from .metrics import (
+    ADAPTER_CALL_ERRORS,
+    ADAPTER_CALLS,
+    InstrumentedAdapter,
+    MetricsRegistry,
+)
+from .testing_utils import STEFANO, AggregatorBaseTestSuite
+from .worker import WORKER_TASK_DURATION, WORKER_TASK_ERRORS, WORKER_TASKS, Worker
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counters_are_rendered_by_labels(self):
+        counter = self.registry.counter("test_calls_total", "Calls", ("method",))
+        counter.inc("get")
+        counter.inc("get")
+        counter.inc('say "hi"', amount=3)
+
+        self.assertEqual(counter.get("get"), 2)
+        self.assertEqual(
+            self.registry.render(),
+            "# HELP test_calls_total Calls\n"
+            "# TYPE test_calls_total counter\n"
+            'test_calls_total{method="get"} 2\n'
+            'test_calls_total{method="say \\"hi\\""} 3\n',
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram(
+            "test_duration_seconds", "Duration", buckets=(0.1, 1)
+        )
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.get_count(), 4)
+        self.assertEqual(
+            self.registry.render().splitlines()[2:],
+            [
+                'test_duration_seconds_bucket{le="0.1"} 2',
+                'test_duration_seconds_bucket{le="1"} 3',
+                'test_duration_seconds_bucket{le="+Inf"} 4',
+                "test_duration_seconds_sum 2.65",
+                "test_duration_seconds_count 4",
+            ],
+        )
+
+    def test_names_are_unique(self):
+        self.registry.gauge("test_depth", "Depth")
+        with self.assertRaises(ValueError):
+            self.registry.counter("test_depth", "Depth")
+
+
+class FailingAdapter(object):
+    def __init__(self):
+        self.key_prefix = "test"
+
+    def fail(self, logger):
+        raise RuntimeError("Unavailable")
+
+
+class TestInstrumentation(AggregatorBaseTestSuite):
+    def test_adapter_calls_are_counted(self):
+        adapter = InstrumentedAdapter(self.redis_adapter, "redis_tests")
+        calls = ADAPTER_CALLS.get("redis_tests", "store_user_in_space")
+
+        adapter.store_user_in_space(STEFANO, self.clock.now(), self.logger)
+        self.assertEqual(
+            adapter.get_user_ids_in_space_with_timestamps(self.logger),
+            [(STEFANO.user_id, self.clock.now())],
+        )
+
+        self.assertEqual(adapter.key_prefix, self.redis_adapter.key_prefix)
+        self.assertEqual(
+            ADAPTER_CALLS.get("redis_tests", "store_user_in_space"), calls + 1
+        )
+
+    def test_adapter_errors_are_counted(self):
+        adapter = InstrumentedAdapter(FailingAdapter(), "failing_tests")
+        errors = ADAPTER_CALL_ERRORS.get("failing_tests", "fail")
+
+        with self.assertRaises(RuntimeError):
+            adapter.fail(self.logger)
+
+        self.assertEqual(adapter.key_prefix, "test")
+        self.assertEqual(ADAPTER_CALL_ERRORS.get("failing_tests", "fail"), errors + 1)
+
+    def test_worker_tasks_are_measured(self):
+        def metrics_tests_task(value, logger):
+            if value is None:
+                raise ValueError("Missing value")
+            return value
+
+        worker_input_queue = WorkerInputQueue(None)
+        Worker(worker_input_queue).start_working_in_background_thread()
+        queue_waits = WORKER_QUEUE_WAIT.get_count()
+        durations = WORKER_TASK_DURATION.get_count("metrics_tests_task")
+
+        for value in (1, 2):
+            worker_input_queue.add_task_with_result_blocking(
+                functools.partial(metrics_tests_task, value), self.logger
+            )
+        with self.assertRaises(ValueError):
+            worker_input_queue.add_task_with_result_blocking(
+                functools.partial(metrics_tests_task, None), self.logger
+            )
+
+        self.assertEqual(WORKER_TASKS.get("metrics_tests_task"), 3)
+        self.assertEqual(WORKER_TASK_ERRORS.get("metrics_tests_task"), 1)
+        self.assertEqual(
+            WORKER_TASK_DURATION.get_count("metrics_tests_task"), durations + 3
+        )
+        self.assertGreaterEqual(WORKER_QUEUE_WAIT.get_count(), queue_waits + 3)
@@ -28,6 +28,10 @@ class User(
 
 Tag = namedtuple("Tag", "tag_id tag user")
 
+# A page of the tags directory. removed_tag_ids is only filled in the first page of an
+# incremental read, and reset tells that the node copy is unknown and has to be replaced.
+TagsPage = namedtuple("TagsPage", "version tags removed_tag_ids next_tag_id reset")
+
 
 class Machine(
     namedtuple(
@@ -49,6 +53,19 @@ ALL_LIGHTS = [
 ]
 
 
+# Everything needed to render the space state, read from Redis in one go
+SpaceStateSnapshot = namedtuple(
+    "SpaceStateSnapshot",
+    "user_ids_in_space_with_timestamps machines machine_states machines_on users_by_id lights_on space_open history_lines",
+)
+
+
+# A check-in or check-out waiting to be sent to the CRM
+CrmOperation = namedtuple(
+    "CrmOperation", "user_id operation op_id enqueued_at attempts"
+)
+
+
 # -- History lines ----
 
 
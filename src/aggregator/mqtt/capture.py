@@ -0,0 +1,243 @@
+import os
+import queue
+import random
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from .topic_router import TopicRouter
+
+# A binary capture starts with MAGIC, followed by one record per message: the time of
+# reception in seconds, the length of the topic and the length of the payload, then the
+# topic and the payload as received. Records are only ever appended.
+
+CapturedMessage = namedtuple("CapturedMessage", "topic payload ts")
+
+MAGIC = b"MSLMQTT1"
+RECORD_HEADER = struct.Struct(">dHI")
+CAPTURE_FILE_EXTENSION = ".mqttcap"
+
+
+def is_binary_capture(file_path):
+    with open(file_path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def encode_captured_message(message):
+    topic = message.topic.encode("utf-8")
+    return (
+        RECORD_HEADER.pack(message.ts, len(topic), len(message.payload))
+        + topic
+        + message.payload
+    )
+
+
+def read_binary_capture(file_path):
+    messages = []
+    with open(file_path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{file_path} is not an MQTT capture")
+    offset = len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        ts, topic_length, payload_length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        end = offset + topic_length + payload_length
+        if end > len(data):
+            # Cut short while being written
+            break
+        topic = data[offset : offset + topic_length].decode("utf-8")
+        messages.append(CapturedMessage(topic, data[offset + topic_length : end], ts))
+        offset = end
+    return messages
+
+
+def truncate_partial_record(file_path):
+    """
+    Drops the last record if it was cut short, e.g. by a crash, so that appending continues
+    from a record boundary. Returns the number of bytes dropped.
+    """
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, "r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file_path} is not an MQTT capture")
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= size:
+            f.seek(offset)
+            _, topic_length, payload_length = RECORD_HEADER.unpack(
+                f.read(RECORD_HEADER.size)
+            )
+            end = offset + RECORD_HEADER.size + topic_length + payload_length
+            if end > size:
+                break
+            offset = end
+        if offset < size:
+            f.truncate(offset)
+        return size - offset
+
+
+def write_binary_capture(file_path, messages):
+    with open(file_path, "ab") as f:
+        if f.tell() == 0:
+            f.write(MAGIC)
+        f.write(b"".join(encode_captured_message(message) for message in messages))
+
+
+def rotate_binary_capture(file_path, backup_count):
+    """
+    Renames the capture to file_path.1, the previous file_path.1 to file_path.2, and so on,
+    deleting the oldest beyond backup_count. The next write starts a new capture.
+    """
+    for i in range(backup_count - 1, 0, -1):
+        if os.path.exists(f"{file_path}.{i}"):
+            os.replace(f"{file_path}.{i}", f"{file_path}.{i + 1}")
+    if backup_count > 0:
+        os.replace(file_path, f"{file_path}.1")
+    else:
+        os.remove(file_path)
+
+
+class MqttCapture(object):
+    """
+    Appends the raw MQTT messages to a binary capture file, for replays and parser tests.
+
+    Messages are sampled and rate limited per topic, with the rates of the first topic
+    filter that matches, and written in batches by a background thread. When the writer
+    falls behind, messages are dropped rather than holding up the MQTT thread.
+
+    With max_bytes, a batch that would make the capture larger than that is written to a
+    new one, keeping backup_count previous captures as file_path.1, file_path.2, etc.
+    """
+
+    def __init__(
+        self,
+        file_path,
+        sample_rates=None,
+        max_messages_per_sec=None,
+        max_bytes=None,
+        backup_count=1,
+        max_queue_size=10000,
+        flush_interval_in_sec=1,
+        time_function=time.time,
+        random_function=random.random,
+    ):
+        self.file_path = file_path
+        self.sample_rates = TopicRouter()
+        for topic_filter, sample_rate in (sample_rates or {}).items():
+            self.sample_rates.add_route(topic_filter, sample_rate)
+        self.max_messages_per_sec = TopicRouter()
+        for topic_filter, rate in (max_messages_per_sec or {}).items():
+            self.max_messages_per_sec.add_route(topic_filter, rate)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval_in_sec = flush_interval_in_sec
+        self.time_function = time_function
+        self.random_function = random_function
+        self.queue = queue.Queue(max_queue_size)
+        # Token buckets by topic: (tokens, last refill)
+        self.buckets = {}
+        self.thread = None
+        self.stats = {
+            "captured": 0,
+            "sampled_out": 0,
+            "rate_limited": 0,
+            "dropped": 0,
+            "written": 0,
+            "rotations": 0,
+        }
+
+    def record(self, topic, payload):
+        """
+        To be called for every message received, from the MQTT thread.
+        """
+        sample_rate = self.sample_rates.get_handler(topic)
+        if sample_rate is not None and self.random_function() >= sample_rate:
+            self.stats["sampled_out"] += 1
+            return
+        now = self.time_function()
+        rate = self.max_messages_per_sec.get_handler(topic)
+        if rate is not None and not self._take_token(topic, rate, now):
+            self.stats["rate_limited"] += 1
+            return
+        try:
+            self.queue.put_nowait(CapturedMessage(topic, payload, now))
+            self.stats["captured"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _take_token(self, topic, rate, now):
+        tokens, last_refill = self.buckets.get(topic, (rate, now))
+        # Bursts of up to one second worth of messages go through
+        tokens = min(rate, tokens + (now - last_refill) * rate)
+        if tokens < 1:
+            self.buckets[topic] = (tokens, now)
+            return False
+        self.buckets[topic] = (tokens - 1, now)
+        return True
+
+    def start_writing_in_background_thread(self, logger):
+        logger = logger.getLogger(subsystem="mqtt_capture")
+        logger.info("Capturing MQTT messages to %s", self.file_path)
+        if truncate_partial_record(self.file_path):
+            logger.error("Dropped a partial record at the end of the MQTT capture")
+        self.thread = threading.Thread(target=self._write_continuously, args=(logger,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _write_continuously(self, logger):
+        while True:
+            messages = [self.queue.get()]
+            if messages[0] is not None:
+                # Batches the messages received meanwhile, opening the file once per batch
+                # so that it can be rotated from outside
+                time.sleep(self.flush_interval_in_sec)
+            while True:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in messages
+            messages = [message for message in messages if message is not None]
+            if messages:
+                try:
+                    self.write(messages)
+                except OSError:
+                    logger.exception("Cannot write the MQTT capture")
+            if stopping:
+                return
+
+    def write(self, messages):
+        if self.max_bytes and os.path.exists(self.file_path):
+            size = os.path.getsize(self.file_path)
+            batch_size = sum(
+                RECORD_HEADER.size
+                + len(message.topic.encode("utf-8"))
+                + len(message.payload)
+                for message in messages
+            )
+            if size > len(MAGIC) and size + batch_size > self.max_bytes:
+                rotate_binary_capture(self.file_path, self.backup_count)
+                self.stats["rotations"] += 1
+        write_binary_capture(self.file_path, messages)
+        self.stats["written"] += len(messages)
+
+    def get_stats(self):
+        return dict(
+            self.stats,
+            pending=self.queue.qsize(),
+            file_size=os.path.getsize(self.file_path)
+            if os.path.exists(self.file_path)
+            else 0,
+        )
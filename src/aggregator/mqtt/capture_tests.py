@@ -0,0 +1,138 @@
+import os
+import tempfile
+import unittest
+
+from ..testing_utils import AggregatorBaseTestSuite
+from ..worker import Worker
+from .capture import (
+    MAGIC,
+    MqttCapture,
+    read_binary_capture,
+    rotate_binary_capture,
+    truncate_partial_record,
+    write_binary_capture,
+)
+from .mqtt_client import MqttListenerClient
+from .replay import (
+    InProcessBroker,
+    InstrumentedWorkerInputQueue,
+    StageTimings,
+    broker_stand_in,
+    read_capture,
+    replay,
+)
+from .replay_tests import CAPTURE
+
+
+class MockTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestBinaryCapture(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.dir.name, "capture.mqttcap")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        write_binary_capture(self.file_path, CAPTURE[:2])
+        write_binary_capture(self.file_path, CAPTURE[2:])
+        self.assertEqual(read_binary_capture(self.file_path), CAPTURE)
+        self.assertEqual(read_capture(self.file_path), CAPTURE)
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read().count(MAGIC), 1)
+
+    def test_partial_records_are_dropped(self):
+        write_binary_capture(self.file_path, CAPTURE)
+        size = os.path.getsize(self.file_path)
+        with open(self.file_path, "r+b") as f:
+            f.truncate(size - 3)
+
+        self.assertEqual(read_binary_capture(self.file_path), CAPTURE[:-1])
+        self.assertGreater(truncate_partial_record(self.file_path), 0)
+        write_binary_capture(self.file_path, CAPTURE[-1:])
+        self.assertEqual(read_binary_capture(self.file_path), CAPTURE)
+
+    def test_rotation(self):
+        write_binary_capture(self.file_path, CAPTURE[:1])
+        size = os.path.getsize(self.file_path)
+        capture = MqttCapture(self.file_path, max_bytes=size + 1, backup_count=2)
+        for message in CAPTURE[1:4]:
+            capture.write([message])
+
+        self.assertEqual(read_binary_capture(self.file_path), CAPTURE[3:4])
+        self.assertEqual(read_binary_capture(self.file_path + ".1"), CAPTURE[2:3])
+        self.assertEqual(read_binary_capture(self.file_path + ".2"), CAPTURE[1:2])
+        self.assertFalse(os.path.exists(self.file_path + ".3"))
+        self.assertEqual(capture.get_stats()["rotations"], 3)
+
+    def test_rotation_without_backups(self):
+        write_binary_capture(self.file_path, CAPTURE[:1])
+        rotate_binary_capture(self.file_path, 0)
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_sampling_and_rate_limits(self):
+        time = MockTime()
+        capture = MqttCapture(
+            self.file_path,
+            sample_rates={"test/log/#": 0.5},
+            max_messages_per_sec={"ac/#": 2},
+            time_function=time,
+            random_function=iter([0.3, 0.7] * 5).__next__,
+        )
+        for _ in range(10):
+            capture.record("test/log/lights", b"lights")
+        for _ in range(5):
+            capture.record("ac/log/master", b"beat")
+        time.now += 1
+        capture.record("ac/log/master", b"beat")
+
+        stats = capture.get_stats()
+        self.assertEqual(stats["sampled_out"], 5)
+        self.assertEqual(stats["rate_limited"], 3)
+        self.assertEqual(stats["captured"], 5 + 3)
+
+
+class TestMqttListenerCapture(AggregatorBaseTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.dir.name, "capture.mqttcap")
+        self.capture = MqttCapture(self.file_path, flush_interval_in_sec=0)
+        self.capture.start_writing_in_background_thread(self.logger)
+        self.worker_input_queue = InstrumentedWorkerInputQueue(None, StageTimings())
+        self.broker = InProcessBroker(StageTimings())
+        with broker_stand_in(self.broker):
+            MqttListenerClient(
+                self.worker_input_queue,
+                self.aggregator,
+                self.logger,
+                None,
+                None,
+                False,
+                capture=self.capture,
+            ).start_listening_on_a_background_thread()
+        Worker(self.worker_input_queue).start_working_in_background_thread()
+
+    def tearDown(self):
+        self.capture.stop()
+        self.dir.cleanup()
+        super().tearDown()
+
+    def test_received_messages_are_captured(self):
+        replay(CAPTURE, self.broker)
+        self.worker_input_queue.wait_until_empty()
+        self.capture.stop()
+
+        captured = read_capture(self.file_path)
+        # The unsubscribed topic never reaches the client
+        self.assertEqual(
+            [(message.topic, message.payload) for message in captured],
+            [(message.topic, message.payload) for message in CAPTURE[:3]],
+        )
@@ -1,26 +1,57 @@
 import functools
+import time
 
 import paho.mqtt.client as mqtt
 
-from .mqtt_parser import parse_message
+from ..metrics import REGISTRY
+from .mqtt_parser import DEFAULT_TOPIC_FILTERS, TOPIC_FILTER_PARSERS, parse_message
+from .topic_router import TopicRouter
 
-MESSAGE_TYPES_TO_DEDUPLICATE = (
-    # 'space_open',
+MQTT_MESSAGES_PARSED = REGISTRY.counter(
+    "aggregator_mqtt_messages_parsed_total",
+    "MQTT messages received, by the type they were parsed into",
+    ("type",),
 )
+MQTT_PARSE_DURATION = REGISTRY.histogram(
+    "aggregator_mqtt_parse_duration_seconds", "Duration of the parsing of MQTT messages"
+)
+
+
+def get_partition_key(msg_type, args):
+    # Messages about the same user or machine are processed in order, others in parallel
+    if msg_type in ("user_entered_space", "user_left_space"):
+        return "user", args[0]
+    if msg_type == "user_activated_machine":
+        # The activation must be stored before the machine is powered on
+        return "machine", args[1]
+    if msg_type in ("machine_power", "machine_state"):
+        return "machine", args[0]
+    return msg_type
+
+
+def get_coalescing_key(msg_type, args):
+    # Messages setting the same piece of state: only the latest one matters
+    if msg_type in ("machine_state", "lights"):
+        return msg_type, args[0]
+    if msg_type == "space_open":
+        return (msg_type,)
+    return None
 
 
 class MqttListenerClient(object):
     def __init__(
         self,
-        http_server_input_message_queue,
         worker_input_queue,
         aggregator,
         logger,
         host,
         port,
         log_all_messages,
+        topic_filters=None,
+        qos=0,
+        capture=None,
+        coalescer=None,
     ):
-        self.http_server_input_message_queue = http_server_input_message_queue
         self.worker_input_queue = worker_input_queue
         self.aggregator = aggregator
         self.logger = logger.getLogger(subsystem="mqtt")
@@ -30,8 +61,18 @@ class MqttListenerClient(object):
         self.host = host
         self.port = port
         self.log_all_messages = log_all_messages
+        self.topic_filters = topic_filters or DEFAULT_TOPIC_FILTERS
+        self.qos = qos
+        # MqttCapture keeping the raw messages, cheaper than log_all_messages
+        self.capture = capture
+        # StateUpdateCoalescer between the parsed messages and the worker input queue
+        self.coalescer = coalescer
+        self.topic_router = TopicRouter()
+        for topic_filter in self.topic_filters:
+            self.topic_router.add_route(
+                topic_filter, TOPIC_FILTER_PARSERS.get(topic_filter, parse_message)
+            )
         self.client.connect(host, port)
-        self.msg_deduplication = {}
 
     def start_listening_on_a_background_thread(self):
         self.client.loop_start()
@@ -41,46 +82,59 @@ class MqttListenerClient(object):
         self.client.loop_stop()
 
     def _on_connect(self, client, userdata, flags, rc):
-        self.logger.info(f"Connected to {self.host}:{self.port}")
-        self.client.subscribe([("#", 0)])
+        self.logger.info("Connected to %s:%s", self.host, self.port)
+        self.client.subscribe(
+            [(topic_filter, self.qos) for topic_filter in self.topic_filters]
+        )
 
     def _on_message(self, client, userdata, msg):
         logger = self.logger.getLoggerWithRandomReqId("mqtt")
         try:
+            if self.capture:
+                self.capture.record(msg.topic, msg.payload)
             try:
                 msg_str = msg.payload.decode("utf-8", "backslashreplace")
             except UnicodeDecodeError:
                 logger.error(
-                    f"Received message, but cannot decode UTF-8: {repr(msg.payload)}"
+                    "Received message, but cannot decode UTF-8: %r", msg.payload
                 )
                 return
             if self.log_all_messages:
-                logger.info(f"RAW: {repr((msg.topic, msg_str))}")
-            parsed_result = parse_message(msg.topic, msg_str)
+                logger.info("RAW: %r", (msg.topic, msg_str))
+            parse_function = self.topic_router.get_handler(msg.topic)
+            if parse_function is None:
+                logger.error("Received message on unsubscribed topic %s", msg.topic)
+                return
+            start = time.perf_counter()
+            parsed_result = parse_function(msg.topic, msg_str)
+            MQTT_PARSE_DURATION.observe(time.perf_counter() - start)
             if parsed_result:
                 if self.log_all_messages:
-                    logger.info(f"PARSED: {repr(parsed_result)}")
+                    logger.info("PARSED: %r", parsed_result)
                 msg_type = parsed_result[0]
+                MQTT_MESSAGES_PARSED.inc(msg_type or "none")
                 if msg_type and msg_type != "ignore":
                     self._process_parsed_message(parsed_result, logger)
             else:
-                logger.error(f"Cannot parse message: {msg.topic} - {msg_str}")
+                MQTT_MESSAGES_PARSED.inc("unparsed")
+                logger.error("Cannot parse message: %s - %s", msg.topic, msg_str)
         except Exception as e:
             logger.error("Error in _on_message handler", exc_info=e)
 
     def _process_parsed_message(self, parsed_result, logger):
         msg_type, *args = parsed_result
-        if msg_type in MESSAGE_TYPES_TO_DEDUPLICATE:
-            last_parsed_message = self.msg_deduplication.get(msg_type)
-            if parsed_result == last_parsed_message:
-                # Skipping this message because last time it was identical (and we know these messages are idempotent)
-                return
-            else:
-                self.msg_deduplication[msg_type] = parsed_result
-
         method = getattr(self.aggregator, msg_type, None)
         if method:
             aggregator_function = functools.partial(method, *args)
-            self.worker_input_queue.add_task(aggregator_function, logger)
+            if self.coalescer:
+                self.coalescer.add(msg_type, args, aggregator_function, logger)
+                return
+            self.worker_input_queue.add_task(
+                aggregator_function,
+                logger,
+                get_partition_key(msg_type, args),
+                msg_type,
+                get_coalescing_key(msg_type, args),
+            )
         else:
-            logger.error(f"Missing method {msg_type} in {self.aggregator}")
+            logger.error("Missing method %s in %s", msg_type, self.aggregator)
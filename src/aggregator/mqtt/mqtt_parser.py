@@ -1,120 +1,48 @@
 import json
 import re
 
+# The parser runs for every message on the broker, so the rules below are plain tables,
+# compiled once at import into dict lookups and a few regular expressions.
+
+IGNORE = ("ignore",)
+
 MACHINE_TAG_RE = re.compile(r"(?:ac|test)\/log\/(.*)")
 
+# "{machine_name} {message}" -> power state
+MACHINE_POWER_MESSAGES = {
+    "Machine switched ON with the safety contacto green on-button.": "on",
+    "Green button on safety contactor pressed.": "on",
+    "Switched on - green button at the back pressed.": "on",
+    "Machine switched OFF with the safety contactor off-button.": "off",
+    "Switching off - red button at the back pressed.": "off",
+    "Switching off - card swiped but the green button was not pressed within 120 seconds.": "off",
+    "Switching off - red button at the back pressed - while running - BAD !": "off",
+    "Machine idle for too long - switching off.": "off",
+    "Machine switched OFF with the off-button.": "off",
+}
 
-def parse_message(topic, message):
-    if topic == "makerspace/groteschakelaar":
-        return "space_open", message == "1"
-    if topic == "makerspace/groteschakelaar/status":
-        return "space_open", message == "open"
-    if topic == "makerspace/groteschakelaar/status/" and message == "werkend":
-        return ("ignore",)
-
-    if topic == "ac/log/master" and message.startswith("JSON="):
-        payload = json.loads(message[5:])
-        if (
-            payload.get("userid", None)
-            and (payload.get("machine", None) in ["spacedeur", "byebye"])
-            and payload.get("acl", None) == "approved"
-            and payload.get("cmd", None) == "leave"
-        ):
-            return "user_left_space", payload["userid"]
-        elif (
-            payload.get("userid", None)
-            and payload.get("machine", None) == "spacedeur"
-            and payload.get("acl", None) == "approved"
-            and payload.get("cmd", None) == "energize"
-        ):
-            return "user_entered_space", payload["userid"]
-        elif (
-            payload.get("userid", None)
-            and payload.get("machine", None)
-            and payload.get("acl", None) == "approved"
-        ):
-            return "user_activated_machine", payload["userid"], payload["machine"]
-        return "ignore"
-
-    if topic == "test/log/lights" and message.startswith("lights {"):
-        payload = json.loads(message[7:])
-        if (
-            payload.get("machine", None) == "lights"
-            and payload.get("state", None) == "Powered - no lights"
-        ):
-            return "lights", "large_room", False
-        if (
-            payload.get("machine", None) == "lights"
-            and payload.get("state", None) == "Lights are ON"
-        ):
-            return "lights", "large_room", True
+# "{machine_name} {json}" -> machine state, from the "state" field of the JSON
+MACHINE_STATES = {
+    "Waiting for card": "ready",
+    "Powered - but idle": "powered_idle",
+    "Running": "powered_running",
+    "Door held open": "door_held_open",
+    "Opening door": "door_opening",
+    "Closing door": "door_closing",
+    "Compressor runnning": "compressor_running",
+    "Powered - compressor off": "compressor_off",
+    "Lights are ON": "lights_on",
+    "Powered - no lights": "lights_off",
+    "Buzzing door": "buzzing_door",
+    "Out of order": "out_of_order",
+    "Contactor Enabled": "contactor_enabled",
+}
 
-    machine_match = MACHINE_TAG_RE.match(topic)
-    if machine_match:
-        machine_name = machine_match.group(1)
-        if message.startswith(machine_name) and message.endswith("Connected."):
-            return ("ignore",)
-        if (
-            message
-            == f"{machine_name} Machine switched ON with the safety contacto green on-button."
-        ):
-            return "machine_power", machine_name, "on"
-        if message == f"{machine_name} Green button on safety contactor pressed.":
-            return "machine_power", machine_name, "on"
-        if message == f"{machine_name} Switched on - green button at the back pressed.":
-            return "machine_power", machine_name, "on"
-        if (
-            message
-            == f"{machine_name} Machine switched OFF with the safety contactor off-button."
-        ):
-            return "machine_power", machine_name, "off"
-        if message == f"{machine_name} Switching off - red button at the back pressed.":
-            return "machine_power", machine_name, "off"
-        if (
-            message
-            == f"{machine_name} Switching off - card swiped but the green button was not pressed within 120 seconds."
-        ):
-            return "machine_power", machine_name, "off"
-        if (
-            message
-            == f"{machine_name} Switching off - red button at the back pressed - while running - BAD !"
-        ):
-            return "machine_power", machine_name, "off"
-        if message == f"{machine_name} Machine idle for too long - switching off.":
-            return "machine_power", machine_name, "off"
-        if message == f"{machine_name} Machine switched OFF with the off-button.":
-            return "machine_power", machine_name, "off"
-        if message.startswith(f"{machine_name} {{"):
-            payload = json.loads(message[len(machine_name) + 1 :])
-            if payload["state"] == "Waiting for card":
-                return "machine_state", machine_name, "ready"
-            if payload["state"] == "Powered - but idle":
-                return "machine_state", machine_name, "powered_idle"
-            if payload["state"] == "Running":
-                return "machine_state", machine_name, "powered_running"
-            if payload["state"] == "Door held open":
-                return "machine_state", machine_name, "door_held_open"
-            if payload["state"] == "Opening door":
-                return "machine_state", machine_name, "door_opening"
-            if payload["state"] == "Closing door":
-                return "machine_state", machine_name, "door_closing"
-            if payload["state"] == "Compressor runnning":
-                return "machine_state", machine_name, "compressor_running"
-            if payload["state"] == "Powered - compressor off":
-                return "machine_state", machine_name, "compressor_off"
-            if payload["state"] == "Lights are ON":
-                return "machine_state", machine_name, "lights_on"
-            if payload["state"] == "Powered - no lights":
-                return "machine_state", machine_name, "lights_off"
-            if payload["state"] == "Buzzing door":
-                return "machine_state", machine_name, "buzzing_door"
-            if payload["state"] == "Out of order":
-                return "machine_state", machine_name, "out_of_order"
-            if payload["state"] == "Contactor Enabled":
-                return "machine_state", machine_name, "contactor_enabled"
-
-    # Message to ignore
-    if (topic, message) in (
+# -- Messages to ignore ----
+
+IGNORED_MESSAGES = frozenset(
+    [
+        ("makerspace/groteschakelaar/status/", "werkend"),
         ("makerspace/grotelasercutter", "offline"),
         ("makerspace/kleinelasercutter", "offline"),
         ("makerspace/switch", "online"),
@@ -134,46 +62,28 @@ def parse_message(topic, message):
             "ac/log/woodlathe",
             "woodlathe Very strange - current observed while we are 'off'. Should not happen.",
         ),
-    ):
-        return ("ignore",)
+    ]
+)
 
-    if topic in (
+IGNORED_TOPICS = frozenset(
+    [
         "makerspace/deur/voor",
         "makerspace/deur/tussen",
         "makerspace/deur/space2",
-    ):
-        return ("ignore",)
-
-    if topic == "ac/log/voordeur" and message.startswith("voordeur {"):
-        return ("ignore",)
-
-    if topic == "makerspace/grotelasercutter":
-        return ("ignore",)
-
-    if message.startswith("SIG/2.0 ") and (
-        message.endswith(" beat")
-        or " announce " in message
-        or " welcome " in message
-        or " energize "
-    ):
-        return ("ignore",)
-
-    if topic == "test/master/exhaustnode" and "event manual-start" in message:
-        return ("ignore",)
+        "makerspace/grotelasercutter",
+    ]
+)
 
-    if topic == "test/master/exhaustnode" and "event manual-stop" in message:
-        return ("ignore",)
-
-    if topic == "ac/log/master" and message.startswith("Announce of"):
-        return ("ignore",)
-
-    for substring in MESAGES_TO_IGNORE:
-        if substring in message:
-            return ("ignore",)
-
-    if topic == "ac/log/master" and "not found either DB" in message:
-        return ("ignore",)
+# topic -> (message prefixes, message substrings)
+MESSAGES_TO_IGNORE_BY_TOPIC = {
+    "ac/log/voordeur": (["voordeur {"], []),
+    "ac/log/master": (["Announce of"], ["not found either DB"]),
+    "test/master/exhaustnode": ([], ["event manual-start", "event manual-stop"]),
+}
 
+MESSAGE_PREFIXES_TO_IGNORE = [
+    "SIG/2.0 ",
+]
 
 MESAGES_TO_IGNORE = [
     "Time warp by",
@@ -211,3 +121,147 @@ MESAGES_TO_IGNORE = [
     "lights ",
     "{",
 ]
+
+
+def _compile_ignore_re(prefixes, substrings):
+    # A single alternation, so that all the patterns are matched in one scan of the message
+    return re.compile(
+        "|".join(
+            [f"^{re.escape(prefix)}" for prefix in prefixes]
+            + [re.escape(substring) for substring in substrings]
+        )
+    )
+
+
+IGNORED_MESSAGES_RE = _compile_ignore_re(MESSAGE_PREFIXES_TO_IGNORE, MESAGES_TO_IGNORE)
+
+IGNORED_MESSAGES_BY_TOPIC_RE = dict(
+    (topic, _compile_ignore_re(prefixes, substrings))
+    for topic, (prefixes, substrings) in MESSAGES_TO_IGNORE_BY_TOPIC.items()
+)
+
+
+# -- Parsing ----
+
+
+def parse_message(topic, message):
+    topic_parser = TOPIC_PARSERS.get(topic)
+    if topic_parser:
+        parsed_message = topic_parser(message)
+        if parsed_message:
+            return parsed_message
+
+    machine_match = MACHINE_TAG_RE.match(topic)
+    if machine_match:
+        parsed_message = _parse_machine_message(machine_match.group(1), message)
+        if parsed_message:
+            return parsed_message
+
+    if _is_message_to_ignore(topic, message):
+        return IGNORE
+
+
+def _parse_space_switch(message):
+    return "space_open", message == "1"
+
+
+def _parse_space_switch_status(message):
+    return "space_open", message == "open"
+
+
+def _parse_master_log(message):
+    if not message.startswith("JSON="):
+        return None
+    payload = json.loads(message[5:])
+    if (
+        payload.get("userid", None)
+        and (payload.get("machine", None) in ["spacedeur", "byebye"])
+        and payload.get("acl", None) == "approved"
+        and payload.get("cmd", None) == "leave"
+    ):
+        return "user_left_space", payload["userid"]
+    elif (
+        payload.get("userid", None)
+        and payload.get("machine", None) == "spacedeur"
+        and payload.get("acl", None) == "approved"
+        and payload.get("cmd", None) == "energize"
+    ):
+        return "user_entered_space", payload["userid"]
+    elif (
+        payload.get("userid", None)
+        and payload.get("machine", None)
+        and payload.get("acl", None) == "approved"
+    ):
+        return "user_activated_machine", payload["userid"], payload["machine"]
+    return IGNORE
+
+
+def _parse_lights_log(message):
+    if not message.startswith("lights {"):
+        return None
+    payload = json.loads(message[7:])
+    if payload.get("machine", None) == "lights":
+        if payload.get("state", None) == "Powered - no lights":
+            return "lights", "large_room", False
+        if payload.get("state", None) == "Lights are ON":
+            return "lights", "large_room", True
+    return None
+
+
+TOPIC_PARSERS = {
+    "makerspace/groteschakelaar": _parse_space_switch,
+    "makerspace/groteschakelaar/status": _parse_space_switch_status,
+    "ac/log/master": _parse_master_log,
+    "test/log/lights": _parse_lights_log,
+}
+
+
+def parse_space_switch_message(topic, message):
+    # Messages on the space switch topics are never machine messages
+    topic_parser = TOPIC_PARSERS.get(topic)
+    if topic_parser:
+        parsed_message = topic_parser(message)
+        if parsed_message:
+            return parsed_message
+    if _is_message_to_ignore(topic, message):
+        return IGNORE
+
+
+# Topic filters to subscribe to: every other topic only carries messages that parse_message ignores
+DEFAULT_TOPIC_FILTERS = [
+    "makerspace/groteschakelaar/#",
+    "ac/log/#",
+    "test/log/#",
+]
+
+# Topic filter -> parser for the messages received through it. Other filters use parse_message.
+TOPIC_FILTER_PARSERS = {
+    "makerspace/groteschakelaar/#": parse_space_switch_message,
+}
+
+
+def _parse_machine_message(machine_name, message):
+    if message.startswith(machine_name) and message.endswith("Connected."):
+        return IGNORE
+    if not (
+        message.startswith(machine_name) and message.startswith(" ", len(machine_name))
+    ):
+        return None
+    machine_message = message[len(machine_name) + 1 :]
+    power = MACHINE_POWER_MESSAGES.get(machine_message)
+    if power:
+        return "machine_power", machine_name, power
+    if machine_message.startswith("{"):
+        state = json.loads(machine_message)["state"]
+        if isinstance(state, str) and state in MACHINE_STATES:
+            return "machine_state", machine_name, MACHINE_STATES[state]
+    return None
+
+
+def _is_message_to_ignore(topic, message):
+    if (topic, message) in IGNORED_MESSAGES or topic in IGNORED_TOPICS:
+        return True
+    ignored_messages_re = IGNORED_MESSAGES_BY_TOPIC_RE.get(topic)
+    if ignored_messages_re and ignored_messages_re.search(message):
+        return True
+    return bool(IGNORED_MESSAGES_RE.search(message))
@@ -1,10 +1,16 @@
+import glob
 import os
 import unittest
 
+from .capture import CAPTURE_FILE_EXTENSION, read_binary_capture
 from .mqtt_parser import parse_message
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 SAMPLE_FILES = ["sample_mqtt_messages.txt", "sample_mqtt_messages2.txt"]
+# Captures written by MqttCapture can be dropped next to this file
+SAMPLE_CAPTURE_FILE_PATHS = sorted(
+    glob.glob(os.path.join(DIR_PATH, "*" + CAPTURE_FILE_EXTENSION))
+)
 
 MISCELLANEOUS_ERRORS_IN_LOGS_3_MAR_2019_FILE_PATH = os.path.join(
     DIR_PATH, "errors_3_mar_2019.txt"
@@ -84,6 +90,15 @@ class TestMqttParsing(unittest.TestCase):
             ("machine_power", "planer", "off"),
         )
 
+    def test_unmatched_master_json_is_ignored(self):
+        self.assertEqual(
+            parse_message(
+                "ac/log/master",
+                'JSON={"ok": false, "userid": 22, "machine": "tablesaw", "acl": "denied"}',
+            ),
+            ("ignore",),
+        )
+
     def test_lights(self):
         self.assertEqual(
             parse_message(
@@ -118,6 +133,15 @@ class TestMqttParsing(unittest.TestCase):
                 ):
                     print(parsed_message)
 
+    def test_sample_captures(self):
+        for file_path in SAMPLE_CAPTURE_FILE_PATHS:
+            for message in read_binary_capture(file_path):
+                payload = message.payload.decode("utf-8", "backslashreplace")
+                self.assertIsNotNone(
+                    parse_message(message.topic, payload),
+                    f"Unable to parse message: ({repr(message.topic)}, {repr(payload)}) in {file_path}",
+                )
+
     def test_miscellaneous_errors_in_logs_3_mar_2019(self):
         for line in open(MISCELLANEOUS_ERRORS_IN_LOGS_3_MAR_2019_FILE_PATH).readlines():
             topic, message = line.strip()[
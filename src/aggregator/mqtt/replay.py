@@ -0,0 +1,217 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import paho.mqtt.client as mqtt
+
+from ..communication import DEFAULT_PARTITION, WorkerInputQueue
+from ..utils import percentile
+from .capture import CapturedMessage, is_binary_capture, read_binary_capture
+
+# Replays recorded MQTT traffic through the ingest path:
+# MqttListenerClient._on_message -> parser -> WorkerInputQueue -> Worker -> Aggregator.
+#
+# A capture is either a binary file written by MqttCapture, or a JSONL file with one
+# {"topic": ..., "payload": ..., "ts": ...} object per line, where payload is the message text
+# and ts the time of reception in seconds.
+
+RECEIVE = "receive"
+PARSE = "parse"
+QUEUE_WAIT = "queue_wait"
+AGGREGATOR = "aggregator"
+END_TO_END = "end_to_end"
+
+STAGES = [RECEIVE, PARSE, QUEUE_WAIT, AGGREGATOR, END_TO_END]
+
+
+def read_capture(file_path):
+    if is_binary_capture(file_path):
+        return read_binary_capture(file_path)
+    messages = []
+    with open(file_path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                messages.append(
+                    CapturedMessage(
+                        record["topic"],
+                        record["payload"].encode("utf-8"),
+                        float(record["ts"]),
+                    )
+                )
+    return messages
+
+
+def write_capture(file_path, messages):
+    with open(file_path, "w", encoding="utf-8") as f:
+        for message in messages:
+            record = {
+                "topic": message.topic,
+                "payload": message.payload.decode("utf-8", "backslashreplace"),
+                "ts": message.ts,
+            }
+            f.write(json.dumps(record) + "\n")
+
+
+class StageTimings(object):
+    """
+    Durations in seconds for every stage of the ingest path, plus the worker queue depth
+    seen at every enqueue. Shared between the replaying thread and the worker thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = dict((stage, []) for stage in STAGES)
+        self.queue_depths = []
+        self.current_message = threading.local()
+
+    def record(self, stage, duration):
+        with self.lock:
+            self.durations[stage].append(duration)
+
+    def record_queue_depth(self, depth):
+        with self.lock:
+            self.queue_depths.append(depth)
+
+    def start_message(self):
+        self.current_message.received_at = time.perf_counter()
+
+    def message_received_at(self):
+        return getattr(self.current_message, "received_at", None)
+
+    def get_percentiles(self, stage, fractions=(0.5, 0.95, 0.99)):
+        with self.lock:
+            durations = sorted(self.durations[stage])
+        return [percentile(durations, fraction) for fraction in fractions] + [
+            durations[-1] if durations else None
+        ]
+
+    def get_max_queue_depth(self):
+        with self.lock:
+            return max(self.queue_depths, default=0)
+
+
+class InProcessBroker(object):
+    """
+    Stands in for paho's mqtt.Client, delivering published messages synchronously
+    to the on_message callback if they match one of the subscribed topic filters.
+    """
+
+    def __init__(self, stage_timings):
+        self.stage_timings = stage_timings
+        self.on_connect = None
+        self.on_message = None
+        self.topic_filters = []
+        self.num_delivered = 0
+        self.num_filtered = 0
+
+    def connect(self, host, port):
+        pass
+
+    def subscribe(self, topics):
+        self.topic_filters.extend(topic_filter for topic_filter, qos in topics)
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def publish(self, topic, payload):
+        if not any(
+            mqtt.topic_matches_sub(topic_filter, topic)
+            for topic_filter in self.topic_filters
+        ):
+            self.num_filtered += 1
+            return
+        msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+        msg.payload = payload
+        self.stage_timings.start_message()
+        self.on_message(self, None, msg)
+        self.stage_timings.record(
+            RECEIVE, time.perf_counter() - self.stage_timings.message_received_at()
+        )
+        self.num_delivered += 1
+
+
+@contextmanager
+def broker_stand_in(broker):
+    # The MQTT client creates its paho client in the constructor
+    client_class = mqtt.Client
+    mqtt.Client = lambda: broker
+    try:
+        yield broker
+    finally:
+        mqtt.Client = client_class
+
+
+class InstrumentedWorkerInputQueue(WorkerInputQueue):
+    def __init__(self, asyncio_loop, stage_timings, max_pending_per_partition=0):
+        super().__init__(asyncio_loop, max_pending_per_partition)
+        self.stage_timings = stage_timings
+
+    def add_task(
+        self,
+        task,
+        logger,
+        partition_key=DEFAULT_PARTITION,
+        message_class=None,
+        coalescing_key=None,
+    ):
+        stage_timings = self.stage_timings
+        received_at = stage_timings.message_received_at()
+        enqueued_at = time.perf_counter()
+
+        def timed_task(logger):
+            started_at = time.perf_counter()
+            stage_timings.record(QUEUE_WAIT, started_at - enqueued_at)
+            try:
+                return task(logger)
+            finally:
+                finished_at = time.perf_counter()
+                stage_timings.record(AGGREGATOR, finished_at - started_at)
+                if received_at is not None:
+                    stage_timings.record(END_TO_END, finished_at - received_at)
+
+        outcome = super().add_task(
+            timed_task, logger, partition_key, message_class, coalescing_key
+        )
+        stage_timings.record_queue_depth(self.queue.qsize())
+        return outcome
+
+
+def instrument_parsers(mqtt_listener_client, stage_timings):
+    def timed(parse_function):
+        def timed_parse_function(topic, message):
+            start = time.perf_counter()
+            try:
+                return parse_function(topic, message)
+            finally:
+                stage_timings.record(PARSE, time.perf_counter() - start)
+
+        return timed_parse_function
+
+    topic_router = mqtt_listener_client.topic_router
+    topic_router.routes = [
+        (topic_filter, timed(parse_function))
+        for topic_filter, parse_function in topic_router.routes
+    ]
+    topic_router.handlers_by_topic.clear()
+
+
+def replay(messages, broker, speed=None):
+    """
+    Publish the messages on the broker, spaced as in the capture divided by speed
+    (1 for the original speed), or as fast as possible when speed is None.
+    Returns the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    first_ts = messages[0].ts if messages else 0
+    for message in messages:
+        if speed:
+            delay = (message.ts - first_ts) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        broker.publish(message.topic, message.payload)
+    return time.perf_counter() - start
@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+
+from ..testing_utils import STEFANO, TABLE_SAW, AggregatorBaseTestSuite
+from ..worker import Worker
+from .mqtt_client import MqttListenerClient
+from .replay import (
+    AGGREGATOR,
+    END_TO_END,
+    PARSE,
+    QUEUE_WAIT,
+    RECEIVE,
+    CapturedMessage,
+    InProcessBroker,
+    InstrumentedWorkerInputQueue,
+    StageTimings,
+    broker_stand_in,
+    instrument_parsers,
+    percentile,
+    read_capture,
+    replay,
+    write_capture,
+)
+
+CAPTURE = [
+    CapturedMessage("makerspace/groteschakelaar", b"1", 1000.0),
+    CapturedMessage(
+        "ac/log/master",
+        (
+            'JSON={"ok": true, "userid": %d, "machine": "spacedeur", "acl": "approved", "cmd": "energize"}'
+            % STEFANO.user_id
+        ).encode("utf-8"),
+        1000.5,
+    ),
+    CapturedMessage(
+        "test/log/tablesaw",
+        b'tablesaw {"machine":"tablesaw","state":"Powered - but idle"}',
+        1001.0,
+    ),
+    CapturedMessage("makerspace/vogelkooi/chirp", b"0", 1001.5),
+]
+
+
+class TestReplay(AggregatorBaseTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.stage_timings = StageTimings()
+        self.worker_input_queue = InstrumentedWorkerInputQueue(None, self.stage_timings)
+        self.broker = InProcessBroker(self.stage_timings)
+        with broker_stand_in(self.broker):
+            self.mqtt_listener_client = MqttListenerClient(
+                self.worker_input_queue,
+                self.aggregator,
+                self.logger,
+                None,
+                None,
+                False,
+            )
+        instrument_parsers(self.mqtt_listener_client, self.stage_timings)
+        self.mqtt_listener_client.start_listening_on_a_background_thread()
+        Worker(self.worker_input_queue).start_working_in_background_thread()
+
+    def test_capture_round_trip(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            file_path = os.path.join(dir_path, "capture.jsonl")
+            write_capture(file_path, CAPTURE)
+            with open(file_path) as f:
+                self.assertEqual(json.loads(f.readline())["payload"], "1")
+            self.assertEqual(read_capture(file_path), CAPTURE)
+
+    def test_replay_through_the_ingest_path(self):
+        replay(CAPTURE, self.broker)
+        self.worker_input_queue.wait_until_empty()
+
+        self.assertEqual(self.broker.num_delivered, 3)
+        self.assertEqual(self.broker.num_filtered, 1)
+        self.assertTrue(self.redis_adapter.get_space_open(self.logger))
+        self.assertEqual(
+            [
+                user_id
+                for user_id, _ in self.redis_adapter.get_user_ids_in_space_with_timestamps(
+                    self.logger
+                )
+            ],
+            [STEFANO.user_id],
+        )
+        self.assertEqual(
+            self.redis_adapter.get_machine_state(
+                TABLE_SAW.node_machine_name, self.logger
+            ),
+            "powered_idle",
+        )
+        for stage in (RECEIVE, PARSE, QUEUE_WAIT, AGGREGATOR, END_TO_END):
+            self.assertEqual(len(self.stage_timings.durations[stage]), 3, stage)
+        self.assertEqual(len(self.stage_timings.queue_depths), 3)
+
+    def test_replay_keeps_the_original_spacing(self):
+        elapsed = replay(CAPTURE[:2], self.broker, speed=10)
+        self.assertGreaterEqual(elapsed, 0.05)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 100)
+        self.assertIsNone(percentile([], 0.5))
@@ -0,0 +1,154 @@
+import functools
+import threading
+import time
+
+from ..communication import DROPPED as QUEUE_DROPPED
+from ..metrics import REGISTRY
+from .mqtt_client import get_coalescing_key, get_partition_key
+
+MACHINE_STATE = "machine_state"
+
+# What happened to a state update
+APPLIED = "applied"  # Sent to the worker
+COALESCED = "coalesced"  # Outdated by a later one before being sent
+DUPLICATE = "duplicate"  # Same as the last one sent, dropped
+REFRESHED = "refreshed"  # Same machine state as the last one sent, expiration refreshed
+DROPPED = "dropped"  # Dropped by the worker input queue, full
+
+STATE_UPDATES = REGISTRY.counter(
+    "aggregator_mqtt_state_updates_total",
+    "Idempotent MQTT state updates, by what the coalescer did with them",
+    ("outcome",),
+)
+
+
+class StateUpdateCoalescer(object):
+    """
+    Sits between the MQTT client and the worker input queue, for the messages setting a
+    piece of the state, like machine_state, lights and space_open: the nodes repeat them
+    every few seconds, and each one would otherwise be a Redis write.
+
+    Only the latest state of every piece is kept until the next flush, and only sent to the
+    worker when it differs from the last one sent. A repeated state is sent again after
+    refresh_interval_in_sec, except for machine states: they are refreshed for all the
+    machines at once, which only writes the states lost meanwhile.
+
+    Other messages go to the worker right away, after the pending states of their partition.
+    They make the next state of the partition count as new, because the state can mean
+    something else then: e.g. a machine "ready" after it was powered on turns it off.
+    """
+
+    def __init__(
+        self,
+        aggregator,
+        worker_input_queue,
+        flush_interval_in_sec=0.5,
+        refresh_interval_in_sec=300,
+        time_function=time.monotonic,
+    ):
+        self.aggregator = aggregator
+        self.worker_input_queue = worker_input_queue
+        self.flush_interval_in_sec = flush_interval_in_sec
+        self.refresh_interval_in_sec = refresh_interval_in_sec
+        self.time_function = time_function
+        self.lock = threading.Lock()
+        # Coalescing key -> (msg_type, args, task, logger, partition key), not sent yet
+        self.pending = {}
+        # Coalescing key -> (args, partition key, sent or refreshed at)
+        self.sent = {}
+        # Machine -> state, to be refreshed with the next flush
+        self.states_to_refresh = {}
+        self.stopping = threading.Event()
+        self.thread = None
+        self.stats = {APPLIED: 0, COALESCED: 0, DUPLICATE: 0, REFRESHED: 0, DROPPED: 0}
+
+    def add(self, msg_type, args, task, logger):
+        """
+        To be called for every parsed message, from the MQTT thread.
+        """
+        coalescing_key = get_coalescing_key(msg_type, args)
+        partition_key = get_partition_key(msg_type, args)
+        with self.lock:
+            if coalescing_key is None:
+                self._flush_partition(partition_key)
+                self.worker_input_queue.add_task(task, logger, partition_key, msg_type)
+                return
+            if self.pending.pop(coalescing_key, None):
+                self._count(COALESCED)
+            now = self.time_function()
+            sent = self.sent.get(coalescing_key)
+            if sent and sent[0] == args:
+                sent_args, _, sent_at = sent
+                if now - sent_at < self.refresh_interval_in_sec:
+                    self._count(DUPLICATE)
+                    return
+                if msg_type == MACHINE_STATE:
+                    self.states_to_refresh[args[0]] = args[1]
+                    self.sent[coalescing_key] = (sent_args, partition_key, now)
+                    self._count(REFRESHED)
+                    return
+            self.pending[coalescing_key] = (msg_type, args, task, logger, partition_key)
+
+    def flush(self, logger):
+        with self.lock:
+            for coalescing_key in list(self.pending):
+                self._send(coalescing_key)
+            if self.states_to_refresh:
+                states = self.states_to_refresh
+                self.states_to_refresh = {}
+                self.worker_input_queue.add_task(
+                    functools.partial(self.aggregator.refresh_machine_states, states),
+                    logger,
+                    "refresh_machine_states",
+                )
+
+    def _flush_partition(self, partition_key):
+        for coalescing_key, (_, _, _, _, pending_partition_key) in list(
+            self.pending.items()
+        ):
+            if pending_partition_key == partition_key:
+                self._send(coalescing_key)
+        for coalescing_key, (_, sent_partition_key, _) in list(self.sent.items()):
+            if sent_partition_key == partition_key:
+                del self.sent[coalescing_key]
+
+    def _send(self, coalescing_key):
+        msg_type, args, task, logger, partition_key = self.pending.pop(coalescing_key)
+        outcome = self.worker_input_queue.add_task(
+            task, logger, partition_key, msg_type, coalescing_key
+        )
+        if outcome == QUEUE_DROPPED:
+            # Not applied, so a repetition must not be taken for a duplicate
+            self.sent.pop(coalescing_key, None)
+            self._count(DROPPED)
+        else:
+            self.sent[coalescing_key] = (args, partition_key, self.time_function())
+            self._count(APPLIED)
+
+    def _count(self, outcome):
+        self.stats[outcome] += 1
+        STATE_UPDATES.inc(outcome)
+
+    def start_flushing_in_background_thread(self, logger):
+        logger = logger.getLogger(subsystem="state_coalescer")
+        self.thread = threading.Thread(target=self._flush_continuously, args=(logger,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def _flush_continuously(self, logger):
+        while not self.stopping.wait(self.flush_interval_in_sec):
+            try:
+                self.flush(logger)
+            except Exception:
+                logger.exception("Cannot flush the state updates")
+        self.flush(logger)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, pending=len(self.pending))
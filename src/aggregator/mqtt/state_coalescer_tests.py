@@ -0,0 +1,176 @@
+import functools
+import unittest
+
+from ..communication import DROPPED, QUEUED
+from ..testing_utils import AggregatorBaseTestSuite
+from .state_coalescer import StateUpdateCoalescer
+
+
+class MockTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingWorkerInputQueue(object):
+    def __init__(self):
+        self.tasks = []
+        self.full = False
+
+    def add_task(
+        self, task, logger, partition_key, message_class=None, coalescing_key=None
+    ):
+        if self.full:
+            return DROPPED
+        self.tasks.append((task.func.__name__, *task.args))
+        return QUEUED
+
+
+class MockAggregator(object):
+    def __getattr__(self, name):
+        def method(*args):
+            pass
+
+        method.__name__ = name
+        return method
+
+
+class TestStateUpdateCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.time = MockTime()
+        self.aggregator = MockAggregator()
+        self.worker_input_queue = RecordingWorkerInputQueue()
+        self.coalescer = StateUpdateCoalescer(
+            self.aggregator,
+            self.worker_input_queue,
+            refresh_interval_in_sec=60,
+            time_function=self.time,
+        )
+        self.logger = None
+
+    def add(self, msg_type, *args):
+        task = functools.partial(getattr(self.aggregator, msg_type), *args)
+        self.coalescer.add(msg_type, list(args), task, self.logger)
+
+    def flush(self):
+        self.coalescer.flush(self.logger)
+        tasks = self.worker_input_queue.tasks
+        self.worker_input_queue.tasks = []
+        return tasks
+
+    def test_only_the_latest_changed_state_is_sent(self):
+        for state in ("ready", "running", "ready"):
+            self.add("machine_state", "tablesaw", state)
+        self.add("lights", "large_room", True)
+        self.add("space_open", True)
+        self.assertEqual(
+            self.flush(),
+            [
+                ("machine_state", "tablesaw", "ready"),
+                ("lights", "large_room", True),
+                ("space_open", True),
+            ],
+        )
+
+        self.add("machine_state", "tablesaw", "ready")
+        self.add("machine_state", "lathe", "ready")
+        self.add("space_open", False)
+        self.add("space_open", True)
+        self.assertEqual(self.flush(), [("machine_state", "lathe", "ready")])
+
+        stats = self.coalescer.get_stats()
+        self.assertEqual(stats["applied"], 4)
+        self.assertEqual(stats["coalesced"], 3)
+        self.assertEqual(stats["duplicate"], 2)
+
+    def test_unchanged_states_are_refreshed(self):
+        self.add("machine_state", "tablesaw", "ready")
+        self.add("machine_state", "lathe", "ready")
+        self.add("lights", "large_room", True)
+        self.flush()
+
+        self.time.now += 60
+        self.add("machine_state", "tablesaw", "ready")
+        self.add("machine_state", "lathe", "ready")
+        self.add("lights", "large_room", True)
+        self.assertEqual(
+            self.flush(),
+            [
+                ("lights", "large_room", True),
+                ("refresh_machine_states", {"tablesaw": "ready", "lathe": "ready"}),
+            ],
+        )
+
+        self.time.now += 30
+        self.add("machine_state", "tablesaw", "ready")
+        self.assertEqual(self.flush(), [])
+        self.assertEqual(self.coalescer.get_stats()["refreshed"], 2)
+
+    def test_other_messages_keep_their_order_in_the_partition(self):
+        self.add("machine_state", "tablesaw", "ready")
+        self.flush()
+
+        self.add("machine_state", "tablesaw", "running")
+        self.add("machine_state", "lathe", "running")
+        self.add("machine_power", "tablesaw", "on")
+        # Now means that the machine was left on
+        self.add("machine_state", "tablesaw", "ready")
+        self.assertEqual(
+            self.worker_input_queue.tasks,
+            [
+                ("machine_state", "tablesaw", "running"),
+                ("machine_power", "tablesaw", "on"),
+            ],
+        )
+        self.assertEqual(
+            self.flush()[2:],
+            [
+                ("machine_state", "lathe", "running"),
+                ("machine_state", "tablesaw", "ready"),
+            ],
+        )
+
+    def test_states_dropped_by_the_queue_are_sent_again(self):
+        self.worker_input_queue.full = True
+        self.add("machine_state", "tablesaw", "ready")
+        self.assertEqual(self.flush(), [])
+        self.worker_input_queue.full = False
+
+        self.add("machine_state", "tablesaw", "ready")
+        self.assertEqual(self.flush(), [("machine_state", "tablesaw", "ready")])
+        stats = self.coalescer.get_stats()
+        self.assertEqual((stats["applied"], stats["dropped"]), (1, 1))
+
+
+class TestRefreshMachineStates(AggregatorBaseTestSuite):
+    def test_expiration_is_pushed_back(self):
+        self.aggregator.machine_state("tablesaw", "ready", self.logger)
+        key = self.redis_adapter._k_machine_state("tablesaw")
+        self.redis_adapter.redis.expire(key, 10)
+
+        self.aggregator.refresh_machine_states({"tablesaw": "ready"}, self.logger)
+
+        self.assertGreater(self.redis_adapter.redis.ttl(key), 10)
+        self.assertEqual(
+            self.redis_adapter.get_machine_state("tablesaw", self.logger), "ready"
+        )
+
+    def test_lost_states_are_written_again(self):
+        self.aggregator.refresh_machine_states({"lathe": "ready"}, self.logger)
+
+        self.assertEqual(
+            self.redis_adapter.get_machine_state("lathe", self.logger), "ready"
+        )
+        key = self.redis_adapter._k_machine_state("lathe")
+        self.assertGreater(self.redis_adapter.redis.ttl(key), 0)
+
+    def test_newer_states_are_kept(self):
+        self.aggregator.machine_state("tablesaw", "running", self.logger)
+
+        self.aggregator.refresh_machine_states({"tablesaw": "ready"}, self.logger)
+
+        self.assertEqual(
+            self.redis_adapter.get_machine_state("tablesaw", self.logger), "running"
+        )
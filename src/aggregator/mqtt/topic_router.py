@@ -0,0 +1,31 @@
+from paho.mqtt.client import topic_matches_sub
+
+
+class TopicRouter(object):
+    """
+    Routes each topic to the handler of the first topic filter that matches it,
+    in the order in which the routes were added.
+
+    The route found for a topic is remembered, so matching runs once per topic.
+    """
+
+    def __init__(self):
+        self.routes = []
+        self.handlers_by_topic = {}
+
+    def add_route(self, topic_filter, handler):
+        self.routes.append((topic_filter, handler))
+        self.handlers_by_topic.clear()
+
+    def get_handler(self, topic):
+        try:
+            return self.handlers_by_topic[topic]
+        except KeyError:
+            pass
+        handler = None
+        for topic_filter, route_handler in self.routes:
+            if topic_matches_sub(topic_filter, topic):
+                handler = route_handler
+                break
+        self.handlers_by_topic[topic] = handler
+        return handler
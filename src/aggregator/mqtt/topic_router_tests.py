@@ -0,0 +1,62 @@
+import os
+import unittest
+
+from paho.mqtt.client import topic_matches_sub
+
+from .mqtt_parser import DEFAULT_TOPIC_FILTERS, TOPIC_FILTER_PARSERS, parse_message
+from .topic_router import TopicRouter
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+SAMPLE_MESSAGES_FILE_PATH = os.path.join(DIR_PATH, "sample_mqtt_messages.txt")
+
+
+def read_sample_messages():
+    with open(SAMPLE_MESSAGES_FILE_PATH, encoding="utf-8", errors="ignore") as f:
+        return [tuple(line.strip().split(" - ", 1)) for line in f]
+
+
+class TestTopicRouter(unittest.TestCase):
+    def test_first_matching_route_wins(self):
+        router = TopicRouter()
+        router.add_route("ac/log/master", "master")
+        router.add_route("ac/log/#", "log")
+        router.add_route("makerspace/+/status", "status")
+
+        self.assertEqual(router.get_handler("ac/log/master"), "master")
+        self.assertEqual(router.get_handler("ac/log/tablesaw"), "log")
+        self.assertEqual(router.get_handler("ac/log"), "log")
+        self.assertEqual(router.get_handler("makerspace/deur/status"), "status")
+        self.assertIsNone(router.get_handler("makerspace/deur/voor"))
+
+    def test_adding_a_route_resets_known_topics(self):
+        router = TopicRouter()
+        self.assertIsNone(router.get_handler("ac/log/tablesaw"))
+        router.add_route("ac/log/#", "log")
+        self.assertEqual(router.get_handler("ac/log/tablesaw"), "log")
+
+
+class TestDefaultTopicFilters(unittest.TestCase):
+    def test_unsubscribed_topics_are_only_ignored(self):
+        for topic, message in read_sample_messages():
+            if not any(
+                topic_matches_sub(topic_filter, topic)
+                for topic_filter in DEFAULT_TOPIC_FILTERS
+            ):
+                self.assertEqual(
+                    parse_message(topic, message), ("ignore",), (topic, message)
+                )
+
+    def test_routed_parsers_agree_with_parse_message(self):
+        router = TopicRouter()
+        for topic_filter in DEFAULT_TOPIC_FILTERS:
+            router.add_route(
+                topic_filter, TOPIC_FILTER_PARSERS.get(topic_filter, parse_message)
+            )
+        for topic, message in read_sample_messages():
+            parse_function = router.get_handler(topic)
+            if parse_function:
+                self.assertEqual(
+                    parse_function(topic, message),
+                    parse_message(topic, message),
+                    (topic, message),
+                )
@@ -2,12 +2,68 @@ import json
 
 import redis
 
-from aggregator.model import Machine, User
+from aggregator.model import CrmOperation, Machine, SpaceStateSnapshot, Tag, User
 
 from .clock import Time
 from .model import history_line_to_json, json_to_history_line
 from .utils import make_random_string
 
+# Reads the whole space state in a single round-trip.
+# Per-machine and per-line keys are built from the prefix the same way the _k_* methods do.
+SPACE_STATE_SNAPSHOT_SCRIPT = """
+local prefix = ARGV[1]
+local users_in_space = redis.call("HGETALL", KEYS[1])
+local machines = redis.call("HGETALL", KEYS[2])
+local machines_on = redis.call("SMEMBERS", KEYS[3])
+local lights_on = redis.call("SMEMBERS", KEYS[4])
+local space_open = redis.call("GET", KEYS[5]) or ""
+
+local machine_states = {}
+for i = 1, #machines, 2 do
+    machine_states[#machine_states + 1] = redis.call("GET", prefix .. ":mt" .. machines[i]) or ""
+end
+
+local user_ids = {}
+for i = 1, #users_in_space, 2 do
+    user_ids[#user_ids + 1] = users_in_space[i]
+end
+
+local machines_on_values = {}
+for i, machine in ipairs(machines_on) do
+    local value = redis.call("GET", prefix .. ":mo" .. machine) or ""
+    machines_on_values[i] = value
+    local user_id = string.match(value, '"user_id":%s*(%d+)')
+    if user_id then
+        user_ids[#user_ids + 1] = user_id
+    end
+end
+
+local users = {}
+for i, user_id in ipairs(user_ids) do
+    users[i] = redis.call("HGET", KEYS[6], user_id) or ""
+end
+
+local history = redis.call("ZRANGEBYSCORE", KEYS[7], ARGV[2], "+inf")
+
+return {users_in_space, machines, machine_states, machines_on, machines_on_values, users, lights_on, space_open, history}
+"""
+
+# Completes (empty ARGV[3]) or reschedules a CRM operation,
+# unless a newer operation for the same user replaced it in the meantime.
+UPDATE_CRM_OPERATION_SCRIPT = """
+if redis.call("HGET", KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] == "" then
+    redis.call("HDEL", KEYS[1], ARGV[1])
+    redis.call("ZREM", KEYS[2], ARGV[1])
+else
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[3])
+    redis.call("ZADD", KEYS[2], ARGV[4], ARGV[1])
+end
+return 1
+"""
+
 
 class RedisAdapter(object):
     def __init__(
@@ -35,30 +91,79 @@ class RedisAdapter(object):
         )
         self.machine_state_timeout_in_minutes = machine_state_timeout_in_minutes
         self.history_lines_expiration_in_days = history_lines_expiration_in_days
+        self.space_state_snapshot_script = self.redis.register_script(
+            SPACE_STATE_SNAPSHOT_SCRIPT
+        )
+        self.update_crm_operation_script = self.redis.register_script(
+            UPDATE_CRM_OPERATION_SCRIPT
+        )
 
     def get_machine_by_name(self, machine, logger):
         logger = logger.getLogger(subsystem="redis")
         data = self.redis.hget(self._k_machines_by_id(), machine)
         if data:
-            logger.info(f"Found machine {machine}")
+            logger.info("Found machine %s", machine)
             return Machine(**json.loads(data))
         else:
-            logger.info(f"Machine {machine} not found")
+            logger.info("Machine %s not found", machine)
 
     def set_all_machines(self, machines, logger):
         logger = logger.getLogger(subsystem="redis")
         if len(machines) > 0:
-            logger.info(f"Storing {len(machines)} machines")
-            self.redis.hmset(
+            logger.info("Storing %s machines", len(machines))
+            pipe = self.redis.pipeline(transaction=True)
+            self._swap_in_hash(
+                pipe,
                 self._k_machines_by_id(),
                 dict(
                     (str(machine.node_machine_name), json.dumps(machine._asdict()))
                     for machine in machines
                 ),
             )
-            self.redis.pexpire(
-                self._k_machines_by_id(), self.users_expiration_time_in_sec * 1000
+            pipe.delete(self._k_machines_checksums())
+            pipe.execute()
+
+    def get_machines_checksums(self, logger):
+        logger = logger.getLogger(subsystem="redis")
+        logger.info("Getting machines checksums")
+        values = self.redis.hgetall(self._k_machines_checksums())
+        return dict(
+            (key.decode("utf-8"), value.decode("utf-8"))
+            for key, value in values.items()
+        )
+
+    def apply_machines_changes(
+        self, changed_machines_with_checksums, removed_machine_names, logger
+    ):
+        logger = logger.getLogger(subsystem="redis")
+        logger.info(
+            "Updating %s machines, removing %s",
+            len(changed_machines_with_checksums),
+            len(removed_machine_names),
+        )
+        pipe = self.redis.pipeline()
+        if removed_machine_names:
+            pipe.hdel(self._k_machines_by_id(), *removed_machine_names)
+            pipe.hdel(self._k_machines_checksums(), *removed_machine_names)
+        if changed_machines_with_checksums:
+            pipe.hmset(
+                self._k_machines_by_id(),
+                dict(
+                    (str(machine.node_machine_name), json.dumps(machine._asdict()))
+                    for machine, _ in changed_machines_with_checksums
+                ),
             )
+            pipe.hmset(
+                self._k_machines_checksums(),
+                dict(
+                    (str(machine.node_machine_name), checksum)
+                    for machine, checksum in changed_machines_with_checksums
+                ),
+            )
+        # Kept up to date by the incremental sync, rather than expired
+        pipe.persist(self._k_machines_by_id())
+        pipe.persist(self._k_machines_checksums())
+        pipe.execute()
 
     def get_all_machines(self, logger):
         logger = logger.getLogger(subsystem="redis")
@@ -70,44 +175,231 @@ class RedisAdapter(object):
         logger = logger.getLogger(subsystem="redis")
         data = self.redis.hget(self._k_users_by_id(), str(user_id))
         if data:
-            logger.info(f"Found user {user_id}")
+            logger.info("Found user %s", user_id)
             return User(**json.loads(data))
         else:
-            logger.info(f"User {user_id} not found")
+            logger.info("User %s not found", user_id)
 
     def set_users_by_ids(self, users, logger):
         logger = logger.getLogger(subsystem="redis")
         if len(users) > 0:
-            logger.info(f"Storing {len(users)} users")
-            self.redis.delete(self._k_users_by_id())
-            self.redis.hmset(
+            logger.info("Storing %s users", len(users))
+            pipe = self.redis.pipeline(transaction=True)
+            self._swap_in_hash(
+                pipe,
                 self._k_users_by_id(),
                 dict((str(user.user_id), json.dumps(user._asdict())) for user in users),
             )
-            self.redis.pexpire(
-                self._k_users_by_id(), self.users_expiration_time_in_sec * 1000
+            self._swap_in_hash(
+                pipe,
+                self._k_users_by_phone_number(),
+                dict(
+                    (user.phone_number, json.dumps(user._asdict()))
+                    for user in users
+                    if user.phone_number
+                ),
+            )
+            pipe.delete(self._k_users_by_telegram_id(), self._k_users_checksums())
+            pipe.execute()
+
+    def _swap_in_hash(self, pipe, key, mapping):
+        # The new hash is built under a temporary key and renamed over the old one.
+        # Queued in a MULTI/EXEC pipeline, readers never see a partial or empty directory.
+        if not mapping:
+            pipe.delete(key)
+            return
+        tmp_key = f"{key}:tmp{make_random_string(10)}"
+        pipe.hmset(tmp_key, mapping)
+        # RENAME carries the expiration over to the destination key
+        pipe.pexpire(tmp_key, self.users_expiration_time_in_sec * 1000)
+        pipe.rename(tmp_key, key)
+
+    def get_users_checksums(self, logger):
+        logger = logger.getLogger(subsystem="redis")
+        logger.info("Getting users checksums")
+        values = self.redis.hgetall(self._k_users_checksums())
+        return dict((int(key), value.decode("utf-8")) for key, value in values.items())
+
+    def apply_users_changes(
+        self, changed_users_with_checksums, removed_user_ids, logger
+    ):
+        logger = logger.getLogger(subsystem="redis")
+        logger.info(
+            "Updating %s users, removing %s",
+            len(changed_users_with_checksums),
+            len(removed_user_ids),
+        )
+        user_ids = [str(user.user_id) for user, _ in changed_users_with_checksums] + [
+            str(user_id) for user_id in removed_user_ids
+        ]
+        previous_users = [
+            User(**json.loads(value))
+            for value in self.redis.hmget(self._k_users_by_id(), user_ids)
+            if value
+        ]
+        previous_phone_numbers = [
+            u.phone_number for u in previous_users if u.phone_number
+        ]
+        changed_users_with_phone_number = [
+            user for user, _ in changed_users_with_checksums if user.phone_number
+        ]
+        pipe = self.redis.pipeline()
+        if previous_phone_numbers:
+            pipe.hdel(self._k_users_by_phone_number(), *previous_phone_numbers)
+        if removed_user_ids:
+            pipe.hdel(self._k_users_by_id(), *removed_user_ids)
+            pipe.hdel(self._k_users_checksums(), *removed_user_ids)
+        if changed_users_with_checksums:
+            pipe.hmset(
+                self._k_users_by_id(),
+                dict(
+                    (str(user.user_id), json.dumps(user._asdict()))
+                    for user, _ in changed_users_with_checksums
+                ),
+            )
+            pipe.hmset(
+                self._k_users_checksums(),
+                dict(
+                    (str(user.user_id), checksum)
+                    for user, checksum in changed_users_with_checksums
+                ),
             )
+        if changed_users_with_phone_number:
+            pipe.hmset(
+                self._k_users_by_phone_number(),
+                dict(
+                    (user.phone_number, json.dumps(user._asdict()))
+                    for user in changed_users_with_phone_number
+                ),
+            )
+        # Kept up to date by the incremental sync, rather than expired
+        for key in (
+            self._k_users_by_id(),
+            self._k_users_by_phone_number(),
+            self._k_users_checksums(),
+        ):
+            pipe.persist(key)
+        pipe.execute()
+
+    def get_tags_checksums(self, logger):
+        logger = logger.getLogger(subsystem="redis")
+        logger.info("Getting tags checksums")
+        values = self.redis.hgetall(self._k_tags_checksums())
+        return dict((int(key), value.decode("utf-8")) for key, value in values.items())
+
+    def apply_tags_changes(self, changed_tags_with_checksums, removed_tag_ids, logger):
+        """
+        Every call is a new version of the tags directory. The changed and removed tags
+        are stamped with it, so that nodes can ask only for what changed since their copy.
+        """
+        logger = logger.getLogger(subsystem="redis")
+        logger.info(
+            "Updating %s tags, removing %s",
+            len(changed_tags_with_checksums),
+            len(removed_tag_ids),
+        )
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    # The new version is only visible together with its changes, otherwise
+                    # a node reading it meanwhile would never ask for them
+                    pipe.watch(self._k_tags_version())
+                    version = int(pipe.get(self._k_tags_version()) or 0) + 1
+                    pipe.multi()
+                    pipe.set(self._k_tags_version(), version)
+                    self._stamp_tags_changes(
+                        pipe, changed_tags_with_checksums, removed_tag_ids, version
+                    )
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    logger.info("Tags version changed meanwhile, retrying")
+        logger.info("Tags directory at version %s", version)
+        return version
+
+    def _stamp_tags_changes(
+        self, pipe, changed_tags_with_checksums, removed_tag_ids, version
+    ):
+        if removed_tag_ids:
+            pipe.hdel(self._k_tags_by_id(), *removed_tag_ids)
+            pipe.hdel(self._k_tags_checksums(), *removed_tag_ids)
+            pipe.zrem(self._k_tags_by_order(), *removed_tag_ids)
+            pipe.zrem(self._k_tags_by_version(), *removed_tag_ids)
+            pipe.zadd(
+                self._k_removed_tags_by_version(),
+                dict((str(tag_id), version) for tag_id in removed_tag_ids),
+            )
+        if changed_tags_with_checksums:
+            tag_ids = [str(tag.tag_id) for tag, _ in changed_tags_with_checksums]
+            pipe.hmset(
+                self._k_tags_by_id(),
+                dict(
+                    (str(tag.tag_id), _encode_tag(tag))
+                    for tag, _ in changed_tags_with_checksums
+                ),
+            )
+            pipe.hmset(
+                self._k_tags_checksums(),
+                dict(
+                    (str(tag.tag_id), checksum)
+                    for tag, checksum in changed_tags_with_checksums
+                ),
+            )
+            pipe.zadd(
+                self._k_tags_by_order(),
+                dict((tag_id, int(tag_id)) for tag_id in tag_ids),
+            )
+            pipe.zadd(
+                self._k_tags_by_version(),
+                dict((tag_id, version) for tag_id in tag_ids),
+            )
+            pipe.zrem(self._k_removed_tags_by_version(), *tag_ids)
 
-            self.redis.delete(self._k_users_by_telegram_id())
+    def get_tags_version(self, logger):
+        return int(self.redis.get(self._k_tags_version()) or 0)
 
-            self.redis.delete(self._k_users_by_phone_number())
-            users_with_phone_number = [u for u in users if u.phone_number]
-            if len(users_with_phone_number) > 0:
-                self.redis.hmset(
-                    self._k_users_by_phone_number(),
-                    dict(
-                        (user.phone_number, json.dumps(user._asdict()))
-                        for user in users_with_phone_number
-                    ),
+    def get_tags_page(self, after_tag_id, since_version, limit, logger):
+        """
+        Up to limit tags with an ID greater than after_tag_id, ordered by ID, and whether
+        there are more. With since_version, only the tags changed after that version.
+        """
+        logger = logger.getLogger(subsystem="redis")
+        min_tag_id = f"({after_tag_id}" if after_tag_id is not None else "-inf"
+        if since_version is None:
+            tag_ids = [
+                int(tag_id)
+                for tag_id in self.redis.zrangebyscore(
+                    self._k_tags_by_order(), min_tag_id, "+inf", start=0, num=limit + 1
                 )
-                self.redis.pexpire(
-                    self._k_users_by_phone_number(),
-                    self.users_expiration_time_in_sec * 1000,
+            ]
+        else:
+            # Usually a handful, unless the node has no copy at all
+            tag_ids = sorted(
+                int(tag_id)
+                for tag_id in self.redis.zrangebyscore(
+                    self._k_tags_by_version(), f"({since_version}", "+inf"
                 )
+            )
+            if after_tag_id is not None:
+                tag_ids = [tag_id for tag_id in tag_ids if tag_id > after_tag_id]
+        has_more = len(tag_ids) > limit
+        tag_ids = tag_ids[:limit]
+        logger.info("Getting %s tags", len(tag_ids))
+        values = self.redis.hmget(self._k_tags_by_id(), tag_ids) if tag_ids else []
+        # Tags removed in the meantime are skipped
+        return [_decode_tag(value) for value in values if value], has_more
+
+    def get_removed_tag_ids(self, since_version, logger):
+        return sorted(
+            int(tag_id)
+            for tag_id in self.redis.zrangebyscore(
+                self._k_removed_tags_by_version(), f"({since_version}", "+inf"
+            )
+        )
 
     def store_user_in_space(self, user, ts, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Storing user ID {user.user_id} in space")
+        logger.info("Storing user ID %s in space", user.user_id)
         self.redis.hset(self._k_users_in_space(), user.user_id, ts.as_int_timestamp())
         self.redis.hset(
             self._k_users_last_in_space(), user.user_id, ts.as_int_timestamp()
@@ -123,12 +415,12 @@ class RedisAdapter(object):
 
     def user_left_space(self, user, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Removing user ID {user.user_id} from space")
+        logger.info("Removing user ID %s from space", user.user_id)
         self.redis.hdel(self._k_users_in_space(), user.user_id)
 
     def remove_user_from_space(self, user_id, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Removing user ID {user_id} from space")
+        logger.info("Removing user ID %s from space", user_id)
         self.redis.hdel(self._k_users_in_space(), user_id)
 
     def get_user_ids_in_space_with_timestamps(self, logger):
@@ -142,7 +434,7 @@ class RedisAdapter(object):
     def store_pending_machine_activation(self, user_id, machine, logger):
         logger = logger.getLogger(subsystem="redis")
         logger.info(
-            f"Storing pending machine activation: user {user_id}, machine {machine}"
+            "Storing pending machine activation: user %s, machine %s", user_id, machine
         )
         self.redis.setex(
             self._k_pending_machine_activation(machine),
@@ -152,13 +444,13 @@ class RedisAdapter(object):
 
     def get_pending_machine_activation(self, machine, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Reading pending machine activation for machine {machine}")
+        logger.info("Reading pending machine activation for machine %s", machine)
         value = self.redis.get(self._k_pending_machine_activation(machine))
         return int(value) if value else None
 
     def set_machine_on(self, machine, user_id, ts, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Setting machine {machine} state ON, for user {user_id}")
+        logger.info("Setting machine %s state ON, for user %s", machine, user_id)
         self.redis.set(
             self._k_machine_on(machine),
             json.dumps({"user_id": user_id, "ts": ts.as_int_timestamp()}),
@@ -167,7 +459,7 @@ class RedisAdapter(object):
 
     def get_machine_on(self, machine, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Reading machine {machine} state")
+        logger.info("Reading machine %s state", machine)
         value = self.redis.get(self._k_machine_on(machine))
         if value:
             data = json.loads(value)
@@ -176,22 +468,37 @@ class RedisAdapter(object):
 
     def set_machine_off(self, machine, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Setting machine {machine} state OFF")
+        logger.info("Setting machine %s state OFF", machine)
         self.redis.delete(self._k_machine_on(machine))
         self.redis.srem(self._k_machines_on(), machine)
 
     def set_machine_state(self, machine, state, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Setting machine {machine} state {state}")
+        logger.info("Setting machine %s state %s", machine, state)
         self.redis.setex(
             self._k_machine_state(machine),
             self.machine_state_timeout_in_minutes * 60,
             state,
         )
 
+    def refresh_machine_states(self, states, logger):
+        """
+        Pushes back the expiration of the states of the machines, a dict machine -> state,
+        and writes the states that were lost, e.g. with a restart of Redis. A state that
+        is there is left as is: it can be newer than the one to refresh.
+        """
+        logger = logger.getLogger(subsystem="redis")
+        logger.info("Refreshing the state of %s machines", len(states))
+        timeout_in_sec = self.machine_state_timeout_in_minutes * 60
+        pipe = self.redis.pipeline()
+        for machine, state in states.items():
+            pipe.set(self._k_machine_state(machine), state, ex=timeout_in_sec, nx=True)
+            pipe.expire(self._k_machine_state(machine), timeout_in_sec)
+        pipe.execute()
+
     def get_machine_state(self, machine, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Getting machine {machine} state")
+        logger.info("Getting machine %s state", machine)
         value = self.redis.get(self._k_machine_state(machine))
         return value.decode("utf-8") if value else None
 
@@ -202,7 +509,7 @@ class RedisAdapter(object):
 
     def set_space_open(self, is_open, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Setting space open {is_open}")
+        logger.info("Setting space open %s", is_open)
         self.redis.set(self._k_space_open(), str(is_open))
 
     def get_space_open(self, logger):
@@ -213,7 +520,7 @@ class RedisAdapter(object):
 
     def set_lights(self, room, lights_on, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f'Setting lights {room} {"ON" if lights_on else "OFF"}')
+        logger.info("Setting lights %s %s", room, "ON" if lights_on else "OFF")
         if lights_on:
             self.redis.sadd(self._k_lights_on(), room)
         else:
@@ -226,49 +533,251 @@ class RedisAdapter(object):
 
     def get_user_by_phone_number(self, phone_number, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Get user with phone number {phone_number}")
+        logger.info("Get user with phone number %s", phone_number)
         data = self.redis.hget(self._k_users_by_phone_number(), phone_number)
         if data:
             return User(**json.loads(data))
 
     def store_history_line(self, hl, logger):
         logger = logger.getLogger(subsystem="redis")
-        logger.info(f"Storing history line of type {hl.__class__.__name__}")
-        hl_id = make_random_string(10)
-        self.redis.setex(
-            self._k_history_line(hl_id),
-            self.history_lines_expiration_in_days * 24 * 3600,
-            json.dumps(history_line_to_json(hl)),
+        logger.info("Storing history line of type %s", hl.__class__.__name__)
+        pipe = self.redis.pipeline()
+        pipe.zadd(
+            self._k_history(),
+            {
+                self._encode_history_line(history_line_to_json(hl)): (
+                    hl.ts.as_int_timestamp()
+                )
+            },
         )
-        self.redis.sadd(self._k_history_lines(), hl_id)
+        # Expire old lines server-side, in the same round-trip
+        pipe.zremrangebyscore(
+            self._k_history(), "-inf", f"({self._history_lines_min_score()}"
+        )
+        pipe.execute()
 
     def get_all_history_lines(self, logger):
+        history_lines, _ = self.get_history_lines(logger)
+        return history_lines
+
+    def get_history_lines(
+        self, logger, since=None, until=None, limit=None, cursor=None
+    ):
+        """
+        Return the history lines, oldest first, and the cursor for the next page.
+        since and until are inclusive Time bounds. The returned cursor is None when
+        there are no more lines, otherwise pass it back to read the following page.
+        """
+        logger = logger.getLogger(subsystem="redis")
+        logger.info("Get history lines")
+        min_score, offset = self._history_lines_start(since, cursor)
+        values = self.redis.zrangebyscore(
+            self._k_history(),
+            min_score,
+            until.as_int_timestamp() if until else "+inf",
+            start=offset,
+            num=limit if limit else -1,
+            withscores=True,
+        )
+        return self._decode_history_lines_page(values, limit, min_score, offset)
+
+    def migrate_legacy_history_lines(self, logger):
+        """
+        One-time migration of the history lines stored one key per line into the sorted set.
+        """
         logger = logger.getLogger(subsystem="redis")
-        logger.info("Get all history lines")
-        all_ids = [
+        legacy_ids = [
             hl_id.decode("utf-8")
-            for hl_id in self.redis.smembers(self._k_history_lines())
+            for hl_id in self.redis.smembers(self._k_legacy_history_lines())
         ]
-        ids_to_remove = []
-        result = []
-        for hl_id in all_ids:
-            value = self.redis.get(self._k_history_line(hl_id))
+        if not legacy_ids:
+            return
+        logger.info("Migrating %s legacy history lines", len(legacy_ids))
+        legacy_keys = [self._k_legacy_history_line(hl_id) for hl_id in legacy_ids]
+        values = [json.loads(value) for value in self.redis.mget(legacy_keys) if value]
+        pipe = self.redis.pipeline()
+        if values:
+            pipe.zadd(
+                self._k_history(),
+                dict((self._encode_history_line(data), data["ts"]) for data in values),
+            )
+        pipe.delete(self._k_legacy_history_lines(), *legacy_keys)
+        pipe.execute()
+
+    def get_space_state_snapshot(self, logger):
+        logger = logger.getLogger(subsystem="redis")
+        logger.info("Getting space state snapshot")
+        return self._decode_space_state_snapshot(
+            self.space_state_snapshot_script(
+                keys=self._space_state_snapshot_keys(),
+                args=[self.key_prefix, self._history_lines_min_score()],
+            )
+        )
+
+    # -- CRM outbox ----
+
+    def enqueue_crm_operation(self, user_id, operation, now, logger):
+        """
+        Stores the operation, due immediately. It replaces any operation still pending for the user,
+        in which case the replaced operation is returned.
+        """
+        logger = logger.getLogger(subsystem="redis")
+        logger.info("Enqueuing CRM %s of user ID %s", operation, user_id)
+        crm_operation = CrmOperation(user_id, operation, make_random_string(10), now, 0)
+        pipe = self.redis.pipeline()
+        pipe.hget(self._k_crm_operations(), user_id)
+        pipe.hset(
+            self._k_crm_operations(), user_id, _encode_crm_operation(crm_operation)
+        )
+        pipe.zadd(self._k_crm_operations_due(), {user_id: now})
+        replaced_value, _, _ = pipe.execute()
+        return _decode_crm_operation(replaced_value) if replaced_value else None
+
+    def get_due_crm_operations(self, now, limit, logger):
+        logger = logger.getLogger(subsystem="redis")
+        user_ids = self.redis.zrangebyscore(
+            self._k_crm_operations_due(), "-inf", now, start=0, num=limit
+        )
+        if not user_ids:
+            return []
+        values = self.redis.hmget(self._k_crm_operations(), user_ids)
+        return [_decode_crm_operation(value) for value in values if value]
+
+    def get_num_pending_crm_operations(self, logger):
+        return self.redis.hlen(self._k_crm_operations())
+
+    def complete_crm_operation(self, crm_operation, logger):
+        """
+        Returns False if the operation had been replaced by a newer one, which stays pending.
+        """
+        return bool(
+            self.update_crm_operation_script(
+                keys=[self._k_crm_operations(), self._k_crm_operations_due()],
+                args=[crm_operation.user_id, _encode_crm_operation(crm_operation), ""],
+            )
+        )
+
+    def reschedule_crm_operation(self, crm_operation, due_at, logger):
+        return bool(
+            self.update_crm_operation_script(
+                keys=[self._k_crm_operations(), self._k_crm_operations_due()],
+                args=[
+                    crm_operation.user_id,
+                    _encode_crm_operation(crm_operation),
+                    _encode_crm_operation(
+                        crm_operation._replace(attempts=crm_operation.attempts + 1)
+                    ),
+                    due_at,
+                ],
+            )
+        )
+
+    def _history_lines_min_score(self):
+        return (
+            self.clock.now().as_int_timestamp()
+            - self.history_lines_expiration_in_days * 24 * 3600
+        )
+
+    def _history_lines_start(self, since, cursor):
+        min_score = self._history_lines_min_score()
+        if since:
+            min_score = max(min_score, since.as_int_timestamp())
+        offset = 0
+        if cursor:
+            cursor_score, cursor_offset = (int(part) for part in cursor.split(":"))
+            if cursor_score >= min_score:
+                min_score, offset = cursor_score, cursor_offset
+        return min_score, offset
+
+    def _decode_history_lines_page(self, values, limit, min_score, offset):
+        next_cursor = None
+        if limit and len(values) == limit:
+            last_score = int(values[-1][1])
+            seen_with_last_score = sum(1 for _, score in values if score == last_score)
+            if last_score == min_score:
+                seen_with_last_score += offset
+            next_cursor = f"{last_score}:{seen_with_last_score}"
+        return [self._decode_history_line(value) for value, _ in values], next_cursor
+
+    def _encode_history_line(self, data):
+        # The random ID keeps identical lines distinct in the sorted set
+        return json.dumps(dict(data, hl_id=make_random_string(10)))
+
+    def _decode_history_line(self, value):
+        data = json.loads(value)
+        del data["hl_id"]
+        return json_to_history_line(data)
+
+    def _space_state_snapshot_keys(self):
+        return [
+            self._k_users_in_space(),
+            self._k_machines_by_id(),
+            self._k_machines_on(),
+            self._k_lights_on(),
+            self._k_space_open(),
+            self._k_users_by_id(),
+            self._k_history(),
+        ]
+
+    def _decode_space_state_snapshot(self, result):
+        (
+            users_in_space,
+            machines,
+            machine_states,
+            machines_on,
+            machines_on_values,
+            users,
+            lights_on,
+            space_open,
+            history,
+        ) = result
+        machine_names = [name.decode("utf-8") for name in machines[::2]]
+        machines_on_states = {}
+        for machine, value in zip(machines_on, machines_on_values):
             if value:
-                result.append(json_to_history_line(json.loads(value)))
-            else:
-                ids_to_remove.append(hl_id)
-        if len(ids_to_remove) > 0:
-            self.redis.srem(self._k_history_lines(), *ids_to_remove)
-        return result
+                data = json.loads(value)
+                data["ts"] = Time.from_timestamp(data["ts"])
+                machines_on_states[machine.decode("utf-8")] = data
+        users_by_id = {}
+        for value in users:
+            if value:
+                user = User(**json.loads(value))
+                users_by_id[user.user_id] = user
+        return SpaceStateSnapshot(
+            user_ids_in_space_with_timestamps=[
+                (int(key), Time.from_timestamp(int(value)))
+                for key, value in zip(users_in_space[::2], users_in_space[1::2])
+            ],
+            machines=[Machine(**json.loads(value)) for value in machines[1::2]],
+            machine_states=dict(
+                (name, state.decode("utf-8"))
+                for name, state in zip(machine_names, machine_states)
+                if state
+            ),
+            machines_on=machines_on_states,
+            users_by_id=users_by_id,
+            lights_on=[light.decode("utf-8") for light in lights_on],
+            space_open=space_open.decode("utf-8") == "True" if space_open else False,
+            history_lines=[self._decode_history_line(value) for value in history],
+        )
 
     # -- Keys ----
 
-    def _k_history_line(self, hl_id):
+    def _k_legacy_history_line(self, hl_id):
         return f"{self.key_prefix}:hl{hl_id}"
 
-    def _k_history_lines(self):
+    def _k_legacy_history_lines(self):
         return f"{self.key_prefix}:hs"
 
+    def _k_crm_operations(self):
+        return f"{self.key_prefix}:co"
+
+    def _k_crm_operations_due(self):
+        return f"{self.key_prefix}:cq"
+
+    def _k_history(self):
+        return f"{self.key_prefix}:hz"
+
     def _k_lights_on(self):
         return f"{self.key_prefix}:li"
 
@@ -278,6 +787,9 @@ class RedisAdapter(object):
     def _k_machines_by_id(self):
         return f"{self.key_prefix}:mc"
 
+    def _k_machines_checksums(self):
+        return f"{self.key_prefix}:mk"
+
     def _k_machine_on(self, machine):
         return f"{self.key_prefix}:mo{machine}"
 
@@ -293,6 +805,27 @@ class RedisAdapter(object):
     def _k_space_open(self):
         return f"{self.key_prefix}:so"
 
+    def _k_tags_by_id(self):
+        return f"{self.key_prefix}:tg"
+
+    def _k_tags_checksums(self):
+        return f"{self.key_prefix}:tk"
+
+    def _k_tags_version(self):
+        return f"{self.key_prefix}:tn"
+
+    def _k_tags_by_order(self):
+        return f"{self.key_prefix}:to"
+
+    def _k_removed_tags_by_version(self):
+        return f"{self.key_prefix}:tr"
+
+    def _k_tags_by_version(self):
+        return f"{self.key_prefix}:tv"
+
+    def _k_users_checksums(self):
+        return f"{self.key_prefix}:uc"
+
     def _k_users_by_id(self):
         return f"{self.key_prefix}:ui"
 
@@ -307,3 +840,23 @@ class RedisAdapter(object):
 
     def _k_users_by_telegram_id(self):
         return f"{self.key_prefix}:ut"
+
+
+def _encode_tag(tag):
+    return json.dumps(
+        {"tag_id": tag.tag_id, "tag": tag.tag, "user": tag.user._asdict()}
+    )
+
+
+def _decode_tag(value):
+    data = json.loads(value)
+    return Tag(data["tag_id"], data["tag"], User(**data["user"]))
+
+
+def _encode_crm_operation(crm_operation):
+    # Always encoded the same way, so that the stored value can be compared with the one read
+    return json.dumps(crm_operation._asdict())
+
+
+def _decode_crm_operation(value):
+    return CrmOperation(**json.loads(value))
@@ -0,0 +1,339 @@
+import json
+import sys
+import threading
+
+from .model import Tag, UserEntered, UserLeft, history_line_to_json
+from .testing_utils import (
+    ALL_MACHINES,
+    ALL_USERS,
+    BOB,
+    STEFANO,
+    AggregatorBaseTestSuite,
+)
+
+
+class TestRedisAdapter(AggregatorBaseTestSuite):
+    def test_space_state_snapshot_when_empty(self):
+        snapshot = self.redis_adapter.get_space_state_snapshot(self.logger)
+        self.assertEqual(snapshot.user_ids_in_space_with_timestamps, [])
+        self.assertEqual(snapshot.machines, [])
+        self.assertEqual(snapshot.machine_states, {})
+        self.assertEqual(snapshot.machines_on, {})
+        self.assertEqual(snapshot.users_by_id, {})
+        self.assertEqual(snapshot.lights_on, [])
+        self.assertEqual(snapshot.space_open, False)
+        self.assertEqual(snapshot.history_lines, [])
+
+    def test_space_state_snapshot(self):
+        now = self.clock.now()
+        self.redis_adapter.set_users_by_ids(ALL_USERS, self.logger)
+        self.redis_adapter.set_all_machines(ALL_MACHINES, self.logger)
+        self.redis_adapter.store_user_in_space(STEFANO, now, self.logger)
+        self.redis_adapter.set_machine_on("tablesaw", BOB.user_id, now, self.logger)
+        self.redis_adapter.set_machine_state("tablesaw", "powered_idle", self.logger)
+        self.redis_adapter.set_lights("large_room", True, self.logger)
+        self.redis_adapter.set_space_open(True, self.logger)
+        self.redis_adapter.store_history_line(
+            UserEntered(STEFANO.user_id, now, STEFANO.first_name, STEFANO.last_name),
+            self.logger,
+        )
+
+        snapshot = self.redis_adapter.get_space_state_snapshot(self.logger)
+
+        self.assertEqual(
+            snapshot.user_ids_in_space_with_timestamps, [(STEFANO.user_id, now)]
+        )
+        self.assertEqual(snapshot.machines, ALL_MACHINES)
+        self.assertEqual(snapshot.machine_states, {"tablesaw": "powered_idle"})
+        self.assertEqual(
+            snapshot.machines_on, {"tablesaw": {"user_id": BOB.user_id, "ts": now}}
+        )
+        self.assertEqual(
+            snapshot.users_by_id, {STEFANO.user_id: STEFANO, BOB.user_id: BOB}
+        )
+        self.assertEqual(snapshot.lights_on, ["large_room"])
+        self.assertEqual(snapshot.space_open, True)
+        self.assertEqual(
+            snapshot.history_lines,
+            [UserEntered(STEFANO.user_id, now, STEFANO.first_name, STEFANO.last_name)],
+        )
+
+    def test_space_state_snapshot_is_a_single_round_trip(self):
+        self.redis_adapter.set_users_by_ids(ALL_USERS, self.logger)
+        self.redis_adapter.set_all_machines(ALL_MACHINES, self.logger)
+        self.redis_adapter.store_user_in_space(STEFANO, self.clock.now(), self.logger)
+
+        commands = []
+        execute_command = self.redis_adapter.redis.execute_command
+
+        def counting_execute_command(*args, **kwargs):
+            commands.append(args[0])
+            return execute_command(*args, **kwargs)
+
+        self.redis_adapter.redis.execute_command = counting_execute_command
+        self.redis_adapter.get_space_state_snapshot(self.logger)
+        self.redis_adapter.get_space_state_snapshot(self.logger)
+
+        # The first call may need to load the script, from then on it's cached server-side
+        self.assertEqual(commands[-1], "EVALSHA")
+        self.assertLessEqual(len(commands), 3)
+
+    def _store_entered_at(self, user, time_of_day):
+        return self._store_entered(user, self.clock.set_time_of_day(time_of_day))
+
+    def _store_entered(self, user, ts):
+        hl = UserEntered(user.user_id, ts, user.first_name, user.last_name)
+        self.redis_adapter.store_history_line(hl, self.logger)
+        return hl
+
+    def test_history_lines_are_sorted_by_time(self):
+        later = self._store_entered_at(BOB, "10:00")
+        earlier = self._store_entered_at(STEFANO, "09:00")
+        self.assertEqual(
+            self.redis_adapter.get_all_history_lines(self.logger), [earlier, later]
+        )
+
+    def test_history_lines_range_query(self):
+        lines = [
+            self._store_entered_at(STEFANO, time_of_day)
+            for time_of_day in ("09:00", "10:00", "11:00", "12:00")
+        ]
+        history_lines, _ = self.redis_adapter.get_history_lines(
+            self.logger,
+            since=lines[1].ts,
+            until=lines[2].ts,
+        )
+        self.assertEqual(history_lines, lines[1:3])
+
+    def test_history_lines_cursor_pagination(self):
+        lines = [
+            self._store_entered_at(user, time_of_day)
+            for time_of_day in ("09:00", "10:00", "11:00")
+            for user in (STEFANO, BOB)
+        ]
+        pages = []
+        cursor = None
+        while True:
+            history_lines, cursor = self.redis_adapter.get_history_lines(
+                self.logger, limit=4, cursor=cursor
+            )
+            pages.append(history_lines)
+            if not cursor:
+                break
+        self.assertEqual([len(page) for page in pages], [4, 2])
+        self.assertEqual(sorted(pages[0] + pages[1]), sorted(lines))
+
+    def test_history_lines_expire(self):
+        self._store_entered_at(STEFANO, "09:00")
+        ts = self.clock.set_day_and_time("11/2/2019 8:55")
+        self.assertEqual(self.redis_adapter.get_all_history_lines(self.logger), [])
+
+        hl = self._store_entered(BOB, ts)
+        self.assertEqual(
+            self.redis_adapter.redis.zcard(self.redis_adapter._k_history()), 1
+        )
+        self.assertEqual(self.redis_adapter.get_all_history_lines(self.logger), [hl])
+
+    def test_migrate_legacy_history_lines(self):
+        now = self.clock.now()
+        hl = UserEntered(STEFANO.user_id, now, STEFANO.first_name, STEFANO.last_name)
+        self.redis_adapter.redis.set(
+            self.redis_adapter._k_legacy_history_line("abc"),
+            json.dumps(history_line_to_json(hl)),
+        )
+        self.redis_adapter.redis.sadd(
+            self.redis_adapter._k_legacy_history_lines(), "abc", "expired"
+        )
+
+        self.redis_adapter.migrate_legacy_history_lines(self.logger)
+
+        self.assertEqual(self.redis_adapter.get_all_history_lines(self.logger), [hl])
+        self.assertEqual(
+            self.redis_adapter.redis.keys(self.redis_adapter.key_prefix + ":h[ls]*"),
+            [],
+        )
+
+    def test_users_directory_is_never_empty_during_refreshes(self):
+        self.redis_adapter.set_users_by_ids(ALL_USERS, self.logger)
+        misses = []
+        refreshing = True
+
+        def read_continuously():
+            while refreshing:
+                for user in ALL_USERS:
+                    if not self.redis_adapter.get_user_by_id(user.user_id, self.logger):
+                        misses.append(user.user_id)
+                    if not self.redis_adapter.get_user_by_phone_number(
+                        user.phone_number, self.logger
+                    ):
+                        misses.append(user.phone_number)
+
+        readers = [threading.Thread(target=read_continuously) for _ in range(4)]
+        switch_interval = sys.getswitchinterval()
+        # Switch threads as often as possible, to interleave reads with the refresh commands
+        sys.setswitchinterval(1e-6)
+        for reader in readers:
+            reader.start()
+        try:
+            for _ in range(200):
+                self.redis_adapter.set_users_by_ids(ALL_USERS, self.logger)
+        finally:
+            refreshing = False
+            for reader in readers:
+                reader.join()
+            sys.setswitchinterval(switch_interval)
+
+        self.assertEqual(misses, [])
+        self.assertEqual(
+            self.redis_adapter.redis.keys(self.redis_adapter.key_prefix + ":*tmp*"), []
+        )
+
+    def test_tags_version_is_visible_with_its_changes(self):
+        tag = Tag(1, "tag1", STEFANO)
+        missing_changes = []
+        applying = True
+
+        def read_continuously():
+            while applying:
+                version = self.redis_adapter.get_tags_version(self.logger)
+                if version:
+                    tags, _ = self.redis_adapter.get_tags_page(
+                        None, version - 1, 10, self.logger
+                    )
+                    if not tags:
+                        missing_changes.append(version)
+
+        readers = [threading.Thread(target=read_continuously) for _ in range(4)]
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        for reader in readers:
+            reader.start()
+        try:
+            for i in range(200):
+                self.redis_adapter.apply_tags_changes(
+                    [(tag, f"checksum{i}")], [], self.logger
+                )
+        finally:
+            applying = False
+            for reader in readers:
+                reader.join()
+            sys.setswitchinterval(switch_interval)
+
+        self.assertEqual(missing_changes, [])
+        self.assertEqual(self.redis_adapter.get_tags_version(self.logger), 200)
+
+
+class TestRedisAdapterSpaceState(AggregatorBaseTestSuite):
+    def test_directory_lookups(self):
+        self.redis_adapter.set_users_by_ids(ALL_USERS, self.logger)
+        self.redis_adapter.set_all_machines(ALL_MACHINES, self.logger)
+
+        self.assertEqual(
+            self.redis_adapter.get_user_by_id(BOB.user_id, self.logger), BOB
+        )
+        self.assertIsNone(self.redis_adapter.get_user_by_id(123, self.logger))
+        self.assertEqual(
+            self.redis_adapter.get_user_by_phone_number(
+                STEFANO.phone_number, self.logger
+            ),
+            STEFANO,
+        )
+        self.assertEqual(
+            self.redis_adapter.get_machine_by_name("tablesaw", self.logger),
+            ALL_MACHINES[0],
+        )
+        self.assertEqual(self.redis_adapter.get_all_machines(self.logger), ALL_MACHINES)
+
+    def test_users_in_space(self):
+        now = self.clock.now()
+        self.redis_adapter.store_user_in_space(STEFANO, now, self.logger)
+        self.redis_adapter.store_user_in_space(BOB, now, self.logger)
+        self.redis_adapter.user_left_space(BOB, self.logger)
+
+        self.assertEqual(
+            self.redis_adapter.get_user_ids_in_space_with_timestamps(self.logger),
+            [(STEFANO.user_id, now)],
+        )
+        self.assertEqual(
+            sorted(self.redis_adapter.get_users_last_in_space(self.logger)),
+            [(now, STEFANO.user_id), (now, BOB.user_id)],
+        )
+        self.redis_adapter.remove_user_from_space(STEFANO.user_id, self.logger)
+        self.assertEqual(
+            self.redis_adapter.get_user_ids_in_space_with_timestamps(self.logger), []
+        )
+
+    def test_machines(self):
+        now = self.clock.now()
+        self.redis_adapter.store_pending_machine_activation(
+            BOB.user_id, "tablesaw", self.logger
+        )
+        self.assertEqual(
+            self.redis_adapter.get_pending_machine_activation("tablesaw", self.logger),
+            BOB.user_id,
+        )
+        self.redis_adapter.set_machine_on("tablesaw", BOB.user_id, now, self.logger)
+        self.redis_adapter.set_machine_state("tablesaw", "powered_idle", self.logger)
+
+        self.assertEqual(self.redis_adapter.get_machines_on(self.logger), ["tablesaw"])
+        self.assertEqual(
+            self.redis_adapter.get_machine_on("tablesaw", self.logger),
+            {"user_id": BOB.user_id, "ts": now},
+        )
+        self.assertEqual(
+            self.redis_adapter.get_machine_state("tablesaw", self.logger),
+            "powered_idle",
+        )
+
+        self.redis_adapter.set_machine_off("tablesaw", self.logger)
+        self.assertEqual(self.redis_adapter.get_machines_on(self.logger), [])
+        self.assertIsNone(self.redis_adapter.get_machine_on("tablesaw", self.logger))
+
+    def test_lights_and_space_open(self):
+        self.assertEqual(self.redis_adapter.get_space_open(self.logger), False)
+        self.redis_adapter.set_space_open(True, self.logger)
+        self.redis_adapter.set_lights("large_room", True, self.logger)
+        self.redis_adapter.set_lights("small_room", True, self.logger)
+        self.redis_adapter.set_lights("small_room", False, self.logger)
+
+        self.assertEqual(self.redis_adapter.get_space_open(self.logger), True)
+        self.assertEqual(self.redis_adapter.get_lights_on(self.logger), ["large_room"])
+
+    def test_history_lines(self):
+        lines = [
+            UserEntered(STEFANO.user_id, self.clock.set_time_of_day("09:00"), "S", "M"),
+            UserLeft(STEFANO.user_id, self.clock.set_time_of_day("10:00"), "S", "M"),
+            UserEntered(BOB.user_id, self.clock.set_time_of_day("11:00"), "B", "B"),
+        ]
+        for hl in lines:
+            self.redis_adapter.store_history_line(hl, self.logger)
+
+        self.assertEqual(self.redis_adapter.get_all_history_lines(self.logger), lines)
+        first_page, cursor = self.redis_adapter.get_history_lines(self.logger, limit=2)
+        second_page, cursor = self.redis_adapter.get_history_lines(
+            self.logger, limit=2, cursor=cursor
+        )
+        self.assertEqual(first_page + second_page, lines)
+        self.assertIsNone(cursor)
+
+    def test_space_state_snapshot(self):
+        now = self.clock.now()
+        self.redis_adapter.set_users_by_ids(ALL_USERS, self.logger)
+        self.redis_adapter.set_all_machines(ALL_MACHINES, self.logger)
+        self.redis_adapter.store_user_in_space(STEFANO, now, self.logger)
+        self.redis_adapter.set_machine_on("tablesaw", BOB.user_id, now, self.logger)
+        self.redis_adapter.set_lights("large_room", True, self.logger)
+
+        snapshot = self.redis_adapter.get_space_state_snapshot(self.logger)
+
+        self.assertEqual(
+            snapshot.user_ids_in_space_with_timestamps, [(STEFANO.user_id, now)]
+        )
+        self.assertEqual(snapshot.machines, ALL_MACHINES)
+        self.assertEqual(
+            snapshot.machines_on, {"tablesaw": {"user_id": BOB.user_id, "ts": now}}
+        )
+        self.assertEqual(
+            snapshot.users_by_id, {STEFANO.user_id: STEFANO, BOB.user_id: BOB}
+        )
+        self.assertEqual(snapshot.lights_on, ["large_room"])
@@ -0,0 +1,115 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import time
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# The /space_state response body, serialised once, with its encodings and their ETags by name
+SpaceStateDocumentVersion = namedtuple(
+    "SpaceStateDocumentVersion", "etags_by_encoding bodies_by_encoding built_at"
+)
+
+
+class SpaceStateDocument(object):
+    """
+    The /space_state response, rebuilt on the reader pool after every space state delta
+    instead of at every request, and served from the asyncio loop.
+
+    It is also rebuilt when older than max_age_in_sec, to update the relative times like
+    "ts_human". The ETag is the hash of the body, so a rebuild which changes nothing keeps
+    it. Every encoding has its own ETag, as the bytes differ: caches must not mix them up.
+    """
+
+    def __init__(
+        self,
+        aggregator,
+        reader_pool,
+        space_state_feed,
+        logger,
+        max_age_in_sec=60,
+        compress=True,
+        time_function=time.monotonic,
+    ):
+        self.aggregator = aggregator
+        self.reader_pool = reader_pool
+        self.logger = logger.getLogger(subsystem="space_state")
+        self.max_age_in_sec = max_age_in_sec
+        self.compress = compress
+        self.time_function = time_function
+        self.version = None
+        self.dirty = False
+        self.rebuilding = None
+        self.num_rebuilds = 0
+        space_state_feed.add_listener(self.invalidate)
+
+    def invalidate(self):
+        """
+        Rebuilds the document in the background. To be called only from the asyncio loop.
+        """
+        self.dirty = True
+        if self.rebuilding is None:
+            self.rebuilding = asyncio.ensure_future(self._rebuild_while_dirty())
+
+    async def get(self):
+        """
+        The latest version of the document. Waits only when there is none yet.
+        """
+        if (
+            self.version is None
+            or self.time_function() - self.version.built_at > self.max_age_in_sec
+        ):
+            self.invalidate()
+        if self.version is None:
+            await asyncio.shield(self.rebuilding)
+            if self.version is None:
+                raise Exception("Cannot build the space state")
+        return self.version
+
+    async def _rebuild_while_dirty(self):
+        try:
+            while self.dirty:
+                # Deltas arriving during the rebuild cause another one
+                self.dirty = False
+                self.version = await self.reader_pool.run(
+                    self._build, self.logger.getLoggerWithRandomReqId("space_state")
+                )
+                self.num_rebuilds += 1
+        except Exception:
+            self.logger.exception("Cannot rebuild the space state")
+        finally:
+            self.rebuilding = None
+
+    def _build(self, logger):
+        state = self.aggregator.get_space_state_for_json(logger)
+        body = json.dumps(state, separators=(",", ":")).encode("utf-8")
+        bodies_by_encoding = {"identity": body}
+        if self.compress:
+            bodies_by_encoding["gzip"] = gzip.compress(body)
+            if brotli:
+                bodies_by_encoding["br"] = brotli.compress(body)
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        return SpaceStateDocumentVersion(
+            {
+                encoding: etag if encoding == "identity" else f"{etag}-{encoding}"
+                for encoding in bodies_by_encoding
+            },
+            bodies_by_encoding,
+            self.time_function(),
+        )
+
+    def get_stats(self):
+        return {
+            "rebuilds": self.num_rebuilds,
+            "age_in_sec": self.time_function() - self.version.built_at
+            if self.version
+            else None,
+        }
@@ -0,0 +1,94 @@
+import asyncio
+import gzip
+import json
+
+from .communication import ReaderPool
+from .space_state_document import SpaceStateDocument
+from .space_state_feed import SpaceStateFeed
+from .testing_utils import STEFANO, AggregatorBaseTestSuite
+
+
+class MockTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSpaceStateDocument(AggregatorBaseTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.reader_pool = ReaderPool(self.loop, 2)
+        feed = SpaceStateFeed(self.loop)
+        self.aggregator.notifications_queue = feed
+        self.time = MockTime()
+        self.document = SpaceStateDocument(
+            self.aggregator,
+            self.reader_pool,
+            feed,
+            self.logger,
+            max_age_in_sec=60,
+            time_function=self.time,
+        )
+
+    def tearDown(self):
+        self.reader_pool.stop()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super().tearDown()
+
+    def get(self):
+        return self.loop.run_until_complete(asyncio.wait_for(self.document.get(), 5))
+
+    def wait_for_rebuilds(self):
+        async def wait():
+            # Lets the deltas published by the worker reach the listener
+            await asyncio.sleep(0.01)
+            while self.document.rebuilding:
+                await asyncio.shield(self.document.rebuilding)
+
+        self.loop.run_until_complete(asyncio.wait_for(wait(), 5))
+
+    def get_users_in_space(self, version):
+        state = json.loads(version.bodies_by_encoding["identity"])
+        return [entry["user"]["user_id"] for entry in state["users_in_space"]]
+
+    def test_document_is_built_once(self):
+        first = self.get()
+        self.assertIs(self.get(), first)
+        self.assertEqual(self.document.num_rebuilds, 1)
+        self.assertEqual(
+            gzip.decompress(first.bodies_by_encoding["gzip"]),
+            first.bodies_by_encoding["identity"],
+        )
+
+    def test_every_encoding_has_its_own_etag(self):
+        version = self.get()
+        etags = version.etags_by_encoding
+        self.assertEqual(set(etags), set(version.bodies_by_encoding))
+        self.assertEqual(len(set(etags.values())), len(etags))
+        self.assertEqual(etags["gzip"], etags["identity"] + "-gzip")
+
+    def test_document_is_rebuilt_after_a_delta(self):
+        first = self.get()
+        self.aggregator.user_entered_space(STEFANO.user_id, self.logger)
+        self.wait_for_rebuilds()
+
+        second = self.get()
+        self.assertNotEqual(second.etags_by_encoding, first.etags_by_encoding)
+        self.assertEqual(self.get_users_in_space(second), [STEFANO.user_id])
+        self.assertEqual(self.document.num_rebuilds, 2)
+
+    def test_old_document_is_served_while_rebuilt(self):
+        first = self.get()
+        self.time.now += 61
+        self.assertIs(self.get(), first)
+        self.wait_for_rebuilds()
+
+        second = self.get()
+        self.assertIsNot(second, first)
+        # Nothing changed, so clients can keep their copy
+        self.assertEqual(second.etags_by_encoding, first.etags_by_encoding)
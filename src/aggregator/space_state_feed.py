@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+import uuid
+from collections import deque
+
+from .broadcast_hub import RESYNC, BroadcastHub
+
+# Types of the messages sent over the /ws websocket.
+# The deltas set a piece of the space state, so applying one twice does no harm, and only
+# the latest of the deltas setting the same piece needs to be sent. That's why a client can
+# see gaps in the sequence numbers.
+SNAPSHOT = "snapshot"
+USER_CHECKED_IN = "user_checked_in"
+USER_CHECKED_OUT = "user_checked_out"
+MACHINE_ON = "machine_on"
+MACHINE_OFF = "machine_off"
+MACHINE_STATE = "machine_state"
+LIGHTS = "lights"
+SPACE_OPEN = "space_open"
+
+# The piece of the space state that a delta sets, from its data
+COALESCING_KEYS = {
+    SPACE_OPEN: lambda data: (SPACE_OPEN,),
+    LIGHTS: lambda data: (LIGHTS, data["light"]["label"]),
+    MACHINE_ON: lambda data: ("machine_power", data["machine"]["machine_id"]),
+    MACHINE_OFF: lambda data: ("machine_power", data["machine"]["machine_id"]),
+    MACHINE_STATE: lambda data: (MACHINE_STATE, data["machine"]["machine_id"]),
+}
+
+
+def encode_feed_message(msg_type, stream_id, seq, data):
+    return json.dumps(
+        {
+            "type": msg_type,
+            "stream": stream_id,
+            "seq": seq,
+            "ts": time.time(),
+            "data": data,
+        },
+        separators=(",", ":"),
+    )
+
+
+class SpaceStateFeed(object):
+    """
+    Numbered space state deltas, from the aggregator to the websocket clients.
+
+    The aggregator calls send_message() from the worker threads. Every delta gets the next
+    sequence number and is encoded once, the last history_size are kept so that a client
+    can resume from the last sequence number it received. Sequence numbers restart with
+    the process, so they are only valid together with the stream ID.
+    """
+
+    def __init__(
+        self,
+        asyncio_loop,
+        history_size=1000,
+        max_pending_per_client=100,
+        slow_client_policy=RESYNC,
+    ):
+        self.asyncio_loop = asyncio_loop
+        self.stream_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.last_seq = 0
+        self.history = deque(maxlen=history_size)
+        self.hub = BroadcastHub(max_pending_per_client, slow_client_policy)
+        self.listeners = []
+
+    def send_message(self, msg_type, **data):
+        """
+        Publish a delta. Can be called from any thread.
+        """
+        with self.lock:
+            self.last_seq += 1
+            message = (
+                self.last_seq,
+                encode_feed_message(msg_type, self.stream_id, self.last_seq, data),
+            )
+            self.history.append(message)
+            coalescing_key = COALESCING_KEYS.get(msg_type, lambda data: None)(data)
+            # Scheduled under the lock, so that the deltas are published in order
+            if self.asyncio_loop:
+                self.asyncio_loop.call_soon_threadsafe(
+                    self._publish, message, coalescing_key
+                )
+
+    def get_messages_since(self, stream_id, seq):
+        """
+        The encoded deltas after seq, or None when they are not available anymore
+        and the client needs a snapshot.
+        """
+        with self.lock:
+            if stream_id != self.stream_id or seq is None or seq > self.last_seq:
+                return None
+            if seq < self.last_seq - len(self.history):
+                return None
+            return [message for message in self.history if message[0] > seq]
+
+    def encode_snapshot(self, seq, space_state):
+        return encode_feed_message(SNAPSHOT, self.stream_id, seq, space_state)
+
+    # -- Subscriptions, only from the asyncio loop ----
+
+    def add_listener(self, callback):
+        """
+        callback() is called after every delta.
+        """
+        self.listeners.append(callback)
+
+    def _publish(self, message, coalescing_key):
+        self.hub.publish(message, coalescing_key)
+        for listener in self.listeners:
+            listener()
+
+    def subscribe(self, stream_id=None, seq=None):
+        """
+        Subscribe a client, which receives the deltas after seq if still available,
+        otherwise starts with a snapshot.
+        """
+        subscription = FeedSubscription(self, self.hub.subscribe())
+        if seq is None:
+            subscription.request_snapshot()
+        else:
+            subscription.resume(stream_id, seq)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.hub.unsubscribe(subscription.subscriber)
+
+
+class FeedSubscription(object):
+    """
+    The deltas not yet sent to one client. What happens when the client does not keep up
+    depends on the slow client policy: by default it gets a new snapshot.
+    """
+
+    def __init__(self, feed, subscriber):
+        self.feed = feed
+        self.subscriber = subscriber
+        self.resume_from = None
+        # Deltas up to this one were already sent, or are part of the sent snapshot
+        self.last_sent_seq = 0
+
+    def resume(self, stream_id, seq):
+        self.resume_from = (stream_id, seq)
+        self.subscriber.wake_up.set()
+
+    def request_snapshot(self):
+        self.subscriber.request_resync()
+
+    async def get_next_messages(self, get_space_state):
+        """
+        Waits for the next encoded messages to send to the client: a delta, the deltas
+        missed when resuming, or a snapshot built with the get_space_state coroutine.
+        Raises SubscriberDisconnected when the client was too slow.
+        """
+        while True:
+            if self.resume_from:
+                stream_id, seq = self.resume_from
+                self.resume_from = None
+                messages = self.feed.get_messages_since(stream_id, seq)
+                if messages is None:
+                    self.subscriber.request_resync()
+                else:
+                    self.last_sent_seq = messages[-1][0] if messages else seq
+                    if messages:
+                        return [text for _, text in messages]
+            if self.subscriber.take_resync():
+                # The pending deltas are all part of the snapshot. Those published while
+                # building it are sent after it, even if already part of it.
+                seq = self.feed.last_seq
+                space_state = await get_space_state()
+                self.last_sent_seq = seq
+                return [self.feed.encode_snapshot(seq, space_state)]
+            message = self.subscriber.get_nowait()
+            if message is None:
+                await self.subscriber.wait()
+            elif message[0] > self.last_sent_seq:
+                self.last_sent_seq = message[0]
+                return [message[1]]
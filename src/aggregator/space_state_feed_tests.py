@@ -0,0 +1,129 @@
+import asyncio
+import json
+import unittest
+
+from .space_state_feed import (
+    LIGHTS,
+    SNAPSHOT,
+    SPACE_OPEN,
+    USER_CHECKED_IN,
+    USER_CHECKED_OUT,
+    SpaceStateFeed,
+)
+from .testing_utils import STEFANO, AggregatorBaseTestSuite
+
+
+def decode(texts):
+    return [
+        (message["type"], message["seq"])
+        for message in (json.loads(text) for text in texts)
+    ]
+
+
+class TestSpaceStateFeed(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.num_snapshots = 0
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    async def get_space_state(self):
+        self.num_snapshots += 1
+        return {"space_open": True}
+
+    def get_next_messages(self, subscription):
+        return decode(
+            self.loop.run_until_complete(
+                asyncio.wait_for(
+                    subscription.get_next_messages(self.get_space_state), 1
+                )
+            )
+        )
+
+    def publish(self, feed, num_messages):
+        for _ in range(num_messages):
+            feed.send_message(msg_type=USER_CHECKED_OUT, user_id=1, history_line=None)
+
+    def test_new_clients_get_a_snapshot_then_the_deltas(self):
+        feed = SpaceStateFeed(self.loop)
+        self.publish(feed, 2)
+        subscription = feed.subscribe()
+        self.assertEqual(self.get_next_messages(subscription), [(SNAPSHOT, 2)])
+
+        self.publish(feed, 2)
+        self.assertEqual(self.get_next_messages(subscription), [(USER_CHECKED_OUT, 3)])
+        self.assertEqual(self.get_next_messages(subscription), [(USER_CHECKED_OUT, 4)])
+
+    def test_resuming_sends_the_missed_deltas(self):
+        feed = SpaceStateFeed(self.loop)
+        self.publish(feed, 3)
+        subscription = feed.subscribe(feed.stream_id, 1)
+        self.assertEqual(
+            self.get_next_messages(subscription),
+            [(USER_CHECKED_OUT, 2), (USER_CHECKED_OUT, 3)],
+        )
+
+        self.publish(feed, 1)
+        self.assertEqual(self.get_next_messages(subscription), [(USER_CHECKED_OUT, 4)])
+        self.assertEqual(self.num_snapshots, 0)
+
+    def test_resuming_needs_a_snapshot_when_the_deltas_are_gone(self):
+        feed = SpaceStateFeed(self.loop, history_size=2)
+        self.publish(feed, 5)
+
+        subscription = feed.subscribe(feed.stream_id, 2)
+        self.assertEqual(self.get_next_messages(subscription), [(SNAPSHOT, 5)])
+        subscription.resume(feed.stream_id, 3)
+        self.assertEqual(
+            self.get_next_messages(subscription),
+            [(USER_CHECKED_OUT, 4), (USER_CHECKED_OUT, 5)],
+        )
+        subscription.resume("stream of another process", 3)
+        self.assertEqual(self.get_next_messages(subscription), [(SNAPSHOT, 5)])
+
+    def test_slow_clients_get_a_new_snapshot(self):
+        feed = SpaceStateFeed(self.loop, max_pending_per_client=2)
+        subscription = feed.subscribe()
+        self.assertEqual(self.get_next_messages(subscription), [(SNAPSHOT, 0)])
+
+        self.publish(feed, 5)
+        self.assertEqual(self.get_next_messages(subscription), [(SNAPSHOT, 5)])
+        self.publish(feed, 1)
+        self.assertEqual(self.get_next_messages(subscription), [(USER_CHECKED_OUT, 6)])
+
+    def test_deltas_setting_the_same_state_are_coalesced(self):
+        feed = SpaceStateFeed(self.loop)
+        subscription = feed.subscribe()
+        self.assertEqual(self.get_next_messages(subscription), [(SNAPSHOT, 0)])
+
+        feed.send_message(msg_type=SPACE_OPEN, space_open=True)
+        self.publish(feed, 1)
+        feed.send_message(msg_type=SPACE_OPEN, space_open=False)
+        self.assertEqual(self.get_next_messages(subscription), [(USER_CHECKED_OUT, 2)])
+        self.assertEqual(self.get_next_messages(subscription), [(SPACE_OPEN, 3)])
+
+
+class TestAggregatorDeltas(AggregatorBaseTestSuite):
+    def setUp(self):
+        super().setUp()
+        self.feed = SpaceStateFeed(None)
+        self.aggregator.notifications_queue = self.feed
+
+    def test_changes_are_published_as_deltas(self):
+        self.aggregator.user_entered_space(STEFANO.user_id, self.logger)
+        self.aggregator.lights("large_room", True, self.logger)
+        self.aggregator.user_left_space(STEFANO.user_id, self.logger)
+
+        messages = [
+            json.loads(text)
+            for _, text in self.feed.get_messages_since(self.feed.stream_id, 0)
+        ]
+        self.assertEqual(
+            [(m["type"], m["seq"]) for m in messages],
+            [(USER_CHECKED_IN, 1), (LIGHTS, 2), (USER_CHECKED_OUT, 3)],
+        )
+        self.assertEqual(messages[0]["data"]["user"], STEFANO.for_json())
+        self.assertEqual(messages[2]["data"]["user_id"], STEFANO.user_id)
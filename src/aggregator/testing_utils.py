@@ -1,4 +1,7 @@
 import os
+import socket
+import socketserver
+import threading
 import unittest
 from collections import defaultdict
 
@@ -39,7 +42,7 @@ ALL_MACHINES = [
 ]
 
 
-class MockeHttpServerInputMessageQueue(object):
+class MockNotificationsQueue(object):
     def send_message(self, **kwargs):
         pass
 
@@ -47,11 +50,15 @@ class MockeHttpServerInputMessageQueue(object):
 class MockDatabaseAdapter(object):
     def __init__(self, test_suite):
         self.test_suite = test_suite
+        self.num_users_reloads = 0
+        self.num_machines_reloads = 0
 
     def get_all_users(self, logger):
+        self.num_users_reloads += 1
         return ALL_USERS
 
     def get_all_machines(self, logger):
+        self.num_machines_reloads += 1
         return ALL_MACHINES
 
 
@@ -66,12 +73,126 @@ class MockCrmAdapter(object):
         pass
 
 
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP server which keeps the received emails, for the tests.
+    Replies with failure_code to the next num_failures emails, and with
+    recipient_failure_code to the next num_recipient_failures recipients.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpSinkHandler)
+        self.host, self.port = self.server_address
+        self.lock = threading.Lock()
+        self.emails = []
+        self.num_connections = 0
+        self.connections = []
+        self.failure_code = 451
+        self.num_failures = 0
+        self.recipient_failure_code = 450
+        self.num_recipient_failures = 0
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def drop_connections(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.shutdown(socket.SHUT_RDWR)
+
+    def fail_next_emails(self, num_failures, failure_code=451):
+        with self.lock:
+            self.num_failures = num_failures
+            self.failure_code = failure_code
+
+    def fail_next_recipients(self, num_failures, failure_code=450):
+        with self.lock:
+            self.num_recipient_failures = num_failures
+            self.recipient_failure_code = failure_code
+
+    def _take_recipient_failure(self):
+        with self.lock:
+            if self.num_recipient_failures <= 0:
+                return None
+            self.num_recipient_failures -= 1
+            return self.recipient_failure_code
+
+    def _take_failure(self):
+        with self.lock:
+            if self.num_failures <= 0:
+                return None
+            self.num_failures -= 1
+            return self.failure_code
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.num_connections += 1
+            self.server.connections.append(self.request)
+        self._reply("220 sink ESMTP")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8").strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self._reply("250 sink")
+            elif verb == "MAIL":
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                failure_code = self.server._take_recipient_failure()
+                if failure_code:
+                    self._reply(f"{failure_code} Recipient refused")
+                    continue
+                recipients.append(command.split(":", 1)[1].strip(" <>"))
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                self._receive_data(recipients)
+            elif verb in ("RSET", "NOOP"):
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+    def _receive_data(self, recipients):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line.rstrip(b"\r\n") == b".":
+                break
+            lines.append(line)
+        failure_code = self.server._take_failure()
+        if failure_code:
+            self._reply(f"{failure_code} Try again later")
+            return
+        with self.server.lock:
+            self.server.emails.append((recipients, b"".join(lines).decode("utf-8")))
+        self._reply("250 OK")
+
+    def _reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode("utf-8"))
+
+
 class AggregatorBaseTestSuite(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None  # To see large JSON diffs
         self.logger = configure_logging_for_tests()
         self.clock = MockClock()
-        http_server_input_message_queue = MockeHttpServerInputMessageQueue()
         self.redis_adapter = RedisAdapter(
             self.clock,
             "127.0.0.1",
@@ -92,7 +213,7 @@ class AggregatorBaseTestSuite(unittest.TestCase):
             self.db,
             self.redis_adapter,
             self.crm_adapter,
-            http_server_input_message_queue,
+            MockNotificationsQueue(),
             self.clock,
             self,
             self.task_scheduler,
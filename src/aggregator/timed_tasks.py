@@ -1,4 +1,5 @@
 import asyncio
+import threading
 
 import aiocron
 
@@ -7,14 +8,27 @@ def start_checking_for_stale_checkins(aggregator, worker_input_queue, crontab, l
     @aiocron.crontab(crontab)
     @asyncio.coroutine
     def early_in_the_morning():
-        worker_input_queue.add_task(aggregator.clean_stale_user_checkins, logger)
+        worker_input_queue.add_task_without_blocking(
+            aggregator.clean_stale_user_checkins, logger
+        )
 
 
 def start_checking_for_off_machines(aggregator, worker_input_queue, logger):
     @aiocron.crontab("*/5 * * * *")  # Every five minutes
     @asyncio.coroutine
     def early_in_the_morning():
-        worker_input_queue.add_task(aggregator.check_expired_machine_state, logger)
+        worker_input_queue.add_task_without_blocking(
+            aggregator.check_expired_machine_state, logger
+        )
+
+
+def start_syncing_directories(aggregator, worker_input_queue, crontab, logger):
+    @aiocron.crontab(crontab)
+    @asyncio.coroutine
+    def sync_directories():
+        worker_input_queue.add_task_without_blocking(
+            aggregator.sync_directories, logger
+        )
 
 
 class TaskScheduler(object):
@@ -22,15 +36,20 @@ class TaskScheduler(object):
         self.logger = logger.getLogger(subsystem="task_scheduler")
         self.clock = clock
         self.scheduled_tasks = []
+        # Tasks can be scheduled from any of the workers
+        self.lock = threading.Lock()
 
     def schedule_task_at_time(self, time, function, logger):
-        self.scheduled_tasks.append((time, function, logger))
+        with self.lock:
+            self.scheduled_tasks.append((time, function, logger))
 
     def start_running_scheduled_tasks(self, worker_input_queue):
         @aiocron.crontab("* * * * *")  # Every minute
         @asyncio.coroutine
         def execute_for_due_tasks():
-            worker_input_queue.add_task(self.actually_execute_due_tasks, self.logger)
+            worker_input_queue.add_task_without_blocking(
+                self.actually_execute_due_tasks, self.logger
+            )
 
     def actually_execute_due_tasks(self, _logger):
         for function, logger in self._extract_due_tasks():
@@ -40,10 +59,11 @@ class TaskScheduler(object):
         now = self.clock.now()
         tasks_left = []
         tasks_due = []
-        for time, function, logger in self.scheduled_tasks:
-            if time < now:
-                tasks_due.append((function, logger))
-            else:
-                tasks_left.append((time, function, logger))
-        self.scheduled_tasks = tasks_left
+        with self.lock:
+            for time, function, logger in self.scheduled_tasks:
+                if time < now:
+                    tasks_due.append((function, logger))
+                else:
+                    tasks_left.append((time, function, logger))
+            self.scheduled_tasks = tasks_left
         return tasks_due
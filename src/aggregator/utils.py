@@ -6,3 +6,11 @@ CHARS_FOR_RANDOM_REQ_ID = string.digits + string.ascii_lowercase
 
 def make_random_string(length):
     return "".join([random.choice(CHARS_FOR_RANDOM_REQ_ID) for _ in range(length)])
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[
+        min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    ]
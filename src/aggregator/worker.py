@@ -1,22 +1,62 @@
+import functools
 import threading
+import time
+
+from .metrics import REGISTRY
+
+WORKER_TASKS = REGISTRY.counter(
+    "aggregator_worker_tasks_total", "Tasks executed by the worker", ("task",)
+)
+WORKER_TASK_ERRORS = REGISTRY.counter(
+    "aggregator_worker_task_errors_total",
+    "Tasks executed by the worker that raised an exception",
+    ("task",),
+)
+WORKER_TASK_DURATION = REGISTRY.histogram(
+    "aggregator_worker_task_duration_seconds",
+    "Duration of the tasks executed by the worker",
+    ("task",),
+)
+
+
+def get_task_name(task):
+    # Tasks are usually partials of the Aggregator methods
+    while isinstance(task, functools.partial):
+        task = task.func
+    return getattr(task, "__name__", task.__class__.__name__)
 
 
 class Worker(object):
-    def __init__(self, input_queue):
+    def __init__(self, input_queue, pool_size=1):
         self.input_queue = input_queue
+        self.pool_size = pool_size
 
     def start_working_in_background_thread(self):
-        thread = threading.Thread(target=self._main)
-        thread.daemon = True
-        thread.start()
+        for _ in range(self.pool_size):
+            thread = threading.Thread(target=self._main)
+            thread.daemon = True
+            thread.start()
 
     def _main(self):
         while True:
-            task, respond, logger = self.input_queue.get_next_task_blocking()
+            (
+                partition_key,
+                (task, respond, logger),
+            ) = self.input_queue.get_next_task_blocking()
+            task_name = get_task_name(task)
             result = error = None
+            start = time.perf_counter()
             try:
                 result = task(logger)
             except Exception as err:
                 error = err
-            if respond:
-                respond(error, result)
+                WORKER_TASK_ERRORS.inc(task_name)
+            WORKER_TASKS.inc(task_name)
+            WORKER_TASK_DURATION.observe(time.perf_counter() - start, task_name)
+            try:
+                if respond:
+                    respond(error, result)
+            except Exception:
+                logger.exception(f"Cannot respond to task {task_name}")
+            finally:
+                self.input_queue.task_done(partition_key)
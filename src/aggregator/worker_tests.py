@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from .communication import (
+    COALESCE,
+    COALESCED,
+    DROP,
+    DROPPED,
+    QUEUED,
+    PartitionedTaskQueue,
+    ReaderPool,
+    WorkerInputQueue,
+    WorkerQueueFull,
+)
+from .logging import configure_logging_for_tests
+from .worker import Worker
+
+
+class TestPartitionedTaskQueue(unittest.TestCase):
+    def test_same_partition_is_handed_out_after_task_done(self):
+        queue = PartitionedTaskQueue()
+        queue.put("a1", "a")
+        queue.put("a2", "a")
+        queue.put("b1", "b")
+
+        self.assertEqual(queue.get(), ("a", "a1"))
+        self.assertEqual(queue.get(), ("b", "b1"))
+        queue.task_done("a")
+        self.assertEqual(queue.get(), ("a", "a2"))
+        queue.task_done("a")
+        queue.task_done("b")
+        self.assertEqual(queue.qsize(), 0)
+        queue.join()
+
+    def test_put_blocks_while_the_partition_is_full(self):
+        queue = PartitionedTaskQueue(max_pending_per_partition=1)
+        queue.put("a1", "a")
+        queue.put("b1", "b")
+        put_done = threading.Event()
+
+        def put():
+            queue.put("a2", "a")
+            put_done.set()
+
+        threading.Thread(target=put, daemon=True).start()
+        self.assertFalse(put_done.wait(0.05))
+        self.assertEqual(queue.get(), ("a", "a1"))
+        self.assertTrue(put_done.wait(1))
+
+    def test_overflow_policies(self):
+        queue = PartitionedTaskQueue(max_size=2)
+        self.assertEqual(queue.put("on", "machine", COALESCE, "state"), QUEUED)
+        self.assertEqual(queue.put("a1", "a"), QUEUED)
+
+        self.assertEqual(queue.put("off", "machine", COALESCE, "state"), COALESCED)
+        self.assertEqual(queue.put("open", "space", COALESCE, "space"), DROPPED)
+        self.assertEqual(queue.put("a2", "a", DROP), DROPPED)
+        self.assertEqual(queue.qsize(), 2)
+
+        self.assertEqual(queue.get(), ("machine", "off"))
+        queue.task_done("machine")
+        # Not pending anymore, so not replaced
+        self.assertEqual(queue.put("on", "machine", COALESCE, "state"), QUEUED)
+        self.assertEqual(queue.put("off", "machine", COALESCE, "state"), COALESCED)
+
+    def test_coalesced_task_runs_after_the_tasks_queued_before_it(self):
+        queue = PartitionedTaskQueue(max_size=2)
+        queue.put("state working", "machine", COALESCE, "state")
+        queue.put("power on", "machine")
+
+        self.assertEqual(
+            queue.put("state ready", "machine", COALESCE, "state"), COALESCED
+        )
+        self.assertEqual(queue.get(), ("machine", "power on"))
+        queue.task_done("machine")
+        self.assertEqual(queue.get(), ("machine", "state ready"))
+        queue.task_done("machine")
+        self.assertEqual(queue.qsize(), 0)
+        queue.join()
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.logger = configure_logging_for_tests()
+        self.loop = asyncio.new_event_loop()
+        self.worker_input_queue = WorkerInputQueue(self.loop)
+        Worker(self.worker_input_queue, 4).start_working_in_background_thread()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_tasks_of_a_partition_run_in_order(self):
+        results = []
+        for i in range(50):
+            self.worker_input_queue.add_task(
+                lambda logger, i=i: results.append(i), self.logger, "machine"
+            )
+        self.worker_input_queue.wait_until_empty()
+        self.assertEqual(results, list(range(50)))
+
+    def test_a_slow_partition_does_not_block_the_others(self):
+        release = threading.Event()
+
+        def slow_checkin(logger):
+            release.wait(5)
+
+        self.worker_input_queue.add_task(slow_checkin, self.logger, ("user", 1))
+        start = time.monotonic()
+        result = self.worker_input_queue.add_task_with_result_blocking(
+            lambda logger: "space_state", self.logger
+        )
+        self.assertEqual(result, "space_state")
+        self.assertLess(time.monotonic() - start, 1)
+        release.set()
+        self.worker_input_queue.wait_until_empty()
+
+    def test_result_future(self):
+        async def get_result():
+            return await self.worker_input_queue.add_task_with_result_future(
+                lambda logger: 42, self.logger, "tags"
+            )
+
+        self.assertEqual(self.loop.run_until_complete(get_result()), 42)
+
+    def test_check_ins_are_never_dropped(self):
+        with self.assertRaises(ValueError):
+            WorkerInputQueue(self.loop, overflow_policies={"user_entered_space": DROP})
+
+    def test_result_future_fails_when_the_queue_is_full(self):
+        worker_input_queue = WorkerInputQueue(self.loop, max_size=1)
+        worker_input_queue.add_task(lambda logger: None, self.logger)
+
+        async def get_result():
+            return await worker_input_queue.add_task_with_result_future(
+                lambda logger: 42, self.logger
+            )
+
+        with self.assertRaises(WorkerQueueFull):
+            self.loop.run_until_complete(get_result())
+        self.assertEqual(worker_input_queue.get_stats()["dropped"], 1)
+
+    def test_tasks_from_the_loop_are_dropped_when_the_queue_is_full(self):
+        worker_input_queue = WorkerInputQueue(self.loop, max_size=1)
+        self.assertEqual(
+            worker_input_queue.add_task_without_blocking(
+                lambda logger: None, self.logger
+            ),
+            QUEUED,
+        )
+        self.assertEqual(
+            worker_input_queue.add_task_without_blocking(
+                lambda logger: None, self.logger
+            ),
+            DROPPED,
+        )
+        self.assertEqual(worker_input_queue.get_stats()["pending"], 1)
+
+    def test_errors_are_raised_to_the_caller(self):
+        def fail(logger):
+            raise ValueError("Boom")
+
+        with self.assertRaises(ValueError):
+            self.worker_input_queue.add_task_with_result_blocking(fail, self.logger)
+
+    def test_failing_response_does_not_block_the_partition(self):
+        def respond(error, result):
+            raise RuntimeError("Caller gone")
+
+        done = threading.Event()
+        self.worker_input_queue._put(lambda logger: 42, respond, self.logger, "tags")
+        self.worker_input_queue.add_task(lambda logger: done.set(), self.logger, "tags")
+        self.assertTrue(done.wait(5))
+
+
+class TestReaderPool(unittest.TestCase):
+    def setUp(self):
+        self.logger = configure_logging_for_tests()
+        self.loop = asyncio.new_event_loop()
+        self.worker_input_queue = WorkerInputQueue(self.loop)
+        Worker(self.worker_input_queue).start_working_in_background_thread()
+        self.reader_pool = ReaderPool(self.loop, 2)
+
+    def tearDown(self):
+        self.reader_pool.stop()
+        self.loop.close()
+
+    def test_reads_do_not_wait_for_the_worker(self):
+        worker_busy = threading.Event()
+        self.worker_input_queue.add_task(
+            lambda logger: worker_busy.wait(5), self.logger
+        )
+
+        result = self.loop.run_until_complete(
+            asyncio.wait_for(
+                self.reader_pool.run(lambda logger: "read", self.logger), 1
+            )
+        )
+        worker_busy.set()
+        self.assertEqual(result, "read")
+        self.assertEqual(self.reader_pool.get_stats()["reads"], 1)